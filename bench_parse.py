@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк парсинга страниц с кодами
+Сравнивает бэкенды BeautifulSoup (html.parser, lxml, html5lib - какие установлены)
+в режимах "вся страница" и "только таблица" на сохраненных копиях afk.guide и lolvvv.com:
+время разбора (среднее и p95) и пиковая память на один парсинг, результат в JSON
+
+Запуск:
+    python3 bench_parse.py --download             # сохранить свежие копии страниц в bench_pages/
+    python3 bench_parse.py --repeat 50 --output parse.json
+Без сохраненных копий используются синтетические страницы похожей структуры
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import requests
+
+from run_direct_api_fixed import (
+    FULL_CODE_WEBSITES,
+    _parse_afk_guide_html,
+    _parse_lolvvv_html,
+)
+
+PAGES_DIR = 'bench_pages'
+
+# Страница: имя -> (файл копии, URL, функция разбора)
+PAGES: Dict[str, tuple] = {
+    'afk.guide': ('afk_guide.html', FULL_CODE_WEBSITES[0], _parse_afk_guide_html),
+    'lolvvv.com': ('lolvvv.html', FULL_CODE_WEBSITES[1], _parse_lolvvv_html),
+}
+
+# Бэкенд BeautifulSoup -> модуль, который должен быть установлен
+BACKENDS = {
+    'html.parser': None,
+    'lxml': 'lxml',
+    'html5lib': 'html5lib',
+}
+
+def available_backends() -> List[str]:
+    return [name for name, module in BACKENDS.items() if module is None or importlib.util.find_spec(module)]
+
+def _filler(size: int) -> str:
+    """Разметка вне таблицы: меню, статьи, скрипты - основная масса реальной страницы"""
+    block = ('<div class="post"><nav><ul>' + '<li><a href="/x">Link</a></li>' * 10 + '</ul></nav>'
+             '<p>AFK Arena guide text with some <b>bold</b> words and <i>markup</i>.</p>'
+             '<script>var cfg = {"a": 1, "b": [1, 2, 3]};</script></div>\n')
+    return block * max(1, size // len(block))
+
+def synthetic_page(name: str, codes: int = 40, filler: int = 400_000) -> bytes:
+    """Синтетическая страница со структурой, которую ожидают парсеры"""
+    if name == 'afk.guide':
+        rows = ''.join(
+            f'<tr class="ninja_table_row_{i} nt_row_id_{i}"><td class="ninja_column_0">code{i:04d}x</td>'
+            f'<td class="ninja_column_1">Diamonds x300</td><td class="ninja_column_2">2099-01-01</td></tr>'
+            for i in range(codes))
+        table = (f'<table data-ninja_table_instance="ninja_table_instance_0" class="ninja_table foo_table">'
+                 f'<thead><tr><th>Code</th><th>Rewards</th><th>Expires</th></tr></thead><tbody>{rows}</tbody></table>')
+    else:
+        rows = ''.join(
+            f'<tr><td class="select-all">lolv{i:04d}z</td><td>Diamonds x300</td>'
+            f'<td><button class="btn rounded">Copy</button></td></tr>'
+            for i in range(codes))
+        table = f'<table><caption>Active AFK Arena Codes</caption><tbody>{rows}</tbody></table>'
+    half = _filler(filler // 2)
+    return f'<html><head><title>{name}</title></head><body>{half}{table}{half}</body></html>'.encode()
+
+def load_page(name: str) -> tuple:
+    """Сохраненная копия страницы или синтетическая замена"""
+    path = os.path.join(PAGES_DIR, PAGES[name][0])
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read(), path
+    return synthetic_page(name), 'synthetic'
+
+def download_pages():
+    os.makedirs(PAGES_DIR, exist_ok=True)
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    }
+    for name, (filename, url, _) in PAGES.items():
+        response = requests.get(url, headers=headers, timeout=15)
+        response.raise_for_status()
+        path = os.path.join(PAGES_DIR, filename)
+        with open(path, 'wb') as f:
+            f.write(response.content)
+        print(f"💾 {name}: {len(response.content)} байт -> {path}", file=sys.stderr)
+
+def measure(parse: Callable, content: bytes, backend: str, table_only: bool, repeat: int) -> Dict:
+    """Время каждого разбора и пиковая память одного разбора"""
+    timings = []
+    codes = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        codes = parse(content, parser=backend, table_only=table_only)
+        timings.append(time.perf_counter() - started)
+    
+    tracemalloc.start()
+    parse(content, parser=backend, table_only=table_only)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    ordered = sorted(timings)
+    return {
+        "mean_ms": round(sum(timings) / len(timings) * 1000, 3),
+        "p95_ms": round(ordered[max(0, math.ceil(0.95 * len(ordered)) - 1)] * 1000, 3),
+        "peak_memory_kb": round(peak / 1024, 1),
+        "codes_found": len(codes),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк парсинга страниц с кодами")
+    parser.add_argument('--download', action='store_true', help=f"Сохранить свежие копии страниц в {PAGES_DIR}/")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--backends', nargs='+', help=f"По умолчанию все установленные из {list(BACKENDS)}")
+    parser.add_argument('--output', help="Файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+    
+    # Логи парсеров на каждый разбор исказили бы замеры
+    logging.disable(logging.CRITICAL)
+    
+    if args.download:
+        download_pages()
+    
+    backends = args.backends or available_backends()
+    results = []
+    for name, (_, _, parse) in PAGES.items():
+        content, origin = load_page(name)
+        for backend in backends:
+            for table_only in (False, True):
+                result = measure(parse, content, backend, table_only, args.repeat)
+                result.update({
+                    "page": name,
+                    "page_source": origin,
+                    "page_bytes": len(content),
+                    "backend": backend,
+                    "mode": "table" if table_only else "full",
+                })
+                print(f"⏱️ {name} {backend:<11} {result['mode']:<5} {result['mean_ms']:>9.2f} мс "
+                      f"{result['peak_memory_kb']:>9.1f} КБ, кодов {result['codes_found']}", file=sys.stderr)
+                results.append(result)
+    
+    report = {
+        "benchmark": "parse_pages",
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"💾 Результаты сохранены в {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк активации кодов против локальной заглушки API Lilith
+Прогоняет redeem_codes_batch_with_tracking по сетке параметров (число ролей, число кодов,
+задержка сервера, лимит частоты) и выводит JSON: коды/минуту, p50/p95/p99 задержки
+одной HTTP попытки /api/consume, число и сумму пауз перед повторами, время сессии и долю окна Verification Code
+
+Запуск:
+    python3 bench_redeem.py --output bench.json
+    python3 bench_redeem.py --engines async --codes 30 --latency lognormal:0.3:0.5 --rate-limit 0 --rate-limit 10
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import direct_lilith_api
+from direct_lilith_api import (
+    AsyncLilithAPI,
+    DeadCodeRegistry,
+    LilithAPI,
+    VERIFICATION_CODE_LIFETIME,
+    close_shared_session,
+)
+from mock_lilith_server import CODE_USED, CODE_VALID, LatencyModel, MockLilithServer
+
+# Сетка по умолчанию
+DEFAULT_ROLES = [1, 3]
+DEFAULT_CODES = [10, 30]
+DEFAULT_LATENCIES = ['fixed:0.05', 'lognormal:0.3:0.6']
+DEFAULT_RATE_LIMITS = [0, 10]  # 0 - без лимита, иначе запросов /api/consume за RATE_WINDOW
+RATE_WINDOW = 10.0
+
+# Доли "мертвых" кодов в наборе: каждый INVALID_EVERY-й не существует, каждый USED_EVERY-й уже активирован
+INVALID_EVERY = 5
+USED_EVERY = 7
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return round(ordered[rank], 4)
+
+def make_codes(count: int) -> Dict[str, str]:
+    """Набор уникальных кодов и их состояние на сервере (None - код не существует)"""
+    prefix = uuid.uuid4().hex[:6]
+    codes = {}
+    for i in range(1, count + 1):
+        code = f"b{prefix}{i:03d}"
+        if i % INVALID_EVERY == 0:
+            codes[code] = None
+        elif i % USED_EVERY == 0:
+            codes[code] = CODE_USED
+        else:
+            codes[code] = CODE_VALID
+    return codes
+
+def _instrument(api, latencies: List[float], retry_sleeps: List[float]):
+    """
+    Замеры экземпляра API: latencies - время каждой HTTP попытки /api/consume (его передает
+    регулятору пауз _post, только для /api/consume), retry_sleeps - паузы перед повторами
+    (backoff и Retry-After) отдельно, чтобы они не попадали в задержку запроса
+    """
+    record_response = api.pacer.record_response
+    
+    def timed_response(status, data, latency):
+        latencies.append(latency)
+        record_response(status, data, latency)
+    
+    next_delay = api.retry.next_delay
+    
+    def counted_delay(attempt, retry_after=None):
+        delay = next_delay(attempt, retry_after)
+        if delay is not None:
+            retry_sleeps.append(delay)
+        return delay
+    
+    api.pacer.record_response = timed_response
+    api.retry.next_delay = counted_delay
+
+async def run_sync_engine(base_url: str, uid: str, codes: List[str],
+                          latencies: List[float], retry_sleeps: List[float]) -> Dict:
+    """LilithAPI (requests) в отдельном потоке, как в консольной версии"""
+    def session():
+        deadline = time.time() + VERIFICATION_CODE_LIFETIME
+        api = LilithAPI(uid, "bench", base_url=base_url)
+        _instrument(api, latencies, retry_sleeps)
+        if not api.verify_account():
+            raise RuntimeError("Верификация на заглушке не прошла")
+        return api.redeem_codes_batch_with_tracking(codes, batch_size=len(codes), deadline=deadline)
+    
+    return await asyncio.get_running_loop().run_in_executor(None, session)
+
+async def run_async_engine(base_url: str, uid: str, codes: List[str],
+                           latencies: List[float], retry_sleeps: List[float]) -> Dict:
+    """AsyncLilithAPI на общем пуле соединений, как в Telegram боте"""
+    deadline = time.time() + VERIFICATION_CODE_LIFETIME
+    api = AsyncLilithAPI(uid, "bench", base_url=base_url)
+    _instrument(api, latencies, retry_sleeps)
+    if not await api.verify_account():
+        raise RuntimeError("Верификация на заглушке не прошла")
+    return await api.redeem_codes_batch_with_tracking(codes, batch_size=len(codes), deadline=deadline)
+
+# Движки активации: имя -> корутина (base_url, uid, codes, latencies, retry_sleeps) -> статистика батча
+ENGINES: Dict[str, Callable] = {
+    'sync': run_sync_engine,
+    'async': run_async_engine,
+}
+
+async def run_case(engine: str, roles: int, code_count: int, latency: str, rate_limit: int) -> Dict:
+    """Один прогон: свежая заглушка, свежий UID (без выученных пауз и кэшей)"""
+    code_states = make_codes(code_count)
+    server = MockLilithServer(
+        codes={code: state for code, state in code_states.items() if state},
+        roles=roles,
+        latency=LatencyModel.parse(latency),
+        rate_limit=rate_limit or None,
+        rate_window=RATE_WINDOW
+    )
+    base_url = await server.start()
+    uid = f"bench-{uuid.uuid4().hex[:8]}"
+    latencies: List[float] = []
+    retry_sleeps: List[float] = []
+    
+    started = time.perf_counter()
+    try:
+        stats = await ENGINES[engine](base_url, uid, list(code_states), latencies, retry_sleeps)
+    finally:
+        wall = time.perf_counter() - started
+        await close_shared_session()
+        await server.stop()
+    
+    processed = stats.get("total_processed", 0)
+    return {
+        "engine": engine,
+        "roles": roles,
+        "codes": code_count,
+        "latency": latency,
+        "rate_limit": rate_limit,
+        "wall_time_s": round(wall, 3),
+        "window_share": round(wall / VERIFICATION_CODE_LIFETIME, 4),
+        "codes_per_minute": round(processed / wall * 60, 2) if wall > 0 else None,
+        "consume_requests": len(latencies),
+        "consume_latency_p50_s": percentile(latencies, 50),
+        "consume_latency_p95_s": percentile(latencies, 95),
+        "consume_latency_p99_s": percentile(latencies, 99),
+        "retries": len(retry_sleeps),
+        "retry_sleep_s": round(sum(retry_sleeps), 3),
+        "throttled": server.stats.get('throttled', 0),
+        "processed": processed,
+        "success": len(stats.get("successful_codes", [])),
+        "already_used": len(stats.get("already_used_codes", [])),
+        "failed": len(stats.get("failed_codes", [])),
+        "not_attempted": len(stats.get("not_attempted_codes", [])),
+        "remaining": len(stats.get("remaining_codes", [])),
+        "aborted": stats.get("aborted", False),
+    }
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+async def run_grid(args) -> Dict:
+    # Мертвые коды бенчмарка не должны попасть в рабочий dead_codes.json
+    scratch = tempfile.mkdtemp(prefix="bench_redeem_")
+    direct_lilith_api.dead_codes = DeadCodeRegistry(os.path.join(scratch, "dead_codes.json"))
+    
+    grid = list(itertools.product(args.engines, args.roles, args.codes, args.latency, args.rate_limit))
+    results = []
+    for i, (engine, roles, code_count, latency, rate_limit) in enumerate(grid, 1):
+        print(f"⏱️ [{i}/{len(grid)}] {engine}: ролей {roles}, кодов {code_count}, "
+              f"задержка {latency}, лимит {rate_limit or 'нет'}", file=sys.stderr)
+        result = await run_case(engine, roles, code_count, latency, rate_limit)
+        print(f"   {result['codes_per_minute']} кодов/мин, {result['wall_time_s']}с "
+              f"({result['window_share']:.0%} окна), p95 {result['consume_latency_p95_s']}с", file=sys.stderr)
+        results.append(result)
+    
+    return {
+        "benchmark": "redeem_batch",
+        "timestamp": datetime.now().isoformat(),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "verification_window_s": VERIFICATION_CODE_LIFETIME,
+        "rate_window_s": RATE_WINDOW,
+        "results": results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк активации кодов против заглушки API Lilith")
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=sorted(ENGINES))
+    parser.add_argument('--roles', type=int, action='append', help=f"По умолчанию {DEFAULT_ROLES}")
+    parser.add_argument('--codes', type=int, action='append', help=f"По умолчанию {DEFAULT_CODES}")
+    parser.add_argument('--latency', action='append', help=f"По умолчанию {DEFAULT_LATENCIES}")
+    parser.add_argument('--rate-limit', type=int, action='append',
+                        help=f"Запросов за {RATE_WINDOW:.0f}с, 0 - без лимита. По умолчанию {DEFAULT_RATE_LIMITS}")
+    parser.add_argument('--output', help="Файл для JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+    
+    args.roles = args.roles or DEFAULT_ROLES
+    args.codes = args.codes or DEFAULT_CODES
+    args.latency = args.latency or DEFAULT_LATENCIES
+    args.rate_limit = args.rate_limit or DEFAULT_RATE_LIMITS
+    
+    logging.basicConfig(level=logging.ERROR)
+    
+    report = asyncio.run(run_grid(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+        print(f"💾 Результаты сохранены в {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+История кодов по UID в SQLite (режим WAL)
+Заменяет used_codes.json / failed_codes.json: одна строка на пару (uid, code_key)
+со статусом и временем, поэтому проверка и запись стоят столько, сколько кодов
+затронуто, а не сколько всего истории у всех пользователей
+Там же очередь отложенных кодов (вместо pending_codes.json): очередь UID
+заменяется одной транзакцией и не задевает очереди других пользователей
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from code_identity import code_key, dedupe_codes
+
+logger = logging.getLogger(__name__)
+
+STATUS_USED = 'used'  # Активирован (или уже был активирован ранее) - окончательно
+STATUS_FAILED = 'failed'  # Не удалось активировать - можно сбросить и попробовать снова
+
+# Лимит параметров в одном запросе SQLite (SQLITE_MAX_VARIABLE_NUMBER в старых сборках - 999)
+QUERY_CHUNK = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS code_history (
+    uid TEXT NOT NULL,
+    code_key TEXT NOT NULL,
+    code TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (uid, code_key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_code_history_uid_status ON code_history (uid, status, created_at);
+CREATE TABLE IF NOT EXISTS pending_codes (
+    uid TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (uid, position)
+) WITHOUT ROWID;
+'''
+
+# Использованный код не понижается до неуспешного, неуспешный становится использованным
+UPSERT = '''
+INSERT INTO code_history (uid, code_key, code, status, created_at, updated_at)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (uid, code_key) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+WHERE code_history.status != excluded.status AND code_history.status != 'used'
+'''
+
+def _chunks(items: List[str], size: int = QUERY_CHUNK) -> Iterable[List[str]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+class CodeHistory:
+    """
+    Хранилище истории кодов
+    Соединение открывается лениво, свое на каждый поток (обработчики бота работают
+    из пула потоков); при первом открытии старые JSON файлы переносятся в базу
+    """
+    
+    def __init__(self, path: str, used_json: Optional[str] = None, failed_json: Optional[str] = None,
+                 pending_json: Optional[str] = None):
+        self.path = path
+        self.used_json = used_json
+        self.failed_json = failed_json
+        self.pending_json = pending_json
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+    
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    connection.executescript(SCHEMA)
+                    self._migrate_json(connection)
+                    self._migrate_pending_json(connection)
+                    self._initialized = True
+        return connection
+    
+    def _migrate_json(self, connection: sqlite3.Connection):
+        """Переносит used_codes.json / failed_codes.json в базу и переименовывает их в *.migrated"""
+        # Сначала неуспешные: если код есть в обоих файлах, итоговый статус - использованный
+        for path, status in ((self.failed_json, STATUS_FAILED), (self.used_json, STATUS_USED)):
+            if not path or not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    history = json.load(f)
+            except Exception as e:
+                logger.error(f"❌ Не удалось прочитать {path} для переноса в {self.path}: {e}")
+                continue
+            
+            total = 0
+            with connection:
+                for uid, codes in history.items():
+                    total += self._write(connection, uid, codes, status)
+            os.replace(path, path + '.migrated')
+            logger.info(f"📦 Перенесено {total} записей из {path} в {self.path} (старый файл: {path}.migrated)")
+    
+    def _migrate_pending_json(self, connection: sqlite3.Connection):
+        """Переносит pending_codes.json в базу и переименовывает его в *.migrated"""
+        path = self.pending_json
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                pending = json.load(f)
+        except Exception as e:
+            logger.error(f"❌ Не удалось прочитать {path} для переноса в {self.path}: {e}")
+            return
+        
+        with connection:
+            for uid, code_records in pending.items():
+                self._write_pending(connection, uid, code_records)
+        os.replace(path, path + '.migrated')
+        logger.info(f"📦 Перенесены очереди {len(pending)} UID из {path} в {self.path} (старый файл: {path}.migrated)")
+    
+    def _write(self, connection: sqlite3.Connection, uid: str, codes: Iterable[str], status: str) -> int:
+        now = time.time()
+        before = connection.total_changes
+        connection.executemany(UPSERT, [(uid, code_key(code), code.strip(), status, now, now)
+                                        for code in dedupe_codes(codes)])
+        return connection.total_changes - before
+    
+    def add(self, uid: str, codes: Iterable[str], status: str) -> int:
+        """Записывает коды со статусом, возвращает число новых или изменившихся записей"""
+        connection = self._connect()
+        with connection:
+            return self._write(connection, uid, codes, status)
+    
+    def codes(self, uid: str, status: str) -> List[str]:
+        """Коды UID с данным статусом в порядке добавления"""
+        rows = self._connect().execute(
+            'SELECT code FROM code_history WHERE uid = ? AND status = ? ORDER BY created_at, code_key',
+            (uid, status)
+        )
+        return [code for (code,) in rows]
+    
+    def count(self, uid: str, status: str) -> int:
+        (total,) = self._connect().execute(
+            'SELECT COUNT(*) FROM code_history WHERE uid = ? AND status = ?', (uid, status)
+        ).fetchone()
+        return total
+    
+    def recent_codes(self, status: str, limit: int) -> List[str]:
+        """Последние limit разных кодов с данным статусом у всех UID (новые первыми)"""
+        rows = self._connect().execute(
+            'SELECT code FROM code_history WHERE status = ? GROUP BY code_key ORDER BY MAX(updated_at) DESC LIMIT ?',
+            (status, limit)
+        )
+        return [code for (code,) in rows]
+    
+    def known_keys(self, uid: str, codes: Iterable[str]) -> Set[str]:
+        """Ключи кодов из списка, которые уже есть в истории UID (любой статус) - поиск по первичному ключу"""
+        keys = list({code_key(code) for code in codes} - {''})
+        known = set()
+        connection = self._connect()
+        for chunk in _chunks(keys):
+            placeholders = ', '.join('?' * len(chunk))
+            rows = connection.execute(
+                f'SELECT code_key FROM code_history WHERE uid = ? AND code_key IN ({placeholders})',
+                [uid, *chunk]
+            )
+            known.update(key for (key,) in rows)
+        return known
+    
+    def _write_pending(self, connection: sqlite3.Connection, uid: str, code_records: List[Dict]):
+        connection.execute('DELETE FROM pending_codes WHERE uid = ?', (uid,))
+        connection.executemany(
+            'INSERT INTO pending_codes (uid, position, record) VALUES (?, ?, ?)',
+            [(uid, position, json.dumps(code_data, ensure_ascii=False))
+             for position, code_data in enumerate(code_records)]
+        )
+    
+    def pending(self, uid: str) -> List[Dict]:
+        """Очередь отложенных кодов UID (записи кодов в порядке очереди)"""
+        rows = self._connect().execute(
+            'SELECT record FROM pending_codes WHERE uid = ? ORDER BY position', (uid,)
+        )
+        return [json.loads(record) for (record,) in rows]
+    
+    def set_pending(self, uid: str, code_records: List[Dict]):
+        """Заменяет очередь отложенных кодов UID (пустой список удаляет очередь)"""
+        connection = self._connect()
+        with connection:
+            self._write_pending(connection, uid, code_records)
+    
+    def clear(self, uid: str, status: str) -> int:
+        """Удаляет коды UID с данным статусом, возвращает число удаленных"""
+        connection = self._connect()
+        with connection:
+            return connection.execute(
+                'DELETE FROM code_history WHERE uid = ? AND status = ?', (uid, status)
+            ).rowcount
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Идентичность промокодов AFK Arena
+Канонический ключ кода и индексы на его основе: все проверки "код уже есть /
+уже использован / уже в очереди" идут через code_key, поэтому регистр и пробелы
+не порождают дубликатов, а поиск в истории любого размера стоит O(1)
+"""
+
+from typing import Dict, Iterable, Iterator, List
+
+def code_key(code) -> str:
+    """Канонический ключ кода: без пробелов по краям и без учета регистра"""
+    return str(code or '').strip().casefold()
+
+class CodeIndex:
+    """
+    Множество кодов по каноническим ключам
+    Хранит код в написании первого появления и сохраняет порядок добавления
+    """
+    
+    def __init__(self, codes: Iterable[str] = ()):
+        self._codes: Dict[str, str] = {}
+        self.update(codes)
+    
+    def add(self, code: str) -> bool:
+        """Добавляет код, возвращает False для пустого кода или дубликата"""
+        key = code_key(code)
+        if not key or key in self._codes:
+            return False
+        self._codes[key] = code
+        return True
+    
+    def update(self, codes: Iterable[str]) -> List[str]:
+        """Добавляет коды, возвращает те из них, которых еще не было"""
+        return [code for code in codes if self.add(code)]
+    
+    def __contains__(self, code) -> bool:
+        return code_key(code) in self._codes
+    
+    def __len__(self) -> int:
+        return len(self._codes)
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._codes.values())
+    
+    def codes(self) -> List[str]:
+        return list(self._codes.values())
+
+def dedupe_codes(codes: Iterable[str]) -> List[str]:
+    """Убирает пустые коды и дубликаты, сохраняя порядок первого появления"""
+    return CodeIndex(codes).codes()
+
+def dedupe_records(*code_lists: Iterable[Dict]) -> List[Dict]:
+    """Объединяет списки записей {'code': ...} без дубликатов, сохраняя порядок первого появления"""
+    seen = CodeIndex()
+    return [code_data for code_list in code_lists for code_data in code_list
+            if seen.add(code_data.get('code', ''))]
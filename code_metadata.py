@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Метаданные промокодов: награды, срок действия и статус
+Парсеры сайтов заполняют ими записи кодов, а планировщик и фильтр новых кодов
+по ним отбрасывают истекшие коды и ставят самые ценные первыми
+"""
+
+import re
+from datetime import date, datetime
+from typing import Dict, Iterable, Optional
+
+STATUS_ACTIVE = 'active'
+STATUS_EXPIRED = 'expired'
+
+# Надписи вместо даты у бессрочных кодов
+NO_EXPIRY_MARKERS = ('never', 'no expir', 'permanent', 'unknown', 'tba', 'n/a')
+
+DATE_FORMATS = (
+    '%Y-%m-%d', '%d.%m.%Y', '%m/%d/%Y', '%d/%m/%Y',
+    '%B %d, %Y', '%b %d, %Y', '%B %d %Y', '%b %d %Y', '%d %B %Y', '%d %b %Y'
+)
+ORDINAL_SUFFIX = re.compile(r'(?<=\d)(st|nd|rd|th)\b', re.IGNORECASE)
+
+# "Diamonds x300", "300 Diamonds", "Gold: 100k"
+REWARD_SEPARATORS = re.compile(r'[,;\n+]|\band\b', re.IGNORECASE)
+REWARD_AMOUNT = r'(\d[\d.,]*(?:[kKmM](?![A-Za-z]))?)'
+REWARD_NAME = r"([A-Za-z][A-Za-z' ]*?[A-Za-z])"
+REWARD_NAME_FIRST = re.compile(rf'^{REWARD_NAME}\s*(?:[x×:]\s*)?{REWARD_AMOUNT}$')
+REWARD_AMOUNT_FIRST = re.compile(rf'^{REWARD_AMOUNT}\s*[x×]?\s*{REWARD_NAME}$')
+
+# Примерная ценность единицы награды в алмазах (для сортировки, не для точного учета)
+REWARD_WEIGHTS = (
+    ('stargazer', 500.0),
+    ('scroll', 270.0),  # Hero / Faction / Summon Scroll
+    ('diamond', 1.0),
+    ('dust', 0.5),
+    ('essence', 0.02),
+    ('gold', 0.0005),
+)
+
+def parse_expiry(text: str) -> Optional[str]:
+    """Дата окончания в ISO формате или None (бессрочный код или дата не распознана)"""
+    text = ORDINAL_SUFFIX.sub('', ' '.join((text or '').split())).strip()
+    if not text or any(marker in text.lower() for marker in NO_EXPIRY_MARKERS):
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+def is_expiry_text(text: str) -> bool:
+    """Текст ячейки похож на срок действия (дата, 'Never', 'Expired')"""
+    lowered = (text or '').lower()
+    return (parse_expiry(text) is not None or 'expir' in lowered
+            or any(marker in lowered for marker in NO_EXPIRY_MARKERS))
+
+def parse_rewards(text: str) -> Dict[str, str]:
+    """Награды из текста ячейки: {'Diamonds': '300', 'Gold': '100k'}"""
+    rewards = {}
+    for part in REWARD_SEPARATORS.split(text or ''):
+        part = ' '.join(part.split())
+        if not part:
+            continue
+        match = REWARD_NAME_FIRST.match(part)
+        if match:
+            rewards[match.group(1).strip()] = match.group(2)
+            continue
+        match = REWARD_AMOUNT_FIRST.match(part)
+        if match:
+            rewards[match.group(2).strip()] = match.group(1)
+            continue
+        rewards[part] = ''
+    return rewards
+
+def _amount(value: str) -> float:
+    """'100k' -> 100000, '1.5M' -> 1500000, '' -> 1"""
+    value = (value or '').replace(',', '').strip().lower()
+    if not value:
+        return 1.0
+    multiplier = 1.0
+    if value[-1] in 'km':
+        multiplier = 1_000.0 if value[-1] == 'k' else 1_000_000.0
+        value = value[:-1]
+    try:
+        return float(value) * multiplier
+    except ValueError:
+        return 1.0
+
+def reward_value(gifts: Optional[Dict[str, str]]) -> float:
+    """Примерная ценность наград кода в алмазах"""
+    total = 0.0
+    for name, amount in (gifts or {}).items():
+        name = name.lower()
+        for keyword, weight in REWARD_WEIGHTS:
+            if keyword in name:
+                total += weight * _amount(amount)
+                break
+    return round(total, 2)
+
+def is_expired(code_data: Dict, today: Optional[date] = None) -> bool:
+    """Код помечен сайтом как истекший или его дата окончания уже прошла"""
+    if code_data.get('status') == STATUS_EXPIRED:
+        return True
+    expires = code_data.get('expires')
+    if not expires:
+        return False
+    try:
+        return date.fromisoformat(expires) < (today or date.today())
+    except ValueError:
+        return False
+
+def describe_rewards(gifts: Optional[Dict[str, str]]) -> str:
+    """Короткая строка наград для сообщений: 'Diamonds x300, Gold x100k'"""
+    return ', '.join(f"{name} x{amount}" if amount else name for name, amount in (gifts or {}).items())
+
+def column_roles(header_names: Iterable[str]) -> Dict[int, str]:
+    """Назначение колонок таблицы по заголовкам: индекс -> rewards / expires / status"""
+    roles = {}
+    for index, name in enumerate(header_names):
+        name = name.lower()
+        if any(word in name for word in ('reward', 'gift', 'item', 'prize')):
+            roles[index] = 'rewards'
+        elif any(word in name for word in ('expir', 'valid', 'until', 'date')):
+            roles[index] = 'expires'
+        elif 'status' in name:
+            roles[index] = 'status'
+    return roles
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Проверка кандидатов в промокоды перед активацией
+Каждая попытка /api/consume стоит слот в окне Verification Code, поэтому коды,
+вытащенные регулярным выражением из текста страницы, оцениваются до активации:
+стоп-слова, форма кода (по кодам, которые сервер уже принимал) и подтверждение несколькими источниками
+"""
+
+import logging
+import re
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+
+from code_identity import CodeIndex, code_key
+
+logger = logging.getLogger(__name__)
+
+# Откуда взят код: из таблицы кодов (надежно) или из текста страницы (эвристика)
+EXTRACTED_TABLE = 'table'
+EXTRACTED_TEXT = 'text'
+
+# Один проход по тексту: 6-15 букв/цифр, не часть слова, CSS-класса или идентификатора
+CANDIDATE_PATTERN = re.compile(r'(?<![\w-])[A-Za-z0-9]{6,15}(?![\w-])')
+HEX_COLOR_PATTERN = re.compile(r'[0-9a-f]{6}|[0-9a-f]{8}', re.IGNORECASE)
+REPEATED_CHAR_PATTERN = re.compile(r'(.)\1{3,}')
+
+# Пороги уверенности (0..1): ниже DROP - не активируем вовсе
+CONFIDENCE_DROP = 0.45
+# Кандидат из текста с одного сайта набирает не больше 0.5 и этот порог не проходит:
+# нужен второй источник (AGREEMENT_BONUS) и форма, похожая на настоящие коды
+CONFIDENCE_DROP_TEXT = 0.75
+CONFIDENCE_TABLE = 0.9
+CONFIDENCE_TEXT = 0.3
+CONFIDENCE_UNVALIDATED = 0.0  # Запись не проходила validate_codes - в очереди активации последней
+AGREEMENT_BONUS = 0.3  # Код найден на нескольких сайтах
+SHAPE_WEIGHT = 0.2
+
+# Реальные коды (проверены при отладке парсеров) - опора для модели формы, пока нет истории активаций
+SEED_CODES = ('vdj82fht4r3000', 'ujqrukd2at1x', 'u4fctemje23x')
+
+# Сколько последних активированных кодов помнит модель формы
+SHAPE_HISTORY_LIMIT = 500
+
+# Коды, которые сервер принял (активированы или уже были активированы) - по ним учится форма
+_learned_codes: deque = deque(maxlen=SHAPE_HISTORY_LIMIT)
+_learned_keys: set = set()
+_learned_lock = threading.Lock()
+
+# Частые английские слова, слова сайтов и разметки, которые выглядят как "код"
+STOPWORDS = frozenset('''
+about above across action active additional afkarena after again against already always amount
+another answer anything around article author available banner before behind being below better
+between bottom button called cannot caption center change channel chapter check chests claim
+click column comment common complete content contents cookie cookies copied copyright correct
+couldn create currently default delete description details diamonds different display document
+download during easily either element emerald enable enter entire events expire expired expires
+facebook family feature featured follow footer format friend friends further gameplay general
+getting github global golden google guides happen header heading height helpful hidden
+however iframe images important include including inline instagram instead interest itself
+javascript justify latest launch layout learn leaving letter likely linear listed little loaded
+loading login longer mailbox margin market medium member members mention method middle mobile
+months mythic native navigation needed neither newest newsletter normal number numbers object
+official online option options others outside padding people player players please plugin popular
+position posted posts premium pretty previous privacy private profile provide public publish
+python rather reader reason recent recently redeem redeemed redemption refresh related release
+remove report required result results return review reward rewards scroll search season second
+section select server servers setting settings should shown simple single social someone something
+source special sponsored started status sticky stream string strong styles submit subscribe summon
+summons support switch system tables target thanks things though thread through ticket tickets
+together toggle tooltip tweets twitter update updated updates upgrade useful username value values
+version vertical videos viewport visible website weight whether window within without wordpress
+working worldwide wrapper writing youtube
+redemption codes arena guide table column afkguide lolvvv lilith cdkey verification
+'''.split())
+
+def is_plausible_code(token: str) -> bool:
+    """Отсев явного мусора: стоп-слова, цвета, числа, повторы символов"""
+    key = code_key(token)
+    if not 6 <= len(key) <= 15 or key in STOPWORDS:
+        return False
+    if key.isdigit() or REPEATED_CHAR_PATTERN.search(key):
+        return False
+    # #ffffff, 1a2b3c4d - цвета и хэши из CSS/скриптов
+    if HEX_COLOR_PATTERN.fullmatch(key) and any(c.isdigit() for c in key):
+        return False
+    return True
+
+def extract_candidates(text: str) -> List[str]:
+    """Кандидаты в коды из произвольного текста страницы (один проход, без дубликатов)"""
+    found = CodeIndex()
+    for match in CANDIDATE_PATTERN.finditer(text):
+        token = match.group(0)
+        if is_plausible_code(token):
+            found.add(token)
+    return found.codes()
+
+class CodeShapeModel:
+    """
+    Форма настоящих кодов: диапазон длины, доля кодов с цифрами и доля кодов
+    в нижнем регистре - по ним кандидат из текста сравнивается с реальными кодами
+    """
+    
+    def __init__(self, codes: Iterable[str] = SEED_CODES):
+        samples = [code.strip() for code in codes if code and code.strip()] or list(SEED_CODES)
+        lengths = [len(code) for code in samples]
+        self.min_length = min(lengths)
+        self.max_length = max(lengths)
+        self.digit_share = sum(any(c.isdigit() for c in code) for code in samples) / len(samples)
+        self.lower_share = sum(code == code.lower() for code in samples) / len(samples)
+    
+    def score(self, code: str) -> float:
+        """Похожесть кода на реальные (0..1)"""
+        has_digit = any(c.isdigit() for c in code)
+        score = 0.3 if self.min_length - 3 <= len(code) <= self.max_length + 3 else 0.0
+        score += 0.5 * (self.digit_share if has_digit else 1 - self.digit_share)
+        score += 0.2 * (self.lower_share if code == code.lower() else 1 - self.lower_share)
+        return score
+
+def learn_codes(codes: Iterable[str]):
+    """Добавляет в модель формы коды, которые сервер принял как настоящие"""
+    with _learned_lock:
+        for code in codes:
+            key = code_key(code)
+            if not key or key in _learned_keys:
+                continue
+            if len(_learned_codes) == _learned_codes.maxlen:
+                _learned_keys.discard(code_key(_learned_codes[0]))
+            _learned_codes.append(code.strip())
+            _learned_keys.add(key)
+
+def shape_model(extra_codes: Iterable[str] = ()) -> CodeShapeModel:
+    """Модель формы по опорным кодам, истории активаций (learn_codes) и extra_codes"""
+    with _learned_lock:
+        learned = list(_learned_codes)
+    return CodeShapeModel(list(SEED_CODES) + learned + list(extra_codes))
+
+def source_sites(sources: Iterable[str]) -> set:
+    """
+    Разные сайты среди источников: лента 'afk.guide/feed' и страница 'afk.guide' -
+    один сайт и друг друга не подтверждают
+    """
+    sites = set()
+    for name in sources:
+        site = name.split('/')[0].lower()
+        sites.add(site[4:] if site.startswith('www.') else site)
+    return sites
+
+def code_confidence(code_data: Dict, model: CodeShapeModel) -> float:
+    """Уверенность, что запись - настоящий код (0..1)"""
+    code = code_data.get('code', '')
+    if code_data.get('extracted', EXTRACTED_TABLE) == EXTRACTED_TABLE:
+        confidence = CONFIDENCE_TABLE
+    elif not is_plausible_code(code):
+        return 0.0
+    else:
+        confidence = CONFIDENCE_TEXT
+    
+    confidence += SHAPE_WEIGHT * model.score(code)
+    if len(source_sites(code_data.get('sources') or [])) >= 2:
+        confidence += AGREEMENT_BONUS
+    return round(min(confidence, 1.0), 3)
+
+def validate_codes(code_records: List[Dict], model: Optional[CodeShapeModel] = None) -> List[Dict]:
+    """
+    Проставляет записям 'confidence' и убирает маловероятные коды
+    Модель формы по умолчанию строится по истории активаций и табличным кодам этого же набора
+    """
+    if model is None:
+        model = shape_model(code_data['code'] for code_data in code_records
+                            if code_data.get('extracted', EXTRACTED_TABLE) == EXTRACTED_TABLE)
+    
+    accepted = []
+    dropped = []
+    for code_data in code_records:
+        code_data['confidence'] = code_confidence(code_data, model)
+        from_text = code_data.get('extracted', EXTRACTED_TABLE) == EXTRACTED_TEXT
+        if code_data['confidence'] >= (CONFIDENCE_DROP_TEXT if from_text else CONFIDENCE_DROP):
+            accepted.append(code_data)
+        else:
+            dropped.append(code_data['code'])
+    
+    if dropped:
+        logger.info(f"🧹 Отброшено {len(dropped)} маловероятных кодов: {', '.join(dropped[:10])}"
+                    f"{'...' if len(dropped) > 10 else ''}")
+    return accepted
@@ -4,49 +4,882 @@
 Основано на анализе реального трафика браузера из Burp логов
 """
 
+import asyncio
+import atexit
+import heapq
+import itertools
+import os
 import requests
+import urllib3
+import aiohttp
 import json
+import random
 import time
 import logging
-from typing import Dict, List, Optional, Tuple
+import threading
+from enum import Enum
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
 import hashlib
 import hmac
 import base64
 from urllib.parse import urlencode
+from email.utils import parsedate_to_datetime
+from datetime import datetime
+
+from code_identity import CodeIndex, code_key, dedupe_codes
+from code_metadata import is_expired, reward_value
+from code_validator import CONFIDENCE_UNVALIDATED
+
+LILITH_BASE_URL = "https://cdkey.lilith.com"
+
+def resolve_base_url(base_url: Optional[str] = None) -> str:
+    """
+    Адрес API: явный аргумент, затем переменная окружения LILITH_BASE_URL
+    (например, локальная заглушка mock_lilith_server.py), затем боевой сервер
+    """
+    return (base_url or os.getenv('LILITH_BASE_URL') or LILITH_BASE_URL).rstrip('/')
+
+# сlient-Id  
+CLIENT_ID = "cid_c3ee9eb5-1e2f-4bbb-811c-b8a3f48289881"
+
+# Точные заголовки 
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36',
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'ru-RU,ru;q=0.9',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Sec-Ch-Ua': '"Chromium";v="143", "Not A(Brand";v="24"',
+    'Sec-Ch-Ua-Mobile': '?0',
+    'Sec-Ch-Ua-Platform': '"Windows"',
+    'Sec-Fetch-Site': 'same-origin',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Dest': 'empty',
+    'Origin': 'https://cdkey.lilith.com',
+    'Referer': 'https://cdkey.lilith.com/afk-global',
+    'Priority': 'u=1, i'
+}
+
+# Настройки общего пула соединений для AsyncLilithAPI
+POOL_LIMIT = 100  # Максимум одновременных соединений на весь процесс
+KEEPALIVE_TIMEOUT = 30  # Сколько секунд держать простаивающее соединение
+CONNECT_TIMEOUT = 5  # Установка соединения: долго ждать мертвый хост бессмысленно
+READ_TIMEOUT = 20  # Ожидание ответа на уже отправленный запрос
+
+# Повторы запросов при сетевых сбоях, 5xx и ограничении частоты
+RETRY_MAX_ATTEMPTS = 3  # Попыток на один запрос, включая первую
+RETRY_BASE_DELAY = 0.5  # Пауза перед первым повтором (дальше удваивается)
+RETRY_MAX_DELAY = 8.0
+RETRY_BUDGET_PER_SESSION = 10  # Сколько повторов всего разрешено одной сессии
+
+# Сколько секунд считать полученный токен живым (при 401 удаляется раньше)
+TOKEN_CACHE_TTL = 600
+
+# Сколько секунд хранить список ролей аккаунта (меняется крайне редко)
+ROSTER_CACHE_TTL = 3600
+
+# Глобальная таблица мертвых кодов (общая для всех UID)
+DEAD_CODES_FILE = 'dead_codes.json'
+DEAD_CODE_MIN_CONFIRMATIONS = 2  # Сколько разных UID должны получить отказ, чтобы код считался мертвым
+DEAD_CODE_TTL = 3 * 24 * 3600  # Через сколько секунд после последнего отказа код снова считается живым
+DEAD_CODES_FLUSH_DELAY = 5.0  # Вердикты за это время пишутся в файл одной записью (в фоновом потоке)
+
+# Адаптивные паузы между запросами /api/consume (вместо фиксированных 5-8 секунд)
+PACING_INITIAL_DELAY = 2.0  # Стартовая пауза для нового UID
+PACING_MIN_DELAY = 1.0
+PACING_MAX_DELAY = 20.0
+PACING_BACKOFF_FACTOR = 2.0  # Во сколько раз увеличить паузу при err_freq_limit
+PACING_RECOVERY_STEP = 0.5  # На сколько секунд уменьшить паузу после успешного ответа
+PACING_SLOW_RESPONSE = 3.0  # Ответ дольше этого считается признаком перегрузки
+LATENCY_INITIAL_ESTIMATE = 1.0  # Оценка времени ответа /api/consume до первых замеров
+
+# Окно Verification Code (действует 2 минуты с момента генерации)
+VERIFICATION_CODE_LIFETIME = 120
+DEADLINE_SAFETY_MARGIN = 5  # Запас в секундах, чтобы не отправлять запрос на истекшем коде
+
+def _extract_message(data: Dict) -> str:
+    """Достает текст ошибки из ответа API"""
+    return data.get('message', data.get('info', 'Неизвестная ошибка'))
+
+def _parse_verify_response(status: int, data: Optional[Dict]) -> Optional[str]:
+    """
+    Разбор ответа /api/verify-afk-code
+    Возвращает токен или None (общая логика для LilithAPI и AsyncLilithAPI)
+    """
+    logging.debug(f"Статус ответа: {status}")
+    
+    if status >= 400:
+        logging.error(f"❌ Ошибка сети при верификации: HTTP {status}")
+        return None
+    
+    if data is None:
+        logging.error(f"❌ Ошибка парсинга JSON при верификации")
+        return None
+    
+    logging.debug(f"Ответ API: {data}")
+    
+    if data.get('success'):
+        token_data = data.get('data', {})
+        token = token_data.get('token')
+        if token:
+            logging.info(f"✅ Аккаунт верифицирован, токен получен")
+            return token
+        else:
+            logging.error(f"❌ Токен не найден в ответе")
+            return None
+    else:
+        message = _extract_message(data)
+        logging.error(f"❌ Ошибка верификации: {message}")
+        return None
+
+def _parse_accounts_response(status: int, data: Optional[Dict]) -> List[Dict]:
+    """
+    Разбор ответа /api/users
+    Возвращает список ролей (общая логика для LilithAPI и AsyncLilithAPI)
+    """
+    logging.debug(f"Статус ответа: {status}")
+    
+    if status >= 400:
+        logging.error(f"❌ Ошибка сети при получении аккаунтов: HTTP {status}")
+        return []
+    
+    if data is None:
+        logging.error(f"❌ Ошибка парсинга JSON при получении аккаунтов")
+        return []
+    
+    logging.debug(f"Ответ API: {data}")
+    
+    if data.get('success'):
+        # Из реальных логов: data.roles содержит массив ролей
+        roles_data = data.get('data', {})
+        roles = roles_data.get('roles', [])
+        
+        logging.info(f"✅ Получено {len(roles)} аккаунтов")
+        
+        # Логируем информацию об аккаунтах (формат из реальных логов)
+        for i, role in enumerate(roles, 1):
+            name = role.get('name', 'Unknown')
+            svr_id = role.get('svr_id', 'Unknown')
+            level = role.get('level', 'Unknown')
+            is_main = role.get('is_main', False)
+            main_text = " (Основной)" if is_main else ""
+            logging.info(f"  {i}. {name} - Уровень {level}, Сервер {svr_id}{main_text}")
+        
+        return roles
+    else:
+        message = _extract_message(data)
+        logging.error(f"❌ Ошибка получения аккаунтов: {message}")
+        return []
+
+class RedeemResult(Enum):
+    """Результат одной попытки /api/consume"""
+    SUCCESS = "success"
+    ALREADY_USED = "already_used"  # Код уже активирован на этом аккаунте
+    INVALID = "invalid"  # Код недействителен или сервер отказал с нераспознанным сообщением
+    NOT_FOUND = "not_found"  # Сервер явно ответил, что такого кода нет (record_not_found)
+    CODE_EXPIRED = "code_expired"  # Срок действия промокода закончился
+    AUTH_EXPIRED = "auth_expired"  # Истек Verification Code / токен
+    RATE_LIMITED = "rate_limited"  # err_freq_limit / HTTP 429
+    NETWORK_ERROR = "network_error"  # Сбой сети или непонятный ответ сервера
+    
+    def __bool__(self) -> bool:
+        # Совместимость со старым кодом, где redeem_code возвращал bool
+        return self is RedeemResult.SUCCESS
+    
+    @property
+    def is_transient(self) -> bool:
+        """Код не получил окончательного вердикта и его можно попробовать позже"""
+        return self in (RedeemResult.AUTH_EXPIRED, RedeemResult.RATE_LIMITED, RedeemResult.NETWORK_ERROR)
+
+# Ошибки 400, которые относятся к Verification Code / токену, а не к промокоду
+AUTH_ERROR_MARKERS = ('verification code', 'verify code', 'token', 'unauthorized')
+
+def _parse_consume_response(code: str, role_name: str, status: int, data: Optional[Dict]) -> RedeemResult:
+    """
+    Разбор ответа /api/consume
+    Возвращает типизированный результат (общая логика для LilithAPI и AsyncLilithAPI)
+    """
+    logging.debug(f"Статус ответа: {status}")
+    
+    # Обрабатываем разные статус коды
+    if status == 400:
+        # Код 400 может означать недействительный код или истекший verification code
+        if data is None:
+            logging.warning(f"⚠️ Код {code} недействителен (статус 400)")
+            return RedeemResult.INVALID
+        
+        message = str(_extract_message(data))
+        
+        # Проверяем специфичные ошибки
+        if 'freq_limit' in message.lower():
+            logging.warning(f"⏳ Код {code} не активирован: превышен лимит запросов")
+            return RedeemResult.RATE_LIMITED
+        elif any(marker in message.lower() for marker in AUTH_ERROR_MARKERS):
+            logging.error(f"❌ Истек Verification Code! Нужно получить новый код в игре")
+            return RedeemResult.AUTH_EXPIRED
+        elif 'expired' in message.lower():
+            # Истек сам промокод ("cdkey expired"), а не авторизация
+            logging.warning(f"⚠️ Код {code} истек")
+            return RedeemResult.CODE_EXPIRED
+        elif 'not_found' in message or 'record_not_found' in message:
+            logging.warning(f"⚠️ Код {code} не найден или недействителен")
+            return RedeemResult.NOT_FOUND
+        elif 'already' in message.lower():
+            logging.warning(f"⚠️ Код {code} уже был использован")
+            return RedeemResult.ALREADY_USED
+        elif 'invalid' in message.lower():
+            logging.warning(f"⚠️ Код {code} недействителен")
+            return RedeemResult.INVALID
+        else:
+            logging.warning(f"⚠️ Ошибка активации кода {code}: {message}")
+            return RedeemResult.INVALID
+    
+    elif status == 401:
+        logging.error(f"❌ Ошибка авторизации! Verification Code истек или неверен")
+        return RedeemResult.AUTH_EXPIRED
+    
+    elif status == 429:
+        logging.warning(f"⏳ Код {code} не активирован: превышен лимит запросов (HTTP 429)")
+        return RedeemResult.RATE_LIMITED
+    
+    elif status >= 400:
+        logging.error(f"❌ Ошибка сети при активации кода {code}: HTTP {status}")
+        return RedeemResult.NETWORK_ERROR
+    
+    if data is None:
+        logging.error(f"❌ Ошибка парсинга JSON при активации кода {code}")
+        return RedeemResult.NETWORK_ERROR
+    
+    logging.debug(f"Ответ API: {data}")
+    
+    if data.get('success'):
+        logging.info(f"✅ Код {code} успешно активирован для {role_name}")
+        return RedeemResult.SUCCESS
+    
+    message = str(_extract_message(data))
+    
+    # Проверяем типичные ошибки
+    if 'freq_limit' in message.lower():
+        logging.warning(f"⏳ Код {code} не активирован: превышен лимит запросов")
+        return RedeemResult.RATE_LIMITED
+    elif any(marker in message.lower() for marker in AUTH_ERROR_MARKERS):
+        # Сначала авторизация: "verification code expired" - не истекший промокод
+        logging.error(f"❌ Истек Verification Code! Нужно получить новый код в игре")
+        return RedeemResult.AUTH_EXPIRED
+    elif 'already' in message.lower() or 'уже' in message.lower():
+        logging.warning(f"⚠️ Код {code} уже был активирован для {role_name}")
+        return RedeemResult.ALREADY_USED
+    elif 'invalid' in message.lower() or 'недействительн' in message.lower():
+        logging.warning(f"⚠️ Код {code} недействителен или истек")
+        return RedeemResult.INVALID
+    elif 'expired' in message.lower() or 'истек' in message.lower():
+        logging.warning(f"⚠️ Код {code} истек")
+        return RedeemResult.CODE_EXPIRED
+    elif 'not_found' in message.lower() or 'record_not_found' in message.lower():
+        logging.warning(f"⚠️ Код {code} не найден")
+        return RedeemResult.NOT_FOUND
+    else:
+        logging.warning(f"⚠️ Не удалось активировать код {code} для {role_name}: {message}")
+        return RedeemResult.INVALID
+
+def _code_verdict(results: List[RedeemResult]) -> RedeemResult:
+    """Итог по коду из результатов для всех целей активации"""
+    for verdict in (RedeemResult.SUCCESS, RedeemResult.AUTH_EXPIRED, RedeemResult.ALREADY_USED,
+                    RedeemResult.RATE_LIMITED, RedeemResult.NETWORK_ERROR, RedeemResult.CODE_EXPIRED,
+                    RedeemResult.NOT_FOUND):
+        if verdict in results:
+            return verdict
+    return RedeemResult.INVALID
+
+def _empty_batch_stats(total_processed: int = 0) -> Dict:
+    """Пустая статистика батча"""
+    return {
+        "success": 0, 
+        "failed": 0, 
+        "successful_codes": [], 
+        "failed_codes": [],
+        "already_used_codes": [],  # Уже активированы ранее - повторять не нужно
+        "remaining_codes": [],  # Без окончательного вердикта - можно повторить в следующей сессии
+        "not_attempted_codes": [],  # Не влезли в батч или в окно Verification Code
+        "skipped_dead_codes": [],  # Пропущены по таблице мертвых кодов без запроса - не сохраняются как неуспешные
+        "code_results": {},  # Код → RedeemResult
+        "aborted": False,  # Батч остановлен из-за истекшего Verification Code
+        "total_processed": total_processed
+    }
+
+def _record_code_verdict(stats: Dict, code: str, verdict: RedeemResult, uid: str):
+    """Раскладывает итог по коду в статистику батча и глобальную таблицу мертвых кодов"""
+    stats["code_results"][code] = verdict
+    dead_codes.record(code, verdict, uid)
+    
+    if verdict is RedeemResult.SUCCESS:
+        stats["successful_codes"].append(code)
+    elif verdict is RedeemResult.ALREADY_USED:
+        stats["already_used_codes"].append(code)
+    elif verdict.is_transient:
+        stats["remaining_codes"].append(code)
+        logging.info(f"🔁 Код {code} отложен до следующей сессии ({verdict.value})")
+    else:
+        stats["failed_codes"].append(code)
+        logging.warning(f"❌ Код {code} не удалось активировать ни для одного аккаунта")
+
+def _abort_batch(stats: Dict, untouched_codes: List[str]):
+    """Останавливает батч: необработанные коды возвращаются без пометки неуспешными"""
+    stats["aborted"] = True
+    stats["remaining_codes"].extend(untouched_codes)
+    logging.error(f"⛔ Verification Code истек, батч остановлен. Не обработано кодов: {len(untouched_codes)}")
+
+def _is_rate_limited(status: int, data: Optional[Dict]) -> bool:
+    """Проверяет, ответил ли сервер ограничением частоты (HTTP 429 / err_freq_limit)"""
+    if status == 429:
+        return True
+    if data:
+        message = str(_extract_message(data)).lower()
+        return 'freq_limit' in message or 'too many' in message
+    return False
+
+def _is_retryable(status: int, data: Optional[Dict]) -> bool:
+    """Ответ, после которого запрос имеет смысл повторить (сервер его не обработал)"""
+    return status >= 500 or _is_rate_limited(status, data)
+
+def _request_not_sent(error: Exception) -> bool:
+    """
+    Сбой до отправки запроса (соединение не установлено) - только такой сбой можно
+    повторять для неидемпотентных запросов: после таймаута ответа сервер мог запрос уже выполнить
+    """
+    if isinstance(error, (requests.exceptions.ConnectTimeout, aiohttp.ClientConnectorError)):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), urllib3.exceptions.NewConnectionError)
+    return False
+
+def _retry_after_seconds(headers) -> Optional[float]:
+    """Разбирает заголовок Retry-After (секунды или HTTP-дата)"""
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class RetryPolicy:
+    """
+    Политика повторов запросов к API Lilith
+    Экспоненциальная пауза с полным jitter, уважение Retry-After и общий бюджет
+    повторов на сессию: повтор не назначается, если он не успеет до истечения Verification Code
+    """
+    
+    def __init__(self, budget: int = RETRY_BUDGET_PER_SESSION, deadline: Optional[float] = None):
+        self.budget = budget
+        self.deadline = deadline
+    
+    def next_delay(self, attempt: int, retry_after: Optional[float] = None) -> Optional[float]:
+        """Пауза перед повтором после попытки attempt или None, если повторять нельзя"""
+        if attempt >= RETRY_MAX_ATTEMPTS or self.budget <= 0:
+            return None
+        
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        
+        if self.deadline is not None and time.time() + delay + DEADLINE_SAFETY_MARGIN > self.deadline:
+            return None
+        
+        self.budget -= 1
+        return delay
+
+class AdaptivePacer:
+    """
+    Адаптивный регулятор пауз между запросами /api/consume (AIMD)
+    - начинает с короткой паузы
+    - при err_freq_limit / HTTP 429 / медленном ответе увеличивает паузу в разы
+    - после каждого нормального ответа уменьшает паузу на фиксированный шаг
+    """
+    
+    def __init__(self, delay: float = PACING_INITIAL_DELAY):
+        self.delay = delay
+        self.latency = LATENCY_INITIAL_ESTIMATE  # Скользящее среднее времени ответа
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+    
+    def consume_cost(self) -> float:
+        """Оценка времени на один запрос /api/consume с учетом паузы и задержки сервера"""
+        return max(self.delay, self.latency)
+    
+    def _reserve_slot(self) -> float:
+        """Резервирует время следующего запроса, возвращает сколько нужно подождать"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.delay
+            return slot - now
+    
+    def wait(self):
+        """Синхронное ожидание своей очереди (для LilithAPI)"""
+        pause = self._reserve_slot()
+        if pause > 0:
+            time.sleep(pause)
+    
+    async def wait_async(self):
+        """Асинхронное ожидание своей очереди (для AsyncLilithAPI)"""
+        pause = self._reserve_slot()
+        if pause > 0:
+            await asyncio.sleep(pause)
+    
+    def record_response(self, status: int, data: Optional[Dict], latency: float):
+        """Подстраивает паузу по результату очередного запроса"""
+        with self._lock:
+            self.latency = 0.7 * self.latency + 0.3 * latency
+            
+            if _is_rate_limited(status, data):
+                self.delay = min(PACING_MAX_DELAY, self.delay * PACING_BACKOFF_FACTOR)
+                # Следующий запрос не раньше чем через новую паузу
+                self._next_slot = max(self._next_slot, time.monotonic() + self.delay)
+                logging.warning(f"⏳ Лимит запросов, пауза увеличена до {self.delay:.1f}с")
+            elif latency > PACING_SLOW_RESPONSE:
+                self.delay = min(PACING_MAX_DELAY, self.delay * PACING_BACKOFF_FACTOR)
+                logging.info(f"🐢 Медленный ответ ({latency:.1f}с), пауза увеличена до {self.delay:.1f}с")
+            else:
+                self.delay = max(PACING_MIN_DELAY, self.delay - PACING_RECOVERY_STEP)
+
+# Выученные паузы по UID (общие для всех сессий в процессе)
+_pacers: Dict[str, AdaptivePacer] = {}
+_pacers_lock = threading.Lock()
+
+def get_pacer(uid: str) -> AdaptivePacer:
+    """Возвращает регулятор пауз для UID, сохраняя выученную скорость между сессиями"""
+    with _pacers_lock:
+        if uid not in _pacers:
+            _pacers[uid] = AdaptivePacer()
+        return _pacers[uid]
+
+def _key_uid(key: Any) -> str:
+    """UID из ключа кэша (ключ - UID или кортеж, начинающийся с UID)"""
+    return key[0] if isinstance(key, tuple) else key
+
+def token_cache_key(uid: str, verification_code: str) -> Tuple[str, str]:
+    """
+    Ключ token_cache: UID и хэш Verification Code, которым получен токен
+    Токен отдается только тому, кто прошел верификацию этим же кодом -
+    чужой UID с произвольным кодом не получает токен владельца
+    """
+    return uid, hashlib.sha256((verification_code or '').strip().encode('utf-8')).hexdigest()
+
+class TTLCache:
+    """
+    Кэш значений по ключу (UID или кортеж с UID первым элементом) с TTL, общий для всего процесса
+    Параллельные запросы одного ключа объединяются в один (single-flight),
+    пустые результаты (ошибки) не кэшируются
+    """
+    
+    def __init__(self, ttl: float, name: str):
+        self.ttl = ttl
+        self.name = name
+        self._values: Dict[Any, Tuple[Any, float]] = {}
+        self._lock = threading.Lock()
+        # Ключ -> (lock, сколько потоков его держат или ждут); запись удаляется вместе с последним
+        self._uid_locks: Dict[Any, Tuple[threading.Lock, int]] = {}
+        self._inflight: Dict[Any, asyncio.Task] = {}
+    
+    def get(self, uid: Any) -> Any:
+        """Живое значение для ключа или None"""
+        with self._lock:
+            entry = self._values.get(uid)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._values[uid]
+                return None
+            return value
+    
+    def put(self, uid: Any, value: Any):
+        """Сохраняет значение для ключа"""
+        with self._lock:
+            self._values[uid] = (value, time.monotonic() + self.ttl)
+    
+    def invalidate(self, uid: Any, value: Any = None):
+        """Удаляет значение ключа (если передан value - только если оно еще актуально)"""
+        with self._lock:
+            entry = self._values.get(uid)
+            if entry is not None and (value is None or entry[0] == value):
+                del self._values[uid]
+                logging.info(f"🗑️ {self.name} для UID {_key_uid(uid)} удален из кэша")
+    
+    def invalidate_uid(self, uid: str):
+        """Удаляет все значения UID, под какими бы ключами они ни лежали"""
+        with self._lock:
+            keys = [key for key in self._values if _key_uid(key) == uid]
+            for key in keys:
+                del self._values[key]
+        if keys:
+            logging.info(f"🗑️ {self.name} для UID {uid} удален из кэша")
+    
+    async def get_or_fetch(self, uid: Any, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Возвращает значение из кэша или выполняет fetch() один раз для всех ожидающих"""
+        value = self.get(uid)
+        if value:
+            return value
+        
+        task = self._inflight.get(uid)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_and_store(uid, fetch))
+            self._inflight[uid] = task
+            task.add_done_callback(lambda done: self._inflight.pop(uid) if self._inflight.get(uid) is done else None)
+        else:
+            logging.info(f"⏳ {self.name}: ожидаем уже идущий запрос для UID {_key_uid(uid)}")
+        
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+    
+    async def _fetch_and_store(self, uid: Any, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        value = await fetch()
+        if value:
+            self.put(uid, value)
+        return value
+    
+    def get_or_fetch_sync(self, uid: Any, fetch: Callable[[], Any]) -> Any:
+        """Синхронный вариант get_or_fetch для LilithAPI (потоки одного UID ждут друг друга)"""
+        with self._lock:
+            uid_lock, users = self._uid_locks.get(uid, (None, 0))
+            uid_lock = uid_lock or threading.Lock()
+            self._uid_locks[uid] = (uid_lock, users + 1)
+        
+        try:
+            with uid_lock:
+                value = self.get(uid)
+                if value:
+                    return value
+                value = fetch()
+                if value:
+                    self.put(uid, value)
+                return value
+        finally:
+            with self._lock:
+                uid_lock, users = self._uid_locks[uid]
+                if users > 1:
+                    self._uid_locks[uid] = (uid_lock, users - 1)
+                else:
+                    del self._uid_locks[uid]
+
+# Общие кэши для всех клиентов в процессе:
+# bearer-токены (удаляются при первом 401) и списки ролей аккаунта
+token_cache = TTLCache(TOKEN_CACHE_TTL, "Токен")
+roster_cache = TTLCache(ROSTER_CACHE_TTL, "Список аккаунтов")
+
+class DeadCodeRegistry:
+    """
+    Глобальная таблица "мертвых" кодов, общая для всех пользователей
+    Код, про который /api/consume явно ответил "не найден" или "истек", мертв для любого игрока:
+    записываем время и UID, получившие отказ. Мертвым код считается после отказа
+    min_confirmations разных UID и только ttl секунд после последнего отказа -
+    ошибка одного аккаунта или временный сбой сервера не закрывает код для всех навсегда.
+    Вердикты копятся в памяти и пишутся в файл фоновым потоком раз в flush_delay секунд
+    """
+    
+    DEAD_RESULTS = (RedeemResult.NOT_FOUND, RedeemResult.CODE_EXPIRED)
+    
+    def __init__(self, path: str = DEAD_CODES_FILE, min_confirmations: int = DEAD_CODE_MIN_CONFIRMATIONS,
+                 ttl: float = DEAD_CODE_TTL, flush_delay: float = DEAD_CODES_FLUSH_DELAY):
+        self.path = path
+        self.min_confirmations = min_confirmations
+        self.ttl = ttl
+        self.flush_delay = flush_delay
+        self._entries: Optional[Dict[str, Dict]] = None
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flush_timer: Optional[threading.Timer] = None
+        atexit.register(self.flush)
+    
+    def _is_stale(self, entry: Dict) -> bool:
+        """Последний отказ старше ttl (или запись из старого формата без явного вердикта)"""
+        if entry.get("status") not in [result.value for result in self.DEAD_RESULTS]:
+            return True
+        try:
+            last_seen = datetime.fromisoformat(entry.get("last_seen") or entry["first_seen"])
+        except (KeyError, TypeError, ValueError):
+            return True
+        return (datetime.now() - last_seen).total_seconds() > self.ttl
+    
+    def _load(self) -> Dict[str, Dict]:
+        """Загружает таблицу из файла (один раз за процесс), устаревшие записи отбрасываются"""
+        if self._entries is None:
+            self._entries = {}
+            try:
+                if os.path.exists(self.path):
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self._entries = json.load(f)
+            except Exception as e:
+                logging.error(f"Ошибка загрузки мертвых кодов: {e}")
+            
+            stale = [key for key, entry in self._entries.items() if self._is_stale(entry)]
+            for key in stale:
+                del self._entries[key]
+            if stale:
+                logging.info(f"🧹 Из мертвых кодов убрано устаревших записей: {len(stale)}")
+                self._schedule_flush()
+        return self._entries
+    
+    def load(self):
+        """Заранее читает файл, чтобы первое обращение из event loop не ждало диска"""
+        with self._lock:
+            self._load()
+    
+    def _schedule_flush(self):
+        """Помечает таблицу измененной и ставит запись в файл (вызывать под self._lock)"""
+        self._dirty = True
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+    
+    def flush(self):
+        """Записывает накопленные изменения в файл (атомарно: временный файл + os.replace)"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if not self._dirty:
+                return
+            snapshot = json.dumps(self._entries, ensure_ascii=False)
+            self._dirty = False
+        
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(snapshot)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"Ошибка сохранения мертвых кодов: {e}")
+    
+    def record(self, code: str, result: RedeemResult, uid: str):
+        """Учитывает итог активации кода: мертвый код подтверждается, успешный - реабилитируется"""
+        key = code_key(code)
+        
+        with self._lock:
+            entries = self._load()
+            
+            if result is RedeemResult.SUCCESS:
+                # Код сработал хотя бы у одного игрока - значит он жив
+                if entries.pop(key, None) is not None:
+                    logging.info(f"♻️ Код {code} снова активен, убран из мертвых")
+                    self._schedule_flush()
+                return
+            
+            if result not in self.DEAD_RESULTS:
+                return
+            
+            now = datetime.now().isoformat()
+            entry = entries.setdefault(key, {
+                "code": code,
+                "status": result.value,
+                "first_seen": now,
+                "confirmations": 0,
+                "uids": []
+            })
+            entry["status"] = result.value
+            entry["last_seen"] = now
+            if uid not in entry["uids"]:
+                entry["uids"].append(uid)
+                entry["confirmations"] = len(entry["uids"])
+            self._schedule_flush()
+    
+    def is_dead(self, code: str) -> bool:
+        """Код признан мертвым для всех пользователей"""
+        with self._lock:
+            entries = self._load()
+            key = code_key(code)
+            entry = entries.get(key)
+            if entry is None:
+                return False
+            if self._is_stale(entry):
+                del entries[key]
+                self._schedule_flush()
+                return False
+            return entry["confirmations"] >= self.min_confirmations
+    
+    def split_alive(self, codes: List[str]) -> Tuple[List[str], List[str]]:
+        """Делит коды на (живые, мертвые) с сохранением порядка"""
+        alive, dead = [], []
+        for code in codes:
+            (dead if self.is_dead(code) else alive).append(code)
+        return alive, dead
+
+# Общая таблица мертвых кодов для всех пользователей
+dead_codes = DeadCodeRegistry()
+
+def session_deadline(setup_time: Optional[datetime]) -> Optional[float]:
+    """
+    Момент истечения Verification Code (time.time()) по времени его ввода
+    Если окно уже закончилось, возвращает None: токен мог сохраниться в кэше,
+    а его срок нам неизвестен - тогда полагаемся на остановку по AUTH_EXPIRED
+    """
+    if setup_time is None:
+        return None
+    deadline = setup_time.timestamp() + VERIFICATION_CODE_LIFETIME
+    return deadline if deadline > time.time() else None
+
+def _code_priority(code_data: Dict) -> Tuple:
+    """
+    Ключ сортировки кодов: живые, отложенные с прошлых сессий, наиболее вероятные
+    настоящие (confidence из code_validator), самые ценные награды (code_metadata),
+    подтвержденные несколькими источниками
+    """
+    sources = code_data.get('sources') or [code_data.get('source')]
+    return (
+        dead_codes.is_dead(code_data.get('code', '')),
+        not code_data.get('carried_over', False),
+        -code_data.get('confidence', CONFIDENCE_UNVALIDATED),
+        -reward_value(code_data.get('gifts')),
+        -len(sources)
+    )
+
+def order_codes_by_value(code_records: List[Dict]) -> List[Dict]:
+    """Упорядочивает коды по ожидаемой ценности (стабильно - при равенстве сохраняется порядок сайтов)"""
+    return sorted(code_records, key=_code_priority)
+
+def plan_redemption(code_records: List[Dict], pacer: AdaptivePacer, deadline: Optional[float] = None,
+                    targets_count: int = 1, max_codes: Optional[int] = None) -> Tuple[List[str], List[str]]:
+    """
+    Планирует сессию активации под окно Verification Code
+    Возвращает (коды для активации по убыванию ценности, коды которые не влезли)
+    Истекшие коды не планируются вовсе - на них не тратятся слоты /api/consume
+    """
+    active = [code_data for code_data in code_records if not is_expired(code_data)]
+    if len(active) < len(code_records):
+        logging.info(f"⌛ Пропущено {len(code_records) - len(active)} истекших кодов")
+    ordered = [code_data['code'] for code_data in order_codes_by_value(active)]
+    
+    capacity = len(ordered) if max_codes is None else max_codes
+    if deadline is not None:
+        per_code = pacer.consume_cost() * max(1, targets_count)
+        time_left = deadline - time.time() - DEADLINE_SAFETY_MARGIN
+        capacity = min(capacity, max(0, int(time_left // per_code)))
+        logging.info(f"⏱ До истечения кода {max(0, time_left):.0f}с, ~{per_code:.1f}с на код → успеем {capacity} кодов")
+    
+    return ordered[:capacity], ordered[capacity:]
+
+def _deadline_reached(deadline: Optional[float], pacer: AdaptivePacer, targets_count: int) -> bool:
+    """Следующий код уже не успеет активироваться до истечения Verification Code"""
+    if deadline is None:
+        return False
+    return time.time() + pacer.consume_cost() * targets_count + DEADLINE_SAFETY_MARGIN > deadline
+
+def _target_role_id(uid: str, account_data: Dict) -> str:
+    """
+    Фактическая цель активации (roleId в /api/consume)
+    В логах используется UID как roleId для любой роли аккаунта
+    """
+    return uid
+
+def group_accounts_by_target(uid: str, accounts: List[Dict]) -> List[Tuple[Dict, List[Dict]]]:
+    """
+    Группирует роли по фактической цели активации
+    Возвращает [(аккаунт для запроса, все роли этой цели)] - по одному consume на группу
+    """
+    groups: Dict[str, List[Dict]] = {}
+    for account in accounts:
+        groups.setdefault(_target_role_id(uid, account), []).append(account)
+    
+    targets = []
+    for group in groups.values():
+        names = ', '.join(account.get('name', 'Unknown') for account in group)
+        targets.append((dict(group[0], name=names), group))
+    
+    if len(targets) < len(accounts):
+        logging.info(f"🔗 {len(accounts)} аккаунтов → {len(targets)} целей активации (один запрос на цель)")
+    return targets
+
+def _consume_payload(role_id: str, code: str) -> Dict:
+    """Точный формат payload /api/consume из Burp логов"""
+    return {
+        "appId": "6241329",  # Из реальных логов
+        "roleId": role_id,
+        "game": "afk",
+        "cdkey": code,
+        "pupBody": "lilith"  # Из реальных логов
+    }
 
 class LilithAPI:
-    def __init__(self, uid: str, verification_code: str):
+    def __init__(self, uid: str, verification_code: str, base_url: Optional[str] = None):
         self.uid = uid
         self.verification_code = verification_code
+        self.base_url = resolve_base_url(base_url)
         self.session = requests.Session()
         self.token = None
-        # сlient-Id  
-        self.client_id = "cid_c3ee9eb5-1e2f-4bbb-811c-b8a3f48289881"
-        
-        # Точные заголовки 
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36',
-            'Accept': 'application/json, text/plain, */*',
-            'Accept-Language': 'ru-RU,ru;q=0.9',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Sec-Ch-Ua': '"Chromium";v="143", "Not A(Brand";v="24"',
-            'Sec-Ch-Ua-Mobile': '?0',
-            'Sec-Ch-Ua-Platform': '"Windows"',
-            'Sec-Fetch-Site': 'same-origin',
-            'Sec-Fetch-Mode': 'cors',
-            'Sec-Fetch-Dest': 'empty',
-            'Origin': 'https://cdkey.lilith.com',
-            'Referer': 'https://cdkey.lilith.com/afk-global',
-            'Priority': 'u=1, i'
-        })
+        self._token_key = token_cache_key(uid, verification_code)
+        self._token_from_cache = False
+        self.client_id = CLIENT_ID
+        self.pacer = get_pacer(uid)
+        self.retry = RetryPolicy()
+        self.session.headers.update(DEFAULT_HEADERS)
     
-    def verify_account(self) -> bool:
+    def _auth_headers(self) -> Dict[str, str]:
+        """Заголовки для запросов с токеном"""
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.token}',
+            'X-Client-Id': self.client_id
+        }
+    
+    def _post(self, path: str, payload: Dict, headers: Dict[str, str],
+              paced: bool = False, idempotent: bool = True) -> Tuple[int, Optional[Dict]]:
         """
-        Верификация аккаунта и получение токена
-        Эндпоинт: POST /api/verify-afk-code
+        POST запрос к API Lilith, возвращает (статус, JSON или None)
+        Сетевые сбои, 5xx и err_freq_limit повторяются по self.retry;
+        paced=True - каждый ответ учитывается регулятором пауз;
+        idempotent=False - повторяются только неустановленные соединения и err_freq_limit
+        (одноразовый Verification Code нельзя отправить второй раз)
         """
-        url = "https://cdkey.lilith.com/api/verify-afk-code"
-        
+        attempt = 0
+        while True:
+            attempt += 1
+            started = time.monotonic()
+            try:
+                response = self.session.post(f"{self.base_url}{path}", json=payload, headers=headers,
+                                             timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                delay = self.retry.next_delay(attempt) if idempotent or _request_not_sent(e) else None
+                if delay is None:
+                    raise
+                logging.warning(f"🔁 Сбой сети на {path} ({e}), повтор через {delay:.1f}с")
+                time.sleep(delay)
+                continue
+            
+            logging.debug(f"Заголовки ответа: {dict(response.headers)}")
+            
+            try:
+                data = response.json()
+            except ValueError:
+                data = None
+            
+            status = response.status_code
+            if paced:
+                self.pacer.record_response(status, data, time.monotonic() - started)
+            
+            # Токен отклонен - убираем его из общего кэша
+            if status == 401 and 'Authorization' in headers:
+                token_cache.invalidate(self._token_key, self.token)
+            
+            retryable = _is_retryable(status, data) if idempotent else _is_rate_limited(status, data)
+            if retryable:
+                retry_after = _retry_after_seconds(response.headers)
+                if _is_rate_limited(status, data):
+                    retry_after = max(retry_after or 0.0, self.pacer.delay)
+                delay = self.retry.next_delay(attempt, retry_after)
+                if delay is not None:
+                    logging.warning(f"🔁 HTTP {status} на {path}, повтор через {delay:.1f}с")
+                    time.sleep(delay)
+                    continue
+            
+            return status, data
+    
+    def _request_token(self) -> Optional[str]:
+        """Запрос нового токена по Verification Code"""
         # Точный формат payload  
         payload = {
             "uid": self.uid,
@@ -61,209 +894,126 @@ class LilithAPI:
         
         try:
             logging.info(f"🔐 Верифицируем аккаунт UID: {self.uid}")
-            response = self.session.post(url, json=payload, headers=headers, timeout=30)
-            
-            logging.debug(f"Статус ответа: {response.status_code}")
-            logging.debug(f"Заголовки ответа: {dict(response.headers)}")
-            
-            response.raise_for_status()
-            
-            data = response.json()
-            logging.debug(f"Ответ API: {data}")
-            
-            if data.get('success'):
-                token_data = data.get('data', {})
-                self.token = token_data.get('token')
-                if self.token:
-                    logging.info(f"✅ Аккаунт верифицирован, токен получен")
-                    return True
-                else:
-                    logging.error(f"❌ Токен не найден в ответе")
-                    return False
-            else:
-                message = data.get('message', data.get('info', 'Неизвестная ошибка'))
-                logging.error(f"❌ Ошибка верификации: {message}")
-                return False
+            status, data = self._post("/api/verify-afk-code", payload, headers, idempotent=False)
+            return _parse_verify_response(status, data)
                 
         except requests.exceptions.RequestException as e:
             logging.error(f"❌ Ошибка сети при верификации: {e}")
-            return False
-        except json.JSONDecodeError as e:
-            logging.error(f"❌ Ошибка парсинга JSON: {e}")
-            return False
+            return None
         except Exception as e:
             logging.error(f"❌ Неожиданная ошибка при верификации: {e}")
+            return None
+    
+    def verify_account(self) -> bool:
+        """
+        Верификация аккаунта и получение токена
+        Эндпоинт: POST /api/verify-afk-code
+        Живой токен, полученный этим же кодом, переиспользуется из token_cache без запроса
+        """
+        cached = token_cache.get(self._token_key)
+        if cached:
+            logging.info(f"♻️ Используем сохраненный токен для UID: {self.uid}")
+            self.token = cached
+            self._token_from_cache = True
+            return True
+        
+        self.token = token_cache.get_or_fetch_sync(self._token_key, self._request_token)
+        self._token_from_cache = False
+        return bool(self.token)
+    
+    def _refresh_stale_token(self) -> bool:
+        """Один раз перевыпускает токен, если сохраненный токен оказался мертвым"""
+        if not self._token_from_cache:
             return False
+        
+        logging.info(f"🔄 Сохраненный токен отклонен, верифицируемся заново")
+        self._token_from_cache = False
+        self.token = token_cache.get_or_fetch_sync(self._token_key, self._request_token)
+        return bool(self.token)
     
-    def get_user_accounts(self) -> List[Dict]:
+    def get_user_accounts(self, force_refresh: bool = False) -> List[Dict]:
         """
         Получение списка аккаунтов пользователя
         Эндпоинт: POST /api/users (из реальных Burp логов)
+        Список кэшируется в roster_cache на ROSTER_CACHE_TTL секунд,
+        force_refresh=True принудительно запрашивает его заново
         """
         if not self.token:
             logging.error("❌ Токен не найден, сначала выполните верификацию")
             return []
-            
-        url = "https://cdkey.lilith.com/api/users"
         
+        if force_refresh:
+            roster_cache.invalidate(self.uid)
+        else:
+            cached = roster_cache.get(self.uid)
+            if cached:
+                logging.info(f"♻️ Список аккаунтов из кэша: {len(cached)} аккаунтов")
+                return list(cached)
+        
+        return list(roster_cache.get_or_fetch_sync(self.uid, self._fetch_user_accounts))
+    
+    def _fetch_user_accounts(self) -> List[Dict]:
+        """Запрос списка аккаунтов у API (без кэша)"""
         # Точный формат payload 
         payload = {
             "uid": self.uid,
             "game": "afk"
         }
         
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.token}',
-            'X-Client-Id': self.client_id
-        }
-        
         try:
             logging.info(f"📋 Получаем список аккаунтов для UID: {self.uid}")
-            response = self.session.post(url, json=payload, headers=headers, timeout=30)
-            
-            logging.debug(f"Статус ответа: {response.status_code}")
+            status, data = self._post("/api/users", payload, self._auth_headers())
+            if status == 401 and self._refresh_stale_token():
+                status, data = self._post("/api/users", payload, self._auth_headers())
             
-            response.raise_for_status()
-            
-            data = response.json()
-            logging.debug(f"Ответ API: {data}")
-            
-            if data.get('success'):
-                # Из реальных логов: data.roles содержит массив ролей
-                roles_data = data.get('data', {})
-                roles = roles_data.get('roles', [])
-                
-                logging.info(f"✅ Получено {len(roles)} аккаунтов")
-                
-                # Логируем информацию об аккаунтах (формат из реальных логов)
-                for i, role in enumerate(roles, 1):
-                    name = role.get('name', 'Unknown')
-                    svr_id = role.get('svr_id', 'Unknown')
-                    level = role.get('level', 'Unknown')
-                    uid = role.get('uid', 'Unknown')
-                    is_main = role.get('is_main', False)
-                    main_text = " (Основной)" if is_main else ""
-                    logging.info(f"  {i}. {name} - Уровень {level}, Сервер {svr_id}{main_text}")
-                
-                return roles
-            else:
-                message = data.get('message', data.get('info', 'Неизвестная ошибка'))
-                logging.error(f"❌ Ошибка получения аккаунтов: {message}")
-                return []
+            return _parse_accounts_response(status, data)
                 
         except requests.exceptions.RequestException as e:
             logging.error(f"❌ Ошибка сети при получении аккаунтов: {e}")
             return []
-        except json.JSONDecodeError as e:
-            logging.error(f"❌ Ошибка парсинга JSON: {e}")
-            return []
         except Exception as e:
             logging.error(f"❌ Неожиданная ошибка при получении аккаунтов: {e}")
             return []
     
-    def redeem_code(self, code: str, account_data: Dict) -> bool:
+    def redeem_code(self, code: str, account_data: Dict) -> RedeemResult:
         """
         Активация кода для конкретного аккаунта
         Эндпоинт: POST /api/consume (из реальных Burp логов)
         """
         if not self.token:
             logging.error("❌ Токен не найден, сначала выполните верификацию")
-            return False
-            
-        url = "https://cdkey.lilith.com/api/consume"
+            return RedeemResult.AUTH_EXPIRED
         
-        # Точный формат payload из Burp логов
-        payload = {
-            "appId": "6241329",  # Из реальных логов
-            "roleId": self.uid,  # В логах используется UID как roleId
-            "game": "afk",
-            "cdkey": code,
-            "pupBody": "lilith"  # Из реальных логов
-        }
-        
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.token}',
-            'X-Client-Id': self.client_id
-        }
+        payload = _consume_payload(_target_role_id(self.uid, account_data), code)
         
         try:
             role_name = account_data.get('name', f"UID {self.uid}")
             logging.info(f"🎁 Активируем код {code} для аккаунта {role_name}")
-            
-            response = self.session.post(url, json=payload, headers=headers, timeout=30)
-            
-            logging.debug(f"Статус ответа: {response.status_code}")
             logging.debug(f"Payload: {payload}")
             
-            # Обрабатываем разные статус коды
-            if response.status_code == 400:
-                # Код 400 может означать недействительный код или истекший verification code
-                try:
-                    data = response.json()
-                    message = data.get('message', data.get('info', 'Неизвестная ошибка'))
-                    
-                    # Проверяем специфичные ошибки
-                    if 'verification code' in message.lower() or 'expired' in message.lower():
-                        logging.error(f"❌ Истек Verification Code! Нужно получить новый код в игре")
-                        return False
-                    elif 'not_found' in message or 'record_not_found' in message:
-                        logging.warning(f"⚠️ Код {code} не найден или недействителен")
-                    elif 'already' in message.lower():
-                        logging.warning(f"⚠️ Код {code} уже был использован")
-                    elif 'invalid' in message.lower():
-                        logging.warning(f"⚠️ Код {code} недействителен")
-                    else:
-                        logging.warning(f"⚠️ Ошибка активации кода {code}: {message}")
-                except:
-                    logging.warning(f"⚠️ Код {code} недействителен (статус 400)")
-                return False
-            
-            elif response.status_code == 401:
-                logging.error(f"❌ Ошибка авторизации! Verification Code истек или неверен")
-                return False
+            status, data = self._post("/api/consume", payload, self._auth_headers(), paced=True)
+            if status == 401 and self._refresh_stale_token():
+                status, data = self._post("/api/consume", payload, self._auth_headers(), paced=True)
             
-            response.raise_for_status()
-            
-            data = response.json()
-            logging.debug(f"Ответ API: {data}")
-            
-            if data.get('success'):
-                logging.info(f"✅ Код {code} успешно активирован для {role_name}")
-                return True
-            else:
-                message = data.get('message', data.get('info', 'Неизвестная ошибка'))
-                
-                # Проверяем типичные ошибки
-                if 'already' in message.lower() or 'уже' in message.lower():
-                    logging.warning(f"⚠️ Код {code} уже был активирован для {role_name}")
-                elif 'invalid' in message.lower() or 'недействительн' in message.lower():
-                    logging.warning(f"⚠️ Код {code} недействителен или истек")
-                elif 'expired' in message.lower() or 'истек' in message.lower():
-                    logging.warning(f"⚠️ Код {code} истек")
-                elif 'not_found' in message.lower() or 'record_not_found' in message.lower():
-                    logging.warning(f"⚠️ Код {code} не найден")
-                else:
-                    logging.warning(f"⚠️ Не удалось активировать код {code} для {role_name}: {message}")
-                
-                return False
+            result = _parse_consume_response(code, role_name, status, data)
+            if result is RedeemResult.AUTH_EXPIRED:
+                token_cache.invalidate(self._token_key, self.token)
+            return result
                 
         except requests.exceptions.RequestException as e:
             logging.error(f"❌ Ошибка сети при активации кода {code}: {e}")
-            return False
-        except json.JSONDecodeError as e:
-            logging.error(f"❌ Ошибка парсинга JSON при активации кода {code}: {e}")
-            return False
+            return RedeemResult.NETWORK_ERROR
         except Exception as e:
             logging.error(f"❌ Неожиданная ошибка при активации кода {code}: {e}")
-            return False
+            return RedeemResult.NETWORK_ERROR
     
-    def redeem_codes_for_all_accounts(self, codes: List[str]) -> Dict[str, int]:
+    def redeem_codes_for_all_accounts(self, codes: List[str]) -> Dict:
         """
         Активация списка кодов для всех аккаунтов
-        Возвращает статистику активации
+        Возвращает статистику активации; если Verification Code истек,
+        необработанные коды возвращаются в not_attempted_codes
         """
+        codes = dedupe_codes(codes)
         if not codes:
             logging.warning("⚠️ Список кодов пуст")
             return {"success": 0, "failed": 0, "already_used": 0}
@@ -274,92 +1024,530 @@ class LilithAPI:
             logging.error("❌ Не удалось получить аккаунты")
             return {"success": 0, "failed": 0, "already_used": 0}
         
-        stats = {"success": 0, "failed": 0, "already_used": 0}
+        stats = {"success": 0, "failed": 0, "already_used": 0, "not_attempted_codes": []}
+        targets = group_accounts_by_target(self.uid, accounts)
         
-        for code in codes:
+        codes, known_dead = dead_codes.split_alive(codes)
+        if known_dead:
+            logging.info(f"💀 Пропускаем {len(known_dead)} глобально мертвых кодов")
+        
+        for index, code in enumerate(codes):
             logging.info(f"\n🎯 Активируем код: {code}")
+            results = []
             
-            for account in accounts:
-                role_name = account.get('role_name', 'Unknown')
-                
-                # Увеличенная задержка между запросами (из-за err_freq_limit)
-                time.sleep(5)
+            for target_account, group in targets:
+                # Адаптивная пауза между запросами (из-за err_freq_limit)
+                self.pacer.wait()
                 
-                success = self.redeem_code(code, account)
-                if success:
-                    stats["success"] += 1
+                # Один запрос на цель, результат засчитываем каждой роли группы
+                result = self.redeem_code(code, target_account)
+                results.append(result)
+                if result is RedeemResult.AUTH_EXPIRED:
+                    # Дальше все запросы будут отклонены - не тратим время
+                    logging.error(f"⛔ Verification Code истек, пропущено кодов: {len(codes) - index}")
+                    stats["not_attempted_codes"] = list(codes[index:])
+                    return stats
+                elif result is RedeemResult.SUCCESS:
+                    stats["success"] += len(group)
+                elif result is RedeemResult.ALREADY_USED:
+                    stats["already_used"] += len(group)
                 else:
-                    stats["failed"] += 1
+                    stats["failed"] += len(group)
+            
+            dead_codes.record(code, _code_verdict(results), self.uid)
         
         return stats
     
-    def redeem_codes_batch_with_tracking(self, codes: List[str], batch_size: int = 25) -> Dict:
+    def redeem_codes_batch_with_tracking(self, codes: List[str], batch_size: int = 25,
+                                         deadline: Optional[float] = None) -> Dict:
         """
         Улучшенная активация кодов с батчингом и отслеживанием результатов
         Возвращает детальную статистику с успешными и неуспешными кодами
+        При истечении Verification Code батч сразу останавливается, а необработанные
+        коды возвращаются в remaining_codes (не попадают в неуспешные)
+        deadline (time.time()) - момент истечения кода: коды, которые уже не успеют,
+        и коды сверх batch_size возвращаются в not_attempted_codes
         """
+        codes = dedupe_codes(codes)
         if not codes:
             logging.warning("⚠️ Список кодов пуст")
-            return {
-                "success": 0, 
-                "failed": 0, 
-                "successful_codes": [], 
-                "failed_codes": [],
-                "total_processed": 0
-            }
+            return _empty_batch_stats()
+        
+        # Повторы запросов тоже не должны выходить за окно Verification Code
+        self.retry.deadline = deadline
         
         # Получаем аккаунты
         accounts = self.get_user_accounts()
         if not accounts:
             logging.error("❌ Не удалось получить аккаунты")
-            return {
-                "success": 0, 
-                "failed": 0, 
-                "successful_codes": [], 
-                "failed_codes": [],
-                "total_processed": 0
-            }
+            stats = _empty_batch_stats()
+            stats["remaining_codes"] = list(codes)
+            return stats
         
         # Ограничиваем количество кодов для обработки
         codes_to_process = codes[:batch_size]
         logging.info(f"🎯 Обрабатываем {len(codes_to_process)} кодов из {len(codes)} (батч размер: {batch_size})")
         
-        stats = {
-            "success": 0, 
-            "failed": 0, 
-            "successful_codes": [], 
-            "failed_codes": [],
-            "total_processed": len(codes_to_process)
-        }
+        stats = _empty_batch_stats()
+        stats["not_attempted_codes"] = list(codes[batch_size:])
+        targets = group_accounts_by_target(self.uid, accounts)
+        
+        # Коды, уже признанные мертвыми другими пользователями, не отправляем
+        codes_to_process, known_dead = dead_codes.split_alive(codes_to_process)
+        if known_dead:
+            logging.info(f"💀 Пропускаем {len(known_dead)} глобально мертвых кодов: {', '.join(known_dead)}")
+            stats["skipped_dead_codes"].extend(known_dead)
         
         for i, code in enumerate(codes_to_process, 1):
+            if _deadline_reached(deadline, self.pacer, len(targets)):
+                # Не успеем до истечения Verification Code - честно возвращаем остаток
+                untouched = codes_to_process[i - 1:]
+                stats["not_attempted_codes"] = untouched + stats["not_attempted_codes"]
+                logging.warning(f"⏱ Окно Verification Code заканчивается, не активировано кодов: {len(untouched)}")
+                break
+            
             logging.info(f"\n🎯 Активируем код {i}/{len(codes_to_process)}: {code}")
             
-            code_success = False
+            results = []
             
-            for account in accounts:
-                role_name = account.get('name', 'Unknown')
+            for target_account, group in targets:
+                # Адаптивная пауза между запросами (из-за err_freq_limit)
+                self.pacer.wait()
                 
-                # Задержка между запросами (увеличена из-за err_freq_limit)
-                time.sleep(8)  # Увеличил с 3 до 8 секунд
+                # Один запрос на цель, результат засчитываем каждой роли группы
+                result = self.redeem_code(code, target_account)
+                results.append(result)
                 
-                success = self.redeem_code(code, account)
-                if success:
-                    code_success = True
-                    stats["success"] += 1
-                    logging.info(f"✅ Код {code} успешно активирован для {role_name}")
+                if result is RedeemResult.AUTH_EXPIRED:
+                    break
+                elif result is RedeemResult.SUCCESS:
+                    stats["success"] += len(group)
                 else:
-                    stats["failed"] += 1
+                    stats["failed"] += len(group)
+            
+            verdict = _code_verdict(results)
+            if verdict is RedeemResult.AUTH_EXPIRED:
+                # Токен мертв: текущий и оставшиеся коды не трогаем
+                _abort_batch(stats, codes_to_process[i - 1:])
+                break
             
             # Отслеживаем результат по коду
-            if code_success:
-                stats["successful_codes"].append(code)
-            else:
-                stats["failed_codes"].append(code)
-                logging.warning(f"❌ Код {code} не удалось активировать ни для одного аккаунта")
+            stats["total_processed"] += 1
+            _record_code_verdict(stats, code, verdict, self.uid)
+        
+        logging.info(f"📊 Батч завершен: {len(stats['successful_codes'])} успешных, {len(stats['failed_codes'])} неуспешных кодов")
+        return stats
+
+# Общий пул keep-alive соединений для всех AsyncLilithAPI в процессе
+_shared_session: Optional[aiohttp.ClientSession] = None
+_shared_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def get_shared_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую aiohttp сессию (создается лениво в текущем event loop)
+    Все пользователи бота делят один пул соединений к cdkey.lilith.com
+    """
+    global _shared_session, _shared_session_loop
+    
+    loop = asyncio.get_running_loop()
+    if _shared_session is None or _shared_session.closed or _shared_session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_LIMIT,
+            limit_per_host=POOL_LIMIT,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300
+        )
+        _shared_session = aiohttp.ClientSession(
+            connector=connector,
+            headers=DEFAULT_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        )
+        _shared_session_loop = loop
+        logging.debug(f"🔌 Создан общий пул соединений (limit={POOL_LIMIT})")
+    
+    return _shared_session
+
+async def close_shared_session():
+    """Закрывает общий пул соединений (вызывается при остановке бота)"""
+    global _shared_session, _shared_session_loop
+    
+    if _shared_session is not None and not _shared_session.closed:
+        await _shared_session.close()
+    _shared_session = None
+    _shared_session_loop = None
+
+class AsyncLilithAPI:
+    """
+    Асинхронная версия LilithAPI на aiohttp
+    Те же эндпоинты, payload и результаты, но без потока на каждую сессию:
+    все экземпляры используют общий пул соединений get_shared_session()
+    """
+    
+    def __init__(self, uid: str, verification_code: str, base_url: Optional[str] = None):
+        self.uid = uid
+        self.verification_code = verification_code
+        self.base_url = resolve_base_url(base_url)
+        self.token = None
+        self._token_key = token_cache_key(uid, verification_code)
+        self._token_from_cache = False
+        self.client_id = CLIENT_ID
+        self.pacer = get_pacer(uid)
+        self.retry = RetryPolicy()
+    
+    def _auth_headers(self) -> Dict[str, str]:
+        """Заголовки для запросов с токеном"""
+        return {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {self.token}',
+            'X-Client-Id': self.client_id
+        }
+    
+    async def _post(self, path: str, payload: Dict, headers: Dict[str, str],
+                    paced: bool = False, idempotent: bool = True) -> Tuple[int, Optional[Dict]]:
+        """
+        POST запрос через общий пул, возвращает (статус, JSON или None)
+        Повторы и учет пауз - как в LilithAPI._post
+        """
+        session = get_shared_session()
+        attempt = 0
+        while True:
+            attempt += 1
+            started = time.monotonic()
+            try:
+                async with session.post(f"{self.base_url}{path}", json=payload, headers=headers) as response:
+                    try:
+                        data = await response.json(content_type=None)
+                    except (ValueError, aiohttp.ContentTypeError):
+                        data = None
+                    status = response.status
+                    retry_after = _retry_after_seconds(response.headers)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                delay = self.retry.next_delay(attempt) if idempotent or _request_not_sent(e) else None
+                if delay is None:
+                    raise
+                logging.warning(f"🔁 Сбой сети на {path} ({e}), повтор через {delay:.1f}с")
+                await asyncio.sleep(delay)
+                continue
+            
+            if paced:
+                self.pacer.record_response(status, data, time.monotonic() - started)
+            
+            # Токен отклонен - убираем его из общего кэша
+            if status == 401 and 'Authorization' in headers:
+                token_cache.invalidate(self._token_key, self.token)
+            
+            retryable = _is_retryable(status, data) if idempotent else _is_rate_limited(status, data)
+            if retryable:
+                if _is_rate_limited(status, data):
+                    retry_after = max(retry_after or 0.0, self.pacer.delay)
+                delay = self.retry.next_delay(attempt, retry_after)
+                if delay is not None:
+                    logging.warning(f"🔁 HTTP {status} на {path}, повтор через {delay:.1f}с")
+                    await asyncio.sleep(delay)
+                    continue
+            
+            return status, data
+    
+    async def _request_token(self) -> Optional[str]:
+        """Запрос нового токена по Verification Code"""
+        payload = {
+            "uid": self.uid,
+            "game": "afk", 
+            "code": self.verification_code
+        }
+        
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Client-Id': self.client_id
+        }
+        
+        try:
+            logging.info(f"🔐 Верифицируем аккаунт UID: {self.uid}")
+            status, data = await self._post("/api/verify-afk-code", payload, headers, idempotent=False)
+            return _parse_verify_response(status, data)
+            
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"❌ Ошибка сети при верификации: {e}")
+            return None
+        except Exception as e:
+            logging.error(f"❌ Неожиданная ошибка при верификации: {e}")
+            return None
+    
+    async def verify_account(self) -> bool:
+        """
+        Верификация аккаунта и получение токена
+        Эндпоинт: POST /api/verify-afk-code
+        Живой токен, полученный этим же кодом, переиспользуется из token_cache без запроса,
+        параллельные верификации одного UID объединяются в один запрос
+        """
+        cached = token_cache.get(self._token_key)
+        if cached:
+            logging.info(f"♻️ Используем сохраненный токен для UID: {self.uid}")
+            self.token = cached
+            self._token_from_cache = True
+            return True
+        
+        self.token = await token_cache.get_or_fetch(self._token_key, self._request_token)
+        self._token_from_cache = False
+        return bool(self.token)
+    
+    async def _refresh_stale_token(self) -> bool:
+        """Один раз перевыпускает токен, если сохраненный токен оказался мертвым"""
+        if not self._token_from_cache:
+            return False
+        
+        logging.info(f"🔄 Сохраненный токен отклонен, верифицируемся заново")
+        self._token_from_cache = False
+        self.token = await token_cache.get_or_fetch(self._token_key, self._request_token)
+        return bool(self.token)
+    
+    async def get_user_accounts(self, force_refresh: bool = False) -> List[Dict]:
+        """
+        Получение списка аккаунтов пользователя
+        Эндпоинт: POST /api/users
+        Список кэшируется в roster_cache на ROSTER_CACHE_TTL секунд,
+        force_refresh=True принудительно запрашивает его заново
+        """
+        if not self.token:
+            logging.error("❌ Токен не найден, сначала выполните верификацию")
+            return []
+        
+        if force_refresh:
+            roster_cache.invalidate(self.uid)
+        else:
+            cached = roster_cache.get(self.uid)
+            if cached:
+                logging.info(f"♻️ Список аккаунтов из кэша: {len(cached)} аккаунтов")
+                return list(cached)
+        
+        return list(await roster_cache.get_or_fetch(self.uid, self._fetch_user_accounts))
+    
+    async def _fetch_user_accounts(self) -> List[Dict]:
+        """Запрос списка аккаунтов у API (без кэша)"""
+        payload = {
+            "uid": self.uid,
+            "game": "afk"
+        }
+        
+        try:
+            logging.info(f"📋 Получаем список аккаунтов для UID: {self.uid}")
+            status, data = await self._post("/api/users", payload, self._auth_headers())
+            if status == 401 and await self._refresh_stale_token():
+                status, data = await self._post("/api/users", payload, self._auth_headers())
+            
+            return _parse_accounts_response(status, data)
+            
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"❌ Ошибка сети при получении аккаунтов: {e}")
+            return []
+        except Exception as e:
+            logging.error(f"❌ Неожиданная ошибка при получении аккаунтов: {e}")
+            return []
+    
+    async def redeem_code(self, code: str, account_data: Dict) -> RedeemResult:
+        """
+        Активация кода для конкретного аккаунта
+        Эндпоинт: POST /api/consume
+        """
+        if not self.token:
+            logging.error("❌ Токен не найден, сначала выполните верификацию")
+            return RedeemResult.AUTH_EXPIRED
+        
+        payload = _consume_payload(_target_role_id(self.uid, account_data), code)
+        
+        try:
+            role_name = account_data.get('name', f"UID {self.uid}")
+            logging.info(f"🎁 Активируем код {code} для аккаунта {role_name}")
+            logging.debug(f"Payload: {payload}")
+            
+            status, data = await self._post("/api/consume", payload, self._auth_headers(), paced=True)
+            if status == 401 and await self._refresh_stale_token():
+                status, data = await self._post("/api/consume", payload, self._auth_headers(), paced=True)
+            
+            result = _parse_consume_response(code, role_name, status, data)
+            if result is RedeemResult.AUTH_EXPIRED:
+                token_cache.invalidate(self._token_key, self.token)
+            return result
+            
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"❌ Ошибка сети при активации кода {code}: {e}")
+            return RedeemResult.NETWORK_ERROR
+        except Exception as e:
+            logging.error(f"❌ Неожиданная ошибка при активации кода {code}: {e}")
+            return RedeemResult.NETWORK_ERROR
+    
+    async def redeem_codes_batch_with_tracking(self, codes: List[str], batch_size: int = 25,
+                                               deadline: Optional[float] = None) -> Dict:
+        """
+        Асинхронный аналог LilithAPI.redeem_codes_batch_with_tracking
+        Паузы между запросами не блокируют event loop
+        """
+        codes = dedupe_codes(codes)
+        if not codes:
+            logging.warning("⚠️ Список кодов пуст")
+            return _empty_batch_stats()
+        
+        # Повторы запросов тоже не должны выходить за окно Verification Code
+        self.retry.deadline = deadline
+        
+        # Получаем аккаунты
+        accounts = await self.get_user_accounts()
+        if not accounts:
+            logging.error("❌ Не удалось получить аккаунты")
+            stats = _empty_batch_stats()
+            stats["remaining_codes"] = list(codes)
+            return stats
+        
+        # Ограничиваем количество кодов для обработки
+        codes_to_process = codes[:batch_size]
+        logging.info(f"🎯 Обрабатываем {len(codes_to_process)} кодов из {len(codes)} (батч размер: {batch_size})")
+        
+        stats = _empty_batch_stats()
+        stats["not_attempted_codes"] = list(codes[batch_size:])
+        targets = group_accounts_by_target(self.uid, accounts)
+        
+        # Коды, уже признанные мертвыми другими пользователями, не отправляем
+        codes_to_process, known_dead = dead_codes.split_alive(codes_to_process)
+        if known_dead:
+            logging.info(f"💀 Пропускаем {len(known_dead)} глобально мертвых кодов: {', '.join(known_dead)}")
+            stats["skipped_dead_codes"].extend(known_dead)
+        
+        for i, code in enumerate(codes_to_process, 1):
+            if _deadline_reached(deadline, self.pacer, len(targets)):
+                # Не успеем до истечения Verification Code - честно возвращаем остаток
+                untouched = codes_to_process[i - 1:]
+                stats["not_attempted_codes"] = untouched + stats["not_attempted_codes"]
+                logging.warning(f"⏱ Окно Verification Code заканчивается, не активировано кодов: {len(untouched)}")
+                break
+            
+            logging.info(f"\n🎯 Активируем код {i}/{len(codes_to_process)}: {code}")
+            
+            verdict = await self._redeem_for_targets(code, targets, stats)
+            if verdict is RedeemResult.AUTH_EXPIRED:
+                # Токен мертв: текущий и оставшиеся коды не трогаем
+                _abort_batch(stats, codes_to_process[i - 1:])
+                break
+            
+            # Отслеживаем результат по коду
+            stats["total_processed"] += 1
+            _record_code_verdict(stats, code, verdict, self.uid)
         
         logging.info(f"📊 Батч завершен: {len(stats['successful_codes'])} успешных, {len(stats['failed_codes'])} неуспешных кодов")
         return stats
+    
+    async def _redeem_for_targets(self, code: str, targets: List[Tuple[Dict, List[Dict]]], stats: Dict) -> RedeemResult:
+        """Активирует код для всех целей, успехи и неудачи засчитываются каждой роли группы"""
+        results = []
+        
+        for target_account, group in targets:
+            # Адаптивная пауза между запросами (из-за err_freq_limit)
+            await self.pacer.wait_async()
+            
+            # Один запрос на цель, результат засчитываем каждой роли группы
+            result = await self.redeem_code(code, target_account)
+            results.append(result)
+            
+            if result is RedeemResult.AUTH_EXPIRED:
+                break
+            elif result is RedeemResult.SUCCESS:
+                stats["success"] += len(group)
+            else:
+                stats["failed"] += len(group)
+        
+        return _code_verdict(results)
+    
+    async def redeem_codes_stream(self, code_batches: AsyncIterator[List[Dict]], deadline: Optional[float] = None,
+                                  max_codes: Optional[int] = None) -> Dict:
+        """
+        Потоковая активация: коды активируются по мере поступления пачек (например, от каждого
+        сайта), первый /api/consume уходит, пока медленные источники еще загружаются
+        Из уже поступивших кодов следующим берется самый ценный (как в plan_redemption),
+        истекшие и повторные коды отбрасываются; статистика - как у redeem_codes_batch_with_tracking
+        """
+        self.retry.deadline = deadline
+        stats = _empty_batch_stats()
+        
+        queue: List[Tuple[Tuple, int, str]] = []
+        seen = CodeIndex()
+        sequence = itertools.count()
+        arrived = asyncio.Event()
+        
+        async def produce():
+            try:
+                async for batch in code_batches:
+                    for code_data in batch:
+                        if is_expired(code_data) or not seen.add(code_data.get('code', '')):
+                            continue
+                        heapq.heappush(queue, (_code_priority(code_data), next(sequence), code_data['code']))
+                    arrived.set()
+            finally:
+                arrived.set()
+        
+        producer = asyncio.create_task(produce())
+        
+        async def finish_producer():
+            """Дожидается оставшихся пачек: их коды нужны для статистики и очереди отложенных"""
+            try:
+                await producer
+            except Exception as e:
+                logging.error(f"❌ Ошибка источника кодов: {e}")
+        
+        def drain() -> List[str]:
+            codes = [code for _, _, code in sorted(queue)]
+            queue.clear()
+            return codes
+        
+        try:
+            accounts = await self.get_user_accounts()
+            if not accounts:
+                logging.error("❌ Не удалось получить аккаунты")
+                await finish_producer()
+                stats["remaining_codes"] = drain()
+                return stats
+            targets = group_accounts_by_target(self.uid, accounts)
+            
+            attempted = 0
+            while True:
+                if not queue:
+                    if producer.done():
+                        await finish_producer()
+                        break
+                    arrived.clear()
+                    await arrived.wait()
+                    continue
+                
+                if (max_codes is not None and attempted >= max_codes) or _deadline_reached(deadline, self.pacer, len(targets)):
+                    # Лимит сессии или окно Verification Code: остаток ждет следующей сессии
+                    await finish_producer()
+                    untouched = drain()
+                    stats["not_attempted_codes"].extend(untouched)
+                    logging.warning(f"⏱ Сессия заканчивается, не активировано кодов: {len(untouched)}")
+                    break
+                
+                _, _, code = heapq.heappop(queue)
+                if dead_codes.is_dead(code):
+                    logging.info(f"💀 Пропускаем глобально мертвый код: {code}")
+                    stats["skipped_dead_codes"].append(code)
+                    continue
+                
+                attempted += 1
+                logging.info(f"\n🎯 Активируем код {attempted} (в очереди еще {len(queue)}): {code}")
+                
+                verdict = await self._redeem_for_targets(code, targets, stats)
+                if verdict is RedeemResult.AUTH_EXPIRED:
+                    # Токен мертв: текущий, поступившие и еще не поступившие коды не трогаем
+                    await finish_producer()
+                    _abort_batch(stats, [code] + drain())
+                    break
+                
+                stats["total_processed"] += 1
+                _record_code_verdict(stats, code, verdict, self.uid)
+        finally:
+            if not producer.done():
+                producer.cancel()
+        
+        logging.info(f"📊 Поток завершен: {len(stats['successful_codes'])} успешных, {len(stats['failed_codes'])} неуспешных кодов")
+        return stats
 
 def test_direct_api():
     """Тестирование прямого API с реальными данными из Burp логов"""
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Неблокирующее выполнение для обработчиков Telegram бота
+Короткая синхронная работа (история кодов, настройки) уходит в пул потоков через
+run_blocking, долгие ожидания сайтов при сборе кодов - в свой пул через run_scrape,
+чтобы они не занимали потоки коротких вызовов. LoopWatchdog следит, чтобы event loop
+не зависал: если loop не отвечает дольше порога, в лог пишется стек вызова, который его держит
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+BLOCKING_WORKERS = int(os.getenv('BOT_BLOCKING_WORKERS', '8'))
+SCRAPE_WORKERS = int(os.getenv('BOT_SCRAPE_WORKERS', '4'))  # Одновременных ожиданий сбора кодов с сайтов
+LOOP_STALL_THRESHOLD = float(os.getenv('LOOP_STALL_THRESHOLD', '0.5'))  # Секунд без отклика event loop до записи в лог
+WATCHDOG_INTERVAL = 0.1  # Период пульса и проверки
+
+# Пулы потоков по имени: 'blocking' - короткие вызовы, 'scrape' - сбор кодов с сайтов
+_pools: Dict[str, ThreadPoolExecutor] = {}
+_pools_lock = threading.Lock()
+_POOL_WORKERS = {'blocking': BLOCKING_WORKERS, 'scrape': SCRAPE_WORKERS}
+
+def _get_pool(name: str) -> ThreadPoolExecutor:
+    """Пул потоков с данным именем (создается при первом вызове)"""
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(max_workers=_POOL_WORKERS[name], thread_name_prefix=f'bot-{name}')
+        return _pools[name]
+
+async def run_blocking(func: Callable, *args, **kwargs) -> Any:
+    """Выполняет короткую синхронную функцию в пуле потоков, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool('blocking'), functools.partial(func, *args, **kwargs))
+
+async def run_scrape(func: Callable, *args, **kwargs) -> Any:
+    """
+    Выполняет сбор кодов (ожидание ответа сайтов, до десятков секунд) в отдельном пуле:
+    одновременные сборы не занимают потоки run_blocking у остальных пользователей
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pool('scrape'), functools.partial(func, *args, **kwargs))
+
+def shutdown_blocking_pool():
+    """Останавливает пулы потоков (при остановке бота)"""
+    with _pools_lock:
+        for pool in _pools.values():
+            if sys.version_info >= (3, 9):
+                pool.shutdown(wait=False, cancel_futures=True)
+            else:
+                pool.shutdown(wait=False)  # cancel_futures появился только в Python 3.9
+        _pools.clear()
+
+class LoopWatchdog:
+    """
+    Сторож event loop: корутина-пульс отмечает время каждые interval секунд,
+    а отдельный поток проверяет отметку. Если пульса нет дольше threshold, loop
+    занят синхронным вызовом - в лог уходит стек этого вызова (один раз на зависание),
+    а после отвисания - длительность зависания
+    """
+    
+    def __init__(self, threshold: float = LOOP_STALL_THRESHOLD, interval: float = WATCHDOG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.longest_stall = 0.0
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+    
+    async def _heartbeat(self):
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+    
+    def _loop_stack(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        return ''.join(traceback.format_stack(frame)) if frame else '(стек недоступен)'
+    
+    def _watch(self):
+        stalled_beat = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            
+            if stalled_beat is not None and beat != stalled_beat:
+                # Loop снова отвечает: пульс пришел позже, чем ожидался
+                duration = beat - stalled_beat - self.interval
+                self.longest_stall = max(self.longest_stall, duration)
+                logger.warning(f"🐢 Event loop был заблокирован {duration:.2f}с")
+                stalled_beat = None
+            
+            lag = time.monotonic() - beat - self.interval
+            if stalled_beat is None and lag > self.threshold:
+                stalled_beat = beat
+                self.stalls += 1
+                logger.warning(f"🐢 Event loop не отвечает {lag:.2f}с (порог {self.threshold}с), "
+                               f"блокирующий вызов:\n{self._loop_stack()}")
+    
+    def start(self):
+        """Запускает сторожа для текущего event loop (вызывать из корутины)"""
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        logger.info(f"🐕 Сторож event loop запущен (порог {self.threshold}с)")
+    
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._stop.set()
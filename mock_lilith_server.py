@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка API Lilith для тестов и нагрузочных экспериментов
+Реализует /api/verify-afk-code, /api/users и /api/consume с теми же JSON ответами,
+которые разбирает direct_lilith_api.py, плюс настраиваемые задержки, срок жизни
+токена, ограничение частоты (err_freq_limit) и состояние каждого кода
+
+Запуск:
+    python3 mock_lilith_server.py --port 8765 --roles 3 --latency lognormal:0.3:0.4 --rate-limit 5
+Клиент:
+    LILITH_BASE_URL=http://127.0.0.1:8765 python3 run_direct_api_fixed.py
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import random
+import secrets
+import time
+from collections import defaultdict, deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from aiohttp import web
+
+# Состояния кодов, известные заглушке (остальные коды отвечают record_not_found)
+CODE_VALID = 'valid'
+CODE_USED = 'used'  # Уже активирован для любой роли
+CODE_EXPIRED = 'expired'
+CODE_STATES = (CODE_VALID, CODE_USED, CODE_EXPIRED)
+
+DEFAULT_TOKEN_TTL = 120  # Как у настоящего Verification Code
+DEFAULT_RATE_WINDOW = 10.0
+
+class LatencyModel:
+    """
+    Распределение задержки ответа
+    fixed:A - всегда A секунд
+    uniform:A:B - равномерно от A до B
+    lognormal:M:S - логнормальное с медианой M и сигмой S (длинный хвост, как у живого сервера)
+    """
+    
+    KINDS = ('fixed', 'uniform', 'lognormal')
+    
+    def __init__(self, kind: str = 'fixed', a: float = 0.0, b: float = 0.0):
+        if kind not in self.KINDS:
+            raise ValueError(f"Неизвестное распределение задержки: {kind}")
+        self.kind = kind
+        self.a = a
+        self.b = b
+    
+    @classmethod
+    def parse(cls, spec: str) -> 'LatencyModel':
+        """Разбор строки вида 'lognormal:0.3:0.4'"""
+        kind, *params = spec.split(':')
+        values = [float(p) for p in params] + [0.0, 0.0]
+        return cls(kind, values[0], values[1])
+    
+    def sample(self) -> float:
+        if self.kind == 'uniform':
+            return random.uniform(self.a, max(self.a, self.b))
+        if self.kind == 'lognormal':
+            return random.lognormvariate(math.log(self.a), self.b) if self.a > 0 else 0.0
+        return self.a
+    
+    def __repr__(self) -> str:
+        return f"{self.kind}:{self.a}:{self.b}"
+
+class MockLilithServer:
+    """
+    Заглушка cdkey.lilith.com
+    
+    codes - состояние известных кодов {код: valid/used/expired}; неизвестные коды - record_not_found
+    roles - сколько ролей вернуть в /api/users
+    token_ttl - через сколько секунд токен перестает приниматься (HTTP 401)
+    rate_limit - сколько /api/consume на UID разрешено за rate_window секунд (None - без лимита)
+    error_rate - доля ответов HTTP 503 (для проверки повторов)
+    verification_codes - допустимые Verification Code (None - принимается любой)
+    """
+    
+    def __init__(self, codes: Optional[Dict[str, str]] = None, roles: int = 1,
+                 latency: Optional[LatencyModel] = None, token_ttl: float = DEFAULT_TOKEN_TTL,
+                 rate_limit: Optional[int] = None, rate_window: float = DEFAULT_RATE_WINDOW,
+                 error_rate: float = 0.0, verification_codes: Optional[Set[str]] = None):
+        self.codes = {code.lower(): state for code, state in (codes or {}).items()}
+        self.roles = roles
+        self.latency = latency or LatencyModel()
+        self.token_ttl = token_ttl
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.error_rate = error_rate
+        self.verification_codes = verification_codes
+        
+        self.tokens: Dict[str, Tuple[str, float]] = {}  # токен -> (uid, время выдачи)
+        self.redeemed: Set[Tuple[str, str]] = set()  # (roleId, код)
+        self.consume_times: Dict[str, Deque[float]] = defaultdict(deque)
+        self.stats: Dict[str, int] = defaultdict(int)
+        self._runner: Optional[web.AppRunner] = None
+    
+    async def _respond(self, payload: Dict, status: int = 200, headers: Optional[Dict[str, str]] = None) -> web.Response:
+        """Ответ с задержкой по выбранному распределению"""
+        delay = self.latency.sample()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.stats[f"http_{status}"] += 1
+        return web.json_response(payload, status=status, headers=headers)
+    
+    def _failure(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+    
+    def _token_uid(self, request: web.Request) -> Optional[str]:
+        """UID владельца токена или None, если токен неизвестен или истек"""
+        token = request.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        owner = self.tokens.get(token)
+        if owner is None:
+            return None
+        uid, issued = owner
+        if time.time() - issued > self.token_ttl:
+            return None
+        return uid
+    
+    def _throttle(self, uid: str) -> Optional[float]:
+        """Регистрирует запрос /api/consume, возвращает Retry-After при превышении лимита"""
+        if self.rate_limit is None:
+            return None
+        now = time.monotonic()
+        window = self.consume_times[uid]
+        while window and now - window[0] > self.rate_window:
+            window.popleft()
+        if len(window) >= self.rate_limit:
+            return self.rate_window - (now - window[0])
+        window.append(now)
+        return None
+    
+    async def handle_verify(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.stats['verify'] += 1
+        if self._failure():
+            return await self._respond({}, status=503)
+        
+        if self.verification_codes is not None and body.get('code') not in self.verification_codes:
+            return await self._respond({"success": False, "message": "verification code is invalid"})
+        
+        token = secrets.token_hex(16)
+        self.tokens[token] = (str(body.get('uid')), time.time())
+        return await self._respond({"success": True, "data": {"token": token}})
+    
+    async def handle_users(self, request: web.Request) -> web.Response:
+        self.stats['users'] += 1
+        if self._failure():
+            return await self._respond({}, status=503)
+        
+        uid = self._token_uid(request)
+        if uid is None:
+            return await self._respond({"message": "unauthorized"}, status=401)
+        
+        roles = [{
+            "name": f"Mock{i}",
+            "svr_id": 100 + i,
+            "level": 100 + i,
+            "uid": uid,
+            "is_main": i == 1
+        } for i in range(1, self.roles + 1)]
+        return await self._respond({"success": True, "data": {"roles": roles}})
+    
+    async def handle_consume(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.stats['consume'] += 1
+        if self._failure():
+            return await self._respond({}, status=503)
+        
+        uid = self._token_uid(request)
+        if uid is None:
+            return await self._respond({"message": "unauthorized"}, status=401)
+        
+        retry_after = self._throttle(uid)
+        if retry_after is not None:
+            self.stats['throttled'] += 1
+            return await self._respond({"success": False, "message": "err_freq_limit"}, status=400,
+                                       headers={'Retry-After': f"{max(retry_after, 0.0):.2f}"})
+        
+        code = str(body.get('cdkey', '')).lower()
+        key = (str(body.get('roleId')), code)
+        state = self.codes.get(code)
+        
+        if state is None:
+            return await self._respond({"success": False, "message": "record_not_found"}, status=400)
+        if state == CODE_EXPIRED:
+            return await self._respond({"success": False, "message": "cdkey expired"})
+        if state == CODE_USED or key in self.redeemed:
+            return await self._respond({"success": False, "message": "already redeemed"}, status=400)
+        
+        self.redeemed.add(key)
+        self.stats['redeemed'] += 1
+        return await self._respond({"success": True, "data": {}})
+    
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/api/verify-afk-code', self.handle_verify)
+        app.router.add_post('/api/users', self.handle_users)
+        app.router.add_post('/api/consume', self.handle_consume)
+        return app
+    
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Запускает сервер в текущем event loop, возвращает base_url (port=0 - свободный порт)"""
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+    
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+def parse_codes(specs) -> Dict[str, str]:
+    """Разбор аргументов вида CODE или CODE=used"""
+    codes = {}
+    for spec in specs or []:
+        code, _, state = spec.partition('=')
+        state = state or CODE_VALID
+        if state not in CODE_STATES:
+            raise ValueError(f"Неизвестное состояние кода {code}: {state}")
+        codes[code] = state
+    return codes
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная заглушка API Lilith")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--roles', type=int, default=1, help="Сколько ролей вернуть в /api/users")
+    parser.add_argument('--latency', default='fixed:0', help="fixed:A | uniform:A:B | lognormal:MEDIAN:SIGMA")
+    parser.add_argument('--token-ttl', type=float, default=DEFAULT_TOKEN_TTL)
+    parser.add_argument('--rate-limit', type=int, default=None, help="Запросов /api/consume на UID за окно")
+    parser.add_argument('--rate-window', type=float, default=DEFAULT_RATE_WINDOW)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов HTTP 503")
+    parser.add_argument('--code', action='append', metavar='CODE[=valid|used|expired]',
+                        help="Известный код (можно повторять)")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    
+    server = MockLilithServer(
+        codes=parse_codes(args.code),
+        roles=args.roles,
+        latency=LatencyModel.parse(args.latency),
+        token_ttl=args.token_ttl,
+        rate_limit=args.rate_limit,
+        rate_window=args.rate_window,
+        error_rate=args.error_rate
+    )
+    
+    print(f"🧪 Заглушка Lilith: http://{args.host}:{args.port} (задержка {server.latency}, ролей {args.roles})")
+    print(f"💡 Для клиента: export LILITH_BASE_URL=http://{args.host}:{args.port}")
+    web.run_app(server.build_app(), host=args.host, port=args.port, print=None, access_log=None)
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,28 @@ AFK Arena Code Redeemer - Автоматический активатор про
 import logging
 import sys
 import os
-import re
 import requests
 from bs4 import BeautifulSoup
-from typing import List, Dict, Set
+from code_identity import code_key
+from code_metadata import (
+    STATUS_ACTIVE, STATUS_EXPIRED, column_roles, is_expired, is_expiry_text, parse_expiry, parse_rewards
+)
+from code_validator import (
+    EXTRACTED_TABLE, EXTRACTED_TEXT, extract_candidates, shape_model, validate_codes
+)
+from typing import Callable, Iterator, List, Dict, Optional, Tuple
+import copy
+import hashlib
+import threading
 import time
 import json
-from datetime import datetime
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from calendar import timegm
+from collections import deque
+from urllib.parse import urlparse
 
 try:
     from dotenv import load_dotenv
@@ -22,6 +37,11 @@ except ImportError:
     print("💡 Установите: pip3 install python-dotenv")
     sys.exit(1)
 
+try:
+    import feedparser
+except ImportError:
+    feedparser = None  # Без feedparser RSS/Atom источники просто пропускаются
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -55,6 +75,21 @@ HEADERS = {
 CONNECT_TIMEOUT = 10
 RECEIVE_TIMEOUT = 15
 REDEEM_DELAY = 5
+SCRAPE_DEADLINE = 20  # Общий лимит на сбор кодов со всех сайтов (сайты парсятся параллельно)
+FETCH_CHUNK_SIZE = 64 * 1024  # Тело страницы читается кусками, между ними проверяется лимит времени
+
+# Общий кэш результатов парсинга (один сайт парсится один раз на всех пользователей)
+SCRAPE_CACHE_TTL = 300  # Сколько секунд список кодов считается свежим
+SCRAPE_CACHE_STALE_TTL = 1800  # Сколько еще секунд отдавать устаревший список, обновляя его в фоне
+
+# Потоки для параллельного парсинга сайтов (общие, чтобы зависший сайт не блокировал выход по дедлайну)
+_scrape_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='scrape')
+
+# Процессы для разбора HTML: BeautifulSoup держит GIL и тормозит event loop бота
+PARSE_PROCESSES = int(os.getenv('SCRAPE_PARSE_PROCESSES', '2'))  # 0 - разбирать в текущем потоке
+PARSE_TIMEOUT = float(os.getenv('SCRAPE_PARSE_TIMEOUT', '10'))  # Сколько ждать разбора одной страницы в пуле
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_parse_pool_lock = threading.Lock()
 
 # Полный список сайтов для парсинга
 FULL_CODE_WEBSITES = [
@@ -62,232 +97,740 @@ FULL_CODE_WEBSITES = [
     'https://www.lolvvv.com/codes/afk-arena'
 ]
 
+# RSS/Atom ленты с новостями о кодах (через запятую в CODE_FEED_URLS, по умолчанию выключены):
+# коды из ленты - кандидаты из текста и активируются, только если их подтвердил другой сайт
+CODE_FEED_URLS = [url.strip() for url in os.getenv('CODE_FEED_URLS', '').split(',') if url.strip()]
+FEED_TIMEOUT = 10
+FEED_CODE_MAX_AGE = 30 * 24 * 3600  # Сколько секунд помнить коды из уже прочитанных записей ленты
+FEED_SEEN_IDS_LIMIT = 500
+
 def fix_truncated_code(code: str) -> str:
     """НЕ НУЖНО исправлять коды - они правильные в HTML"""
     # Убираем функцию исправления - коды правильные
     return code
 
-def parse_afk_guide_fixed(url: str) -> List[Dict]:
+def _detect_html_parser() -> str:
+    """
+    Бэкенд BeautifulSoup для парсинга страниц: SCRAPE_HTML_PARSER из окружения,
+    иначе lxml (в разы быстрее, если установлен), иначе встроенный html.parser
+    """
+    preferred = os.getenv('SCRAPE_HTML_PARSER')
+    if preferred:
+        return preferred
+    try:
+        import lxml  # noqa: F401
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+HTML_PARSER = _detect_html_parser()
+
+# Маркеры таблицы с кодами: по ним вырезается фрагмент страницы для хэша
+AFK_GUIDE_TABLE_MARKER = b'ninja_table_instance_0'
+LOLVVV_TABLE_MARKER = b'Active AFK Arena Codes'
+LOLVVV_EXPIRED_TABLE_MARKER = b'Expired AFK Arena Codes'
+LOLVVV_TABLE_MARKERS = (LOLVVV_TABLE_MARKER, LOLVVV_EXPIRED_TABLE_MARKER)
+
+# Состояние страниц между запросами: URL -> ETag, Last-Modified, хэш таблицы и коды
+_page_states: Dict[str, Dict] = {}
+_page_states_lock = threading.Lock()
+
+def _table_fragment(content: bytes, marker) -> bytes:
+    """
+    Вырезает <table>...</table> вокруг маркера (или вокруг каждого из кортежа маркеров)
+    Если ни одна таблица не найдена - вся страница
+    """
+    fragments = []
+    for item in ((marker,) if isinstance(marker, bytes) else marker):
+        position = content.find(item)
+        if position == -1:
+            continue
+        start = content.rfind(b'<table', 0, position)
+        end = content.find(b'</table>', position)
+        if start != -1 and end != -1:
+            fragments.append(content[start:end + len(b'</table>')])
+    return b''.join(fragments) or content
+
+def fetch_with_deadline(url: str, headers: Dict[str, str], timeout: float) -> Tuple[requests.Response, bytes]:
+    """
+    GET с общим лимитом времени на ответ: read timeout requests ограничивает только паузу
+    между пакетами, и сайт, отдающий страницу по байту, держал бы поток _scrape_pool сколько угодно.
+    Тело читается по мере прихода пакетов, и загрузка обрывается (Timeout), как только timeout секунд истекли
+    """
+    deadline = time.monotonic() + timeout
+    with requests.get(url, headers=headers, timeout=(CONNECT_TIMEOUT, timeout), stream=True) as response:
+        # read1 (urllib3 2.x) отдает то, что уже пришло; iter_content ждет полный кусок
+        if hasattr(response.raw, 'read1'):
+            chunks_iter = iter(lambda: response.raw.read1(FETCH_CHUNK_SIZE, decode_content=True), b'')
+        else:
+            chunks_iter = response.iter_content(FETCH_CHUNK_SIZE)
+        
+        chunks = []
+        for chunk in chunks_iter:
+            chunks.append(chunk)
+            if time.monotonic() > deadline:
+                raise requests.exceptions.Timeout(f"{url}: страница не загрузилась за {timeout}с")
+        return response, b''.join(chunks)
+
+def fetch_codes_conditional(url: str, timeout: float, marker,
+                            parse_html: Callable[[bytes], List[Dict]]) -> List[Dict]:
+    """
+    Условная загрузка страницы с кодами
+    Повторный запрос идет с If-None-Match / If-Modified-Since: на 304 или неизменившийся
+    хэш таблицы парсинг пропускается и возвращается прошлый список кодов
+    """
+    with _page_states_lock:
+        state = dict(_page_states.get(url, {}))
+    
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    }
+    if state.get('codes'):
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+    
+    response, content = fetch_with_deadline(url, headers, timeout)
+    
+    if response.status_code == 304 and state.get('codes'):
+        logger.info(f"♻️ Страница не изменилась (304): {url}")
+        return copy.deepcopy(state['codes'])
+    
+    response.raise_for_status()
+    
+    digest = hashlib.sha256(_table_fragment(content, marker)).hexdigest()
+    if state.get('codes') and digest == state.get('hash'):
+        logger.info(f"♻️ Таблица с кодами не изменилась, парсинг пропущен: {url}")
+        codes = state['codes']
+    else:
+        codes = run_parser(parse_html, content)
+    
+    if codes:
+        with _page_states_lock:
+            _page_states[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'hash': digest,
+                'codes': copy.deepcopy(codes)
+            }
+    
+    return codes
+
+def _get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """Общий пул процессов для разбора (создается при первом парсинге)"""
+    global _parse_pool
+    
+    if PARSE_PROCESSES <= 0:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # spawn: форк процесса с потоками бота небезопасен
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        return _parse_pool
+
+def shutdown_parse_pool():
+    """Останавливает пул процессов разбора (при остановке бота)"""
+    global _parse_pool
+    
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            if sys.version_info >= (3, 9):
+                _parse_pool.shutdown(wait=False, cancel_futures=True)
+            else:
+                _parse_pool.shutdown(wait=False)  # cancel_futures появился только в Python 3.9
+            _parse_pool = None
+
+def _parse_to_tuples(parse_html: Callable[[bytes], List[Dict]],
+                     content: bytes) -> List[Tuple[str, str, str, str, Optional[str], str]]:
+    """
+    Выполняется в процессе пула: байты страницы -> компактные кортежи
+    (код, источник, награды, откуда взят, дата окончания, статус)
+    """
+    return [(c['code'], c['source'], json.dumps(c['gifts'], ensure_ascii=False), c.get('extracted', EXTRACTED_TABLE),
+             c.get('expires'), c.get('status', STATUS_ACTIVE))
+            for c in parse_html(content)]
+
+def run_parser(parse_html: Callable[[bytes], List[Dict]], content: bytes) -> List[Dict]:
+    """
+    Разбор страницы в пуле процессов; если пул недоступен, упал или не ответил
+    за PARSE_TIMEOUT секунд - в текущем потоке
+    """
+    pool = _get_parse_pool()
+    if pool is None:
+        return parse_html(content)
+    
+    try:
+        future = pool.submit(_parse_to_tuples, parse_html, content)
+        rows = future.result(timeout=PARSE_TIMEOUT)
+    except FuturesTimeoutError:
+        logger.warning(f"⚠️ Пул процессов разбора не ответил за {PARSE_TIMEOUT}с, разбираем в текущем потоке")
+        future.cancel()
+        # Зависший процесс держит слот пула: следующие разборы пойдут в новый пул
+        shutdown_parse_pool()
+        return parse_html(content)
+    except BrokenProcessPool as e:
+        logger.warning(f"⚠️ Пул процессов разбора упал ({e}), разбираем в текущем потоке")
+        shutdown_parse_pool()
+        return parse_html(content)
+    except Exception as e:
+        logger.warning(f"⚠️ Ошибка разбора в пуле процессов ({e}), разбираем в текущем потоке")
+        return parse_html(content)
+    
+    return [{'code': code, 'gifts': json.loads(gifts), 'source': source, 'extracted': extracted,
+             'expires': expires, 'status': status}
+            for code, source, gifts, extracted, expires, status in rows]
+
+def _header_roles(table) -> Dict[int, str]:
+    """Назначение колонок таблицы по ее заголовкам (rewards / expires / status)"""
+    header = table.find('thead') or table.find('tr')
+    if not header or not header.find('th'):
+        return {}
+    return column_roles(cell.get_text(' ') for cell in header.find_all(['th', 'td']))
+
+def _row_metadata(row, code_cell, roles: Dict[int, str], placeholder: str) -> Dict:
+    """
+    Награды, дата окончания и статус из ячеек строки с кодом
+    Без заголовков колонок: ячейка с датой - срок действия, остальные - награды
+    """
+    gifts = {}
+    expires = None
+    status = STATUS_ACTIVE
+    
+    for index, cell in enumerate(row.find_all('td')):
+        if cell is code_cell or cell.find('button'):
+            continue
+        text = ' '.join(cell.get_text(' ').split())
+        if not text:
+            continue
+        
+        role = roles.get(index) or ('expires' if is_expiry_text(text) else 'rewards')
+        if role == 'rewards':
+            gifts.update(parse_rewards(text))
+        elif role == 'expires':
+            expires = parse_expiry(text) or expires
+        if role != 'rewards' and 'expired' in text.lower():
+            status = STATUS_EXPIRED
+    
+    return {
+        'gifts': gifts or {'Unknown': placeholder},
+        'expires': expires,
+        'status': status
+    }
+
+def parse_afk_guide_fixed(url: str, timeout: float = RECEIVE_TIMEOUT) -> List[Dict]:
     """ИСПРАВЛЕННЫЙ парсер для afk.guide - использует точные селекторы таблицы"""
     logger.info(f"🔧 ИСПРАВЛЕННЫЙ парсинг afk.guide: {url}")
     
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
+        return fetch_codes_conditional(url, timeout, AFK_GUIDE_TABLE_MARKER, _parse_afk_guide_html)
         
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
+    except Exception as e:
+        logger.warning(f"⚠️ Ошибка ИСПРАВЛЕННОГО парсинга afk.guide: {e}")
+        return []
+
+def _parse_afk_guide_html(content: bytes, parser: Optional[str] = None, table_only: bool = True) -> List[Dict]:
+    """
+    Разбор страницы afk.guide (таблица ninja_table)
+    table_only - строить дерево только для фрагмента с таблицей, а не для всей страницы
+    """
+    parser = parser or HTML_PARSER
+    soup = BeautifulSoup(_table_fragment(content, AFK_GUIDE_TABLE_MARKER) if table_only else content, parser)
+    found_codes: Dict[str, Dict] = {}
+    
+    # Ищем таблицу с кодами - несколько вариантов селекторов
+    table = soup.find('table', {'data-ninja_table_instance': 'ninja_table_instance_0'})
+    
+    if not table:
+        # Пробуем альтернативные селекторы
+        table = soup.find('table', class_='ninja_table')
+        if not table:
+            table = soup.find('table')
+    
+    if not table:
+        logger.warning("❌ Не найдена таблица с кодами")
+        return []
+    
+    logger.info("✅ Найдена таблица с кодами")
+    
+    # Ищем все строки таблицы - несколько вариантов
+    rows = table.select('tr[class*="ninja_table_row_"]')
+    
+    if not rows:
+        # Альтернативный поиск строк
+        rows = table.find_all('tr')
+        logger.info(f"📊 Найдено {len(rows)} строк (альтернативный поиск)")
+    else:
+        logger.info(f"📊 Найдено {len(rows)} строк в таблице")
+    
+    roles = _header_roles(table)
+    
+    for row in rows:
+        # Ищем первую колонку с кодом - несколько вариантов
+        code_cell = row.find('td', class_='ninja_column_0')
         
-        soup = BeautifulSoup(response.content, 'html.parser')
-        found_codes = set()
+        if not code_cell:
+            # Альтернативный поиск - первая колонка
+            code_cell = row.find('td')
         
-        # Ищем таблицу с кодами - несколько вариантов селекторов
-        table = soup.find('table', {'data-ninja_table_instance': 'ninja_table_instance_0'})
+        if code_cell:
+            code = code_cell.get_text().strip()
+            
+            # Проверяем что это похоже на код (буквы/цифры, длина 3-20)
+            if code and len(code) >= 3 and len(code) <= 20 and code.replace(' ', '').isalnum():
+                found_codes[code] = _row_metadata(row, code_cell, roles, 'Parsed from afk.guide table')
+                logger.debug(f"  Найден: {code}")
+    
+    # Дополнительный поиск по всему тексту страницы
+    if len(found_codes) == 0:
+        logger.info("🔍 Дополнительный поиск кодов по всей странице...")
         
-        if not table:
-            # Пробуем альтернативные селекторы
-            table = soup.find('table', class_='ninja_table')
-            if not table:
-                table = soup.find('table')
+        # Один проход по тексту со стоп-словами; окончательно коды оценит validate_codes
+        text = BeautifulSoup(content, parser).get_text(' ')
+        text_codes = extract_candidates(text)
+        for match in text_codes:
+            logger.debug(f"  Найден (паттерн): {match}")
         
-        if not table:
-            logger.warning("❌ Не найдена таблица с кодами")
-            return []
+        logger.info(f"🔍 Дополнительный поиск нашел {len(text_codes)} кандидатов")
         
-        logger.info("✅ Найдена таблица с кодами")
+        return [{
+            'code': code,
+            'gifts': {'Unknown': 'Found in afk.guide page text'},
+            'source': 'afk.guide',
+            'extracted': EXTRACTED_TEXT,
+            'expires': None,
+            'status': STATUS_ACTIVE
+        } for code in text_codes]
+    
+    # Преобразуем в список словарей
+    codes_list = []
+    for code, metadata in found_codes.items():
+        codes_list.append(dict(metadata, code=code, source='afk.guide', extracted=EXTRACTED_TABLE))
+    
+    logger.info(f"✅ afk.guide ТОЧНЫЙ парсинг: найдено {len(codes_list)} кодов")
+    
+    # Выводим найденные коды для проверки
+    if codes_list:
+        logger.info("🔍 Найденные коды:")
+        for code_data in sorted(codes_list, key=lambda x: x['code'])[:15]:
+            logger.info(f"  📋 {code_data['code']}")
+        if len(codes_list) > 15:
+            logger.info(f"  ... и еще {len(codes_list) - 15} кодов")
+    
+    return codes_list
+
+def parse_lolvvv_fixed(url: str, timeout: float = RECEIVE_TIMEOUT) -> List[Dict]:
+    """ТОЧНЫЙ парсер для lolvvv.com - использует точные селекторы таблицы"""
+    logger.info(f"🔧 ТОЧНЫЙ парсинг lolvvv.com: {url}")
+    
+    try:
+        return fetch_codes_conditional(url, timeout, LOLVVV_TABLE_MARKERS, _parse_lolvvv_html)
+        
+    except Exception as e:
+        logger.warning(f"⚠️ Ошибка ТОЧНОГО парсинга lolvvv.com: {e}")
+        return []
+
+def _parse_lolvvv_html(content: bytes, parser: Optional[str] = None, table_only: bool = True) -> List[Dict]:
+    """
+    Разбор страницы lolvvv.com (таблицы 'Active AFK Arena Codes' и 'Expired AFK Arena Codes')
+    table_only - строить дерево только для фрагментов с таблицами, а не для всей страницы
+    """
+    parser = parser or HTML_PARSER
+    soup = BeautifulSoup(_table_fragment(content, LOLVVV_TABLE_MARKERS) if table_only else content, parser)
+    found_codes: Dict[str, Dict] = {}
+    
+    # Таблицы с кодами различаем по заголовку: активные и истекшие
+    tables = [(table, table.find('caption').get_text()) for table in soup.find_all('table') if table.find('caption')]
+    active_tables = [table for table, caption in tables if 'Active AFK Arena Codes' in caption]
+    expired_tables = [table for table, caption in tables if 'Expired AFK Arena Codes' in caption]
+    
+    if not soup.find('table'):
+        logger.warning("❌ Не найдена таблица на странице")
+    elif not active_tables:
+        logger.warning("❌ Таблица не содержит 'Active AFK Arena Codes'")
+    
+    code_tables = [(table, False) for table in active_tables] + [(table, True) for table in expired_tables]
+    for table, expired in code_tables:
+        logger.info(f"✅ Найдена таблица '{'Expired' if expired else 'Active'} AFK Arena Codes'")
         
-        # Ищем все строки таблицы - несколько вариантов
-        rows = table.find_all('tr', class_=lambda x: x and 'ninja_table_row_' in x)
+        # Ищем все строки в tbody
+        tbody = table.find('tbody')
+        if not tbody:
+            logger.warning("❌ Не найден tbody в таблице")
+            continue
         
-        if not rows:
-            # Альтернативный поиск строк
-            rows = table.find_all('tr')
-            logger.info(f"📊 Найдено {len(rows)} строк (альтернативный поиск)")
-        else:
-            logger.info(f"📊 Найдено {len(rows)} строк в таблице")
+        rows = tbody.find_all('tr')
+        logger.info(f"📊 Найдено {len(rows)} строк в таблице")
+        roles = _header_roles(table)
         
         for row in rows:
-            # Ищем первую колонку с кодом - несколько вариантов
-            code_cell = row.find('td', class_='ninja_column_0')
-            
-            if not code_cell:
-                # Альтернативный поиск - первая колонка
-                code_cell = row.find('td')
+            # Код в колонке td.select-all (в таблице истекших - в первой колонке)
+            code_cell = row.find('td', class_='select-all') or (row.find('td') if expired else None)
             
             if code_cell:
                 code = code_cell.get_text().strip()
                 
-                # Проверяем что это похоже на код (буквы/цифры, длина 3-20)
-                if code and len(code) >= 3 and len(code) <= 20 and code.replace(' ', '').isalnum():
-                    found_codes.add(code)
-                    logger.debug(f"  Найден: {code}")
-        
-        # Дополнительный поиск по всему тексту страницы
-        if len(found_codes) == 0:
-            logger.info("🔍 Дополнительный поиск кодов по всей странице...")
-            
-            # Ищем коды по паттернам
-            import re
-            text = soup.get_text()
-            
-            # Паттерны для кодов AFK Arena
-            patterns = [
-                r'\b[A-Z0-9]{6,15}\b',  # Заглавные буквы и цифры
-                r'\b[a-z0-9]{6,15}\b',  # Строчные буквы и цифры
-                r'\b[A-Za-z0-9]{6,15}\b'  # Смешанный регистр
-            ]
+                if code and len(code) >= 3:
+                    metadata = _row_metadata(row, code_cell, roles, 'Parsed from lolvvv.com table')
+                    if expired:
+                        metadata['status'] = STATUS_EXPIRED
+                    # Код, перенесенный сайтом в истекшие, остается истекшим
+                    found_codes[code] = metadata
+                    logger.debug(f"  Найден: {code} ({metadata['status']})")
+    
+    # Дополнительный поиск по кнопкам копирования (как резерв)
+    copy_buttons = soup.find_all('button', class_='btn rounded')
+    if copy_buttons:
+        logger.info(f"🔍 Найдено {len(copy_buttons)} кнопок копирования")
+        
+        for button in copy_buttons:
+            # Ищем код в той же строке что и кнопка
+            row = button.find_parent('tr')
+            if row:
+                code_cell = row.find('td', class_='select-all')
+                if code_cell:
+                    code = code_cell.get_text().strip()
+                    if code and len(code) >= 3 and code not in found_codes:
+                        found_codes[code] = _row_metadata(row, code_cell, {}, 'Parsed from lolvvv.com table')
+    
+    # Преобразуем в список словарей
+    codes_list = []
+    for code, metadata in found_codes.items():
+        codes_list.append(dict(metadata, code=code, source='lolvvv.com', extracted=EXTRACTED_TABLE))
+    
+    expired_count = sum(code_data['status'] == STATUS_EXPIRED for code_data in codes_list)
+    logger.info(f"✅ lolvvv.com ТОЧНЫЙ парсинг: найдено {len(codes_list)} кодов (истекших {expired_count})")
+    
+    # Выводим найденные коды для проверки
+    if codes_list:
+        logger.info("🔍 Найденные коды:")
+        for code_data in sorted(codes_list, key=lambda x: x['code'])[:10]:
+            logger.info(f"  📋 {code_data['code']}")
+        if len(codes_list) > 10:
+            logger.info(f"  ... и еще {len(codes_list) - 10} кодов")
+    
+    return codes_list
+
+class ScrapeCache:
+    """
+    Общий для всех пользователей кэш распарсенных кодов по источникам
+    - свежий список (моложе ttl) отдается сразу
+    - устаревший (моложе ttl + stale_ttl) отдается сразу, а обновление идет в фоне
+    - при отсутствии данных парсинг выполняет один поток, остальные ждут его результат
+    Пустые результаты (ошибка сайта) не кэшируются
+    """
+    
+    def __init__(self, ttl: float = SCRAPE_CACHE_TTL, stale_ttl: float = SCRAPE_CACHE_STALE_TTL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries: Dict[str, tuple] = {}  # источник -> (коды, время получения)
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+    
+    def _refresh(self, name: str, fetch: Callable[[], List[Dict]], future: Future):
+        """Парсинг источника с раздачей результата всем ожидающим"""
+        try:
+            codes = fetch()
+            if codes:
+                with self._lock:
+                    self._entries[name] = (codes, time.monotonic())
+            future.set_result(codes)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop(name, None)
+    
+    def get(self, name: str, fetch: Callable[[], List[Dict]], force: bool = False) -> List[Dict]:
+        """Коды источника name; fetch вызывается только при устаревании кэша"""
+        with self._lock:
+            entry = self._entries.get(name)
+            age = time.monotonic() - entry[1] if entry else None
             
-            for pattern in patterns:
-                matches = re.findall(pattern, text)
-                for match in matches:
-                    # Фильтруем очевидно неподходящие коды
-                    if (len(match) >= 6 and len(match) <= 15 and 
-                        not match.lower() in ['redemption', 'codes', 'arena', 'guide', 'table', 'column']):
-                        found_codes.add(match)
-                        logger.debug(f"  Найден (паттерн): {match}")
+            if entry and not force and age < self.ttl:
+                logger.info(f"💾 {name}: коды из кэша ({age:.0f}с назад)")
+                return copy.deepcopy(entry[0])
             
-            logger.info(f"🔍 Дополнительный поиск нашел {len(found_codes)} кодов")
-        
-        # Преобразуем в список словарей
-        codes_list = []
-        for code in found_codes:
-            codes_list.append({
-                'code': code,
-                'gifts': {'Unknown': 'Parsed from afk.guide table'},
-                'source': 'afk.guide'
-            })
-        
-        logger.info(f"✅ afk.guide ТОЧНЫЙ парсинг: найдено {len(codes_list)} кодов")
+            future = self._inflight.get(name)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[name] = future
         
-        # Выводим найденные коды для проверки
-        if codes_list:
-            logger.info("🔍 Найденные коды:")
-            for code_data in sorted(codes_list, key=lambda x: x['code'])[:15]:
-                logger.info(f"  📋 {code_data['code']}")
-            if len(codes_list) > 15:
-                logger.info(f"  ... и еще {len(codes_list) - 15} кодов")
+        if entry and not force and age < self.ttl + self.stale_ttl:
+            # Отдаем устаревшие данные, обновляем в фоне
+            if leader:
+                logger.info(f"🔄 {name}: кэш устарел ({age:.0f}с), обновляем в фоне")
+                threading.Thread(target=self._refresh, args=(name, fetch, future),
+                                 name=f'scrape-refresh-{name}', daemon=True).start()
+            return copy.deepcopy(entry[0])
         
-        return codes_list
-        
-    except Exception as e:
-        logger.warning(f"⚠️ Ошибка ИСПРАВЛЕННОГО парсинга afk.guide: {e}")
-        return []
+        if leader:
+            self._refresh(name, fetch, future)
+        else:
+            logger.info(f"⏳ {name}: ждем парсинг, запущенный другим пользователем")
+        return copy.deepcopy(future.result())
+    
+    def invalidate(self, name: Optional[str] = None):
+        """Сбрасывает кэш источника (или всех источников)"""
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
 
-def parse_lolvvv_fixed(url: str) -> List[Dict]:
-    """ТОЧНЫЙ парсер для lolvvv.com - использует точные селекторы таблицы"""
-    logger.info(f"🔧 ТОЧНЫЙ парсинг lolvvv.com: {url}")
+scrape_cache = ScrapeCache()
+
+class CodeSource:
+    """
+    Источник кодов в реестре
+    fetcher(source, timeout) загружает данные и разбирает их функцией parser,
+    priority определяет порядок объединения (код из более приоритетного источника
+    сохраняет свои данные), timeout - лимит ожидания ответа источника
+    """
     
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        response = requests.get(url, headers=headers, timeout=15)
+    def __init__(self, name: str, url: str, fetcher: Callable[['CodeSource', float], List[Dict]],
+                 parser: Callable, timeout: float = RECEIVE_TIMEOUT, priority: int = 0, marker=b''):
+        self.name = name
+        self.url = url
+        self.fetcher = fetcher
+        self.parser = parser
+        self.timeout = timeout
+        self.priority = priority
+        self.marker = marker
+    
+    def fetch(self, timeout: Optional[float] = None) -> List[Dict]:
+        """Коды источника; ошибки источника не мешают остальным"""
+        try:
+            return self.fetcher(self, timeout or self.timeout)
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка источника {self.name}: {e}")
+            return []
+
+def fetch_html_source(source: CodeSource, timeout: float) -> List[Dict]:
+    """Страница с таблицей кодов: условный запрос + разбор таблицы"""
+    logger.info(f"🔧 Парсинг {source.name}: {source.url}")
+    return fetch_codes_conditional(source.url, timeout, source.marker, source.parser)
+
+# Состояние лент: URL -> ETag, Last-Modified, последняя дата, прочитанные id и найденные коды
+_feed_states: Dict[str, Dict] = {}
+_feed_states_lock = threading.Lock()
+
+def _parse_feed_entry(entry) -> List[str]:
+    """Кандидаты в коды из заголовка и текста записи ленты"""
+    parts = [entry.get('title', ''), entry.get('summary', '')]
+    parts += [content.get('value', '') for content in entry.get('content', [])]
+    text = BeautifulSoup(' '.join(parts), 'html.parser').get_text(' ')
+    return extract_candidates(text)
+
+def _entry_timestamp(entry) -> Optional[float]:
+    published = entry.get('published_parsed') or entry.get('updated_parsed')
+    return float(timegm(published)) if published else None
+
+def fetch_feed_source(source: CodeSource, timeout: float) -> List[Dict]:
+    """
+    RSS/Atom лента: разбираются только записи новее последней прочитанной
+    (по id и дате), коды из прошлых записей берутся из состояния ленты
+    """
+    if feedparser is None:
+        logger.warning(f"⚠️ feedparser не установлен - лента {source.name} пропущена")
+        return []
+    
+    with _feed_states_lock:
+        state = copy.deepcopy(_feed_states.get(source.url, {}))
+    codes: Dict[str, Dict] = state.get('codes', {})
+    seen_ids = deque(state.get('seen_ids', []), maxlen=FEED_SEEN_IDS_LIMIT)
+    last_published = state.get('last_published')
+    
+    headers = {'User-Agent': HEADERS['User-Agent']}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    
+    response, content = fetch_with_deadline(source.url, headers, timeout)
+    
+    new_entries = 0
+    if response.status_code == 304:
+        logger.info(f"♻️ Лента {source.name} не изменилась (304)")
+    else:
         response.raise_for_status()
+        feed = feedparser.parse(content)
+        now = time.time()
         
-        soup = BeautifulSoup(response.content, 'html.parser')
-        found_codes = set()
-        
-        # Ищем таблицу с кодами по точному селектору
-        table = soup.find('table')
-        
-        if table:
-            # Проверяем что это правильная таблица по заголовку
-            caption = table.find('caption')
-            if caption and 'Active AFK Arena Codes' in caption.get_text():
-                logger.info("✅ Найдена таблица 'Active AFK Arena Codes'")
-                
-                # Ищем все строки в tbody
-                tbody = table.find('tbody')
-                if tbody:
-                    rows = tbody.find_all('tr')
-                    logger.info(f"📊 Найдено {len(rows)} строк в таблице")
-                    
-                    for row in rows:
-                        # Ищем первую колонку с кодом (td.select-all)
-                        code_cell = row.find('td', class_='select-all')
-                        
-                        if code_cell:
-                            code = code_cell.get_text().strip()
-                            
-                            if code and len(code) >= 3:
-                                found_codes.add(code)
-                                logger.debug(f"  Найден: {code}")
-                else:
-                    logger.warning("❌ Не найден tbody в таблице")
-            else:
-                logger.warning("❌ Таблица не содержит 'Active AFK Arena Codes'")
-        else:
-            logger.warning("❌ Не найдена таблица на странице")
-        
-        # Дополнительный поиск по кнопкам копирования (как резерв)
-        copy_buttons = soup.find_all('button', class_='btn rounded')
-        if copy_buttons:
-            logger.info(f"🔍 Найдено {len(copy_buttons)} кнопок копирования")
+        for entry in feed.entries:
+            entry_id = entry.get('id') or entry.get('link') or entry.get('title')
+            published = _entry_timestamp(entry)
+            if entry_id in seen_ids or (published and last_published and published < last_published):
+                continue
+            
+            new_entries += 1
+            seen_ids.append(entry_id)
+            if published:
+                last_published = max(published, last_published or 0)
             
-            for button in copy_buttons:
-                # Ищем код в той же строке что и кнопка
-                row = button.find_parent('tr')
-                if row:
-                    code_cell = row.find('td', class_='select-all')
-                    if code_cell:
-                        code = code_cell.get_text().strip()
-                        if code and len(code) >= 3:
-                            found_codes.add(code)
-        
-        # Преобразуем в список словарей
-        codes_list = []
-        for code in found_codes:
-            codes_list.append({
-                'code': code,
-                'gifts': {'Unknown': 'Parsed from lolvvv.com table'},
-                'source': 'lolvvv.com'
-            })
-        
-        logger.info(f"✅ lolvvv.com ТОЧНЫЙ парсинг: найдено {len(codes_list)} кодов")
-        
-        # Выводим найденные коды для проверки
-        if codes_list:
-            logger.info("🔍 Найденные коды:")
-            for code_data in sorted(codes_list, key=lambda x: x['code'])[:10]:
-                logger.info(f"  📋 {code_data['code']}")
-            if len(codes_list) > 10:
-                logger.info(f"  ... и еще {len(codes_list) - 10} кодов")
-        
-        return codes_list
+            for code in source.parser(entry):
+                codes.setdefault(code_key(code), {
+                    'code': code,
+                    'gifts': {'Unknown': f'Found in {source.name} feed'},
+                    'source': source.name,
+                    'extracted': EXTRACTED_TEXT,
+                    'expires': None,
+                    'status': STATUS_ACTIVE,
+                    'seen_at': published or now
+                })
         
-    except Exception as e:
-        logger.warning(f"⚠️ Ошибка ТОЧНОГО парсинга lolvvv.com: {e}")
-        return []
+        # Коды из давних записей забываем
+        codes = {key: record for key, record in codes.items() if now - record['seen_at'] < FEED_CODE_MAX_AGE}
+        logger.info(f"📰 Лента {source.name}: новых записей {new_entries}, кодов в ленте {len(codes)}")
+    
+    with _feed_states_lock:
+        _feed_states[source.url] = {
+            'etag': response.headers.get('ETag') or state.get('etag'),
+            'last_modified': response.headers.get('Last-Modified') or state.get('last_modified'),
+            'last_published': last_published,
+            'seen_ids': list(seen_ids),
+            'codes': codes
+        }
+    
+    return [dict(record) for record in codes.values()]
+
+# Реестр источников кодов: имя -> CodeSource
+SOURCE_REGISTRY: Dict[str, CodeSource] = {}
 
-def get_all_codes_fixed() -> List[Dict]:
-    """ИСПРАВЛЕННЫЙ сбор кодов с ВСЕХ сайтов без дубликатов"""
-    logger.info("🔧 ИСПРАВЛЕННЫЙ ПАРСИНГ КОДОВ С ДВУХ САЙТОВ")
+def register_source(source: CodeSource) -> CodeSource:
+    """Добавляет источник в реестр (get_all_codes_fixed опрашивает все источники параллельно)"""
+    SOURCE_REGISTRY[source.name] = source
+    return source
+
+register_source(CodeSource('afk.guide', FULL_CODE_WEBSITES[0], fetch_html_source, _parse_afk_guide_html,
+                           priority=20, marker=AFK_GUIDE_TABLE_MARKER))
+register_source(CodeSource('lolvvv.com', FULL_CODE_WEBSITES[1], fetch_html_source, _parse_lolvvv_html,
+                           priority=10, marker=LOLVVV_TABLE_MARKERS))
+for feed_url in CODE_FEED_URLS:
+    feed_name = (urlparse(feed_url).netloc + urlparse(feed_url).path).rstrip('/')
+    register_source(CodeSource(feed_name, feed_url, fetch_feed_source, _parse_feed_entry,
+                               timeout=FEED_TIMEOUT, priority=5))
+
+def scrape_source(name: str, timeout: Optional[float] = None, force: bool = False,
+                  validate: bool = True) -> List[Dict]:
+    """
+    Коды одного источника через общий кэш, проверенные validate_codes
+    validate=False - без проверки: сборщики всех источников проверяют коды после
+    объединения, когда видно подтверждение другими сайтами
+    """
+    source = SOURCE_REGISTRY[name]
+    codes_list = scrape_cache.get(name, lambda: source.fetch(timeout), force=force)
+    return validate_codes(codes_list) if validate else codes_list
+
+def _merge_metadata(existing: Dict, code_data: Dict):
+    """
+    Дополняет запись кода данными другого источника: истекший хотя бы на одном сайте
+    код считается истекшим, награды и дата берутся, если их не было
+    """
+    if code_data.get('status') == STATUS_EXPIRED:
+        existing['status'] = STATUS_EXPIRED
+    if not existing.get('expires') and code_data.get('expires'):
+        existing['expires'] = code_data['expires']
+    if 'Unknown' in existing.get('gifts', {}) and 'Unknown' not in code_data.get('gifts', {'Unknown': ''}):
+        existing['gifts'] = dict(code_data['gifts'])
+
+def _merge_source_codes(codes_by_key: Dict[str, Dict], codes_list: List[Dict], source_name: str) -> List[Dict]:
+    """Добавляет коды источника в общий индекс, возвращает записи кодов, которых еще не было"""
+    added = []
+    for code_data in codes_list:
+        key = code_key(code_data.get('code'))
+        if not key:
+            continue
+        existing = codes_by_key.get(key)
+        if existing is None:
+            code_data['sources'] = [code_data.get('source', source_name)]
+            codes_by_key[key] = code_data
+            added.append(code_data)
+        elif source_name not in existing['sources']:
+            # Код есть на нескольких сайтах - запоминаем все источники (выше приоритет)
+            existing['sources'].append(source_name)
+            _merge_metadata(existing, code_data)
+    
+    logger.info(f"📊 {source_name}: добавлено {len(added)} уникальных кодов")
+    return added
+
+def iter_codes_fixed(deadline: float = SCRAPE_DEADLINE, source_timeout: Optional[float] = None) -> Iterator[List[Dict]]:
+    """
+    Потоковый сбор кодов со всех источников реестра: пачка новых проверенных кодов
+    отдается сразу, как ответил очередной источник (в порядке ответа, а не приоритета),
+    чтобы активация начиналась, пока медленные сайты еще загружаются
+    Код из текста страницы, отброшенный validate_codes, пересматривается, когда
+    его подтвердит другой источник
+    """
+    futures = {_scrape_pool.submit(scrape_source, name, source_timeout, validate=False): name
+               for name in SOURCE_REGISTRY}
+    codes_by_key: Dict[str, Dict] = {}
+    unconfirmed: List[Dict] = []
+    
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            candidates = unconfirmed + _merge_source_codes(codes_by_key, future.result(), futures[future])
+            
+            # Форма кода - по истории активаций и табличным кодам всех уже ответивших источников
+            model = shape_model(code_data['code'] for code_data in codes_by_key.values()
+                                if code_data.get('extracted', EXTRACTED_TABLE) == EXTRACTED_TABLE)
+            accepted = validate_codes(candidates, model)
+            accepted_ids = {id(code_data) for code_data in accepted}
+            unconfirmed = [code_data for code_data in candidates if id(code_data) not in accepted_ids]
+            
+            if accepted:
+                yield accepted
+    except FuturesTimeoutError:
+        for future, source_name in futures.items():
+            if not future.done():
+                # cancel() снимает только еще не начатую загрузку: начатая не прерывается,
+                # а сама обрывается по таймауту источника (fetch_with_deadline)
+                future.cancel()
+                logger.warning(f"⏱️ {source_name} не ответил за {deadline}с - результат не ждем")
+
+def get_all_codes_fixed(deadline: float = SCRAPE_DEADLINE, source_timeout: Optional[float] = None) -> List[Dict]:
+    """
+    ИСПРАВЛЕННЫЙ сбор кодов со ВСЕХ источников реестра без дубликатов
+    Источники опрашиваются параллельно: source_timeout - лимит ожидания ответа одного
+    источника (по умолчанию свой у каждого), deadline - общий лимит; источники,
+    не уложившиеся в него, пропускаются (частичный результат)
+    """
+    sources = sorted(SOURCE_REGISTRY, key=lambda name: -SOURCE_REGISTRY[name].priority)
+    
+    logger.info(f"🔧 ИСПРАВЛЕННЫЙ ПАРСИНГ КОДОВ С {len(sources)} ИСТОЧНИКОВ")
     logger.info("=" * 50)
     
     all_codes = []
-    unique_codes: Set[str] = set()
+    codes_by_key: Dict[str, Dict] = {}
     
-    # Парсим afk.guide
-    afk_guide_codes = parse_afk_guide_fixed(FULL_CODE_WEBSITES[0])
+    started = time.monotonic()
+    futures = [_scrape_pool.submit(scrape_source, name, source_timeout, validate=False) for name in sources]
+    wait(futures, timeout=deadline)
     
-    # Парсим lolvvv.com
-    lolvvv_codes = parse_lolvvv_fixed(FULL_CODE_WEBSITES[1])
+    results = []
+    for source_name, future in zip(sources, futures):
+        if future.done():
+            results.append((future.result(), source_name))
+        else:
+            # Начатая загрузка не прерывается cancel() - она оборвется по таймауту источника
+            future.cancel()
+            logger.warning(f"⏱️ {source_name} не ответил за {deadline}с - результат не ждем")
     
-    # Объединяем коды без дубликатов
-    for codes_list, source_name in [(afk_guide_codes, 'afk.guide'), (lolvvv_codes, 'lolvvv.com')]:
-        new_codes_count = 0
-        for code_data in codes_list:
-            code = code_data.get('code', '').strip()
-            if code and code.lower() not in [c.lower() for c in unique_codes]:
-                unique_codes.add(code)
-                all_codes.append(code_data)
-                new_codes_count += 1
-        
-        logger.info(f"📊 {source_name}: добавлено {new_codes_count} уникальных кодов")
+    logger.info(f"⏱️ Сайты опрошены за {time.monotonic() - started:.1f}с")
+    
+    # Объединяем коды без дубликатов (в порядке приоритета источников, а не завершения)
+    for codes_list, source_name in results:
+        all_codes.extend(_merge_source_codes(codes_by_key, codes_list, source_name))
     
-    logger.info(f"📥 ИТОГО: {len(all_codes)} уникальных кодов с двух сайтов")
+    # Коды из текста страниц без подтверждения не тратят слоты активации
+    all_codes = validate_codes(all_codes)
+    
+    logger.info(f"📥 ИТОГО: {len(all_codes)} уникальных кодов с {len(results)} источников")
+    expired_count = sum(is_expired(code_data) for code_data in all_codes)
+    if expired_count:
+        logger.info(f"⌛ Из них истекших: {expired_count} (активироваться не будут)")
     
     # Показываем статистику по источникам
     sources_stats = {}
@@ -428,10 +971,8 @@ def main():
             
             # Проверяем есть ли исправленные коды
             fixed_codes = ['vdj82fht4r3000', 'ujqrukd2at1x', 'u4fctemje23x']
-            found_fixed = []
-            for fixed in fixed_codes:
-                if any(code_data.get('code', '').lower() == fixed.lower() for code_data in all_codes):
-                    found_fixed.append(fixed)
+            found_keys = {code_key(code_data.get('code')) for code_data in all_codes}
+            found_fixed = [fixed for fixed in fixed_codes if code_key(fixed) in found_keys]
             
             if found_fixed:
                 print(f"\n🔧 Найдены ИСПРАВЛЕННЫЕ коды: {', '.join(found_fixed)}")
@@ -440,9 +981,15 @@ def main():
             return
         
         # Запускаем активацию через прямой API
-        from direct_lilith_api import LilithAPI
+        from direct_lilith_api import LilithAPI, get_pacer, plan_redemption
+        
+        # Истекшие коды не отправляем (как и бот), остальные - по убыванию ценности
+        codes, _ = plan_redemption(all_codes, get_pacer(uid))
+        if not codes:
+            print("⌛ Все найденные коды истекли - активировать нечего")
+            return
         
-        print(f"\n🚀 ЗАПУСКАЕМ АКТИВАЦИЮ {len(all_codes)} КОДОВ!")
+        print(f"\n🚀 ЗАПУСКАЕМ АКТИВАЦИЮ {len(codes)} КОДОВ!")
         print("⏰ У вас есть ~2 минуты с момента генерации кода")
         print("-" * 50)
         
@@ -467,9 +1014,6 @@ def main():
             main_mark = " (Основной)" if acc.get('is_main') else ""
             logger.info(f"  - {acc.get('name')} - Уровень {acc.get('level')}, Сервер {acc.get('svr_id')}{main_mark}")
         
-        # Извлекаем только коды из данных
-        codes = [code_data['code'] for code_data in all_codes]
-        
         # Активируем коды для всех аккаунтов
         logger.info(f"🎁 Начинаем активацию {len(codes)} кодов...")
         stats = api.redeem_codes_for_all_accounts(codes)
@@ -479,7 +1023,10 @@ def main():
         print(f"\n📊 ИТОГОВАЯ СТАТИСТИКА:")
         print(f"  ✅ Успешно активировано: {stats['success']}")
         print(f"  ❌ Неудачных попыток: {stats['failed']}")
+        print(f"  ♻️ Уже использовано ранее: {stats['already_used']}")
         print(f"  📈 Всего попыток: {total_attempts}")
+        if stats.get("not_attempted_codes"):
+            print(f"  ⏸ Не обработано (истек Verification Code): {len(stats['not_attempted_codes'])}")
         print(f"  📊 Процент успеха: {(stats['success']/total_attempts*100):.1f}%" if total_attempts > 0 else "  📊 Процент успеха: 0%")
         
         if stats["success"] > 0:
@@ -8,8 +8,9 @@ import asyncio
 import logging
 import os
 import sys
+import threading
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional, Set
 
 from telegram import (
     Update, 
@@ -30,8 +31,23 @@ from telegram.ext import (
 
 # Импортируем нашу логику
 try:
-    from direct_lilith_api import LilithAPI
-    from run_direct_api_fixed import get_all_codes_fixed, parse_afk_guide_fixed, parse_lolvvv_fixed
+    from direct_lilith_api import (
+        AsyncLilithAPI,
+        close_shared_session,
+        dead_codes,
+        group_accounts_by_target,
+        order_codes_by_value,
+        plan_redemption,
+        roster_cache,
+        session_deadline,
+        token_cache
+    )
+    from code_identity import CodeIndex, code_key, dedupe_records
+    from code_history import STATUS_FAILED, STATUS_USED, CodeHistory
+    from code_metadata import describe_rewards, is_expired
+    from code_validator import SHAPE_HISTORY_LIMIT, learn_codes
+    from loop_guard import LoopWatchdog, run_blocking, run_scrape, shutdown_blocking_pool
+    from run_direct_api_fixed import get_all_codes_fixed, iter_codes_fixed, scrape_source, shutdown_parse_pool
 except ImportError as e:
     print(f"❌ Ошибка импорта: {e}")
     print("📁 Убедитесь что файлы direct_lilith_api.py и run_direct_api_fixed.py существуют")
@@ -55,13 +71,19 @@ WAITING_UID, WAITING_VERIFICATION_CODE, WAITING_BOT_TOKEN = range(3)
 user_data: Dict[int, Dict] = {}
 
 # Файлы для хранения данных о кодах
-USED_CODES_FILE = 'used_codes.json'
+CODE_HISTORY_DB = 'code_history.db'  # История кодов и очередь отложенных кодов по UID (SQLite)
+USED_CODES_FILE = 'used_codes.json'  # Старый формат истории - переносится в CODE_HISTORY_DB при запуске
 FAILED_CODES_FILE = 'failed_codes.json'
 USER_SETTINGS_FILE = 'user_settings.json'  # Новый файл для настроек пользователей
+PENDING_CODES_FILE = 'pending_codes.json'  # Старый формат очереди отложенных кодов - тоже переносится в базу
+
+# Настройки пользователей - один JSON на всех: чтение-изменение-запись только под замком
+_user_settings_lock = threading.Lock()
 
 # Настройки активации
 BATCH_SIZE = 25  # Количество кодов за один раз
 MAX_CODES_PER_SESSION = 30  # Максимум кодов за сессию
+SESSION_BUSY_TEXT = "⏳ Для этого UID уже идет активация кодов. Дождись ее окончания и попробуй снова."
 
 def load_user_settings() -> Dict[int, Dict]:
     """Загружает настройки пользователей из файла"""
@@ -80,8 +102,11 @@ def save_user_settings(settings: Dict[int, Dict]):
         import json
         # Конвертируем ключи в строки для JSON
         settings_str_keys = {str(k): v for k, v in settings.items()}
-        with open(USER_SETTINGS_FILE, 'w', encoding='utf-8') as f:
+        # Через временный файл: недописанный файл прочитался бы как пустой и стер бы все настройки
+        tmp_path = f"{USER_SETTINGS_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(settings_str_keys, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp_path, USER_SETTINGS_FILE)
     except Exception as e:
         logger.error(f"Ошибка сохранения настроек пользователей: {e}")
 
@@ -93,122 +118,209 @@ def get_user_uid(user_id: int) -> Optional[str]:
 
 def save_user_uid(user_id: int, uid: str):
     """Сохраняет UID пользователя"""
-    settings = load_user_settings()
-    if str(user_id) not in settings:
-        settings[str(user_id)] = {}
-    settings[str(user_id)]['uid'] = uid
-    settings[str(user_id)]['last_updated'] = datetime.now().isoformat()
-    save_user_settings(settings)
-
-def load_used_codes() -> Dict[str, List[str]]:
-    """Загружает список использованных кодов из файла"""
-    try:
-        import json
-        if os.path.exists(USED_CODES_FILE):
-            with open(USED_CODES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка загрузки использованных кодов: {e}")
-    return {}
-
-def save_used_codes(used_codes: Dict[str, List[str]]):
-    """Сохраняет список использованных кодов в файл"""
-    try:
-        import json
-        with open(USED_CODES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(used_codes, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения использованных кодов: {e}")
+    with _user_settings_lock:
+        settings = load_user_settings()
+        if str(user_id) not in settings:
+            settings[str(user_id)] = {}
+        settings[str(user_id)]['uid'] = uid
+        settings[str(user_id)]['last_updated'] = datetime.now().isoformat()
+        save_user_settings(settings)
 
-def load_failed_codes() -> Dict[str, List[str]]:
-    """Загружает список неуспешных кодов из файла"""
-    try:
-        import json
-        if os.path.exists(FAILED_CODES_FILE):
-            with open(FAILED_CODES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка загрузки неуспешных кодов: {e}")
-    return {}
-
-def save_failed_codes(failed_codes: Dict[str, List[str]]):
-    """Сохраняет список неуспешных кодов в файл"""
-    try:
-        import json
-        with open(FAILED_CODES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(failed_codes, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        logger.error(f"Ошибка сохранения неуспешных кодов: {e}")
+# История кодов: первичный ключ (uid, code_key), каждый вызов затрагивает только свои коды
+code_history = CodeHistory(CODE_HISTORY_DB, used_json=USED_CODES_FILE, failed_json=FAILED_CODES_FILE,
+                           pending_json=PENDING_CODES_FILE)
 
 def add_used_codes(uid: str, codes: List[str]):
     """Добавляет коды в список использованных для конкретного UID"""
-    used_codes = load_used_codes()
-    if uid not in used_codes:
-        used_codes[uid] = []
-    
-    # Добавляем новые коды, избегая дубликатов
-    for code in codes:
-        if code.lower() not in [c.lower() for c in used_codes[uid]]:
-            used_codes[uid].append(code)
-    
-    save_used_codes(used_codes)
-    logger.info(f"Добавлено {len(codes)} использованных кодов для UID {uid}")
+    added = code_history.add(uid, codes, STATUS_USED)
+    logger.info(f"Добавлено {added} использованных кодов для UID {uid}")
 
 def add_failed_codes(uid: str, codes: List[str]):
     """Добавляет коды в список неуспешных для конкретного UID"""
-    failed_codes = load_failed_codes()
-    if uid not in failed_codes:
-        failed_codes[uid] = []
-    
-    # Добавляем новые коды, избегая дубликатов
-    for code in codes:
-        if code.lower() not in [c.lower() for c in failed_codes[uid]]:
-            failed_codes[uid].append(code)
-    
-    save_failed_codes(failed_codes)
-    logger.info(f"Добавлено {len(codes)} неуспешных кодов для UID {uid}")
+    added = code_history.add(uid, codes, STATUS_FAILED)
+    logger.info(f"Добавлено {added} неуспешных кодов для UID {uid}")
 
 def get_used_codes(uid: str) -> List[str]:
     """Получает список использованных кодов для конкретного UID"""
-    used_codes = load_used_codes()
-    return used_codes.get(uid, [])
+    return code_history.codes(uid, STATUS_USED)
 
 def get_failed_codes(uid: str) -> List[str]:
     """Получает список неуспешных кодов для конкретного UID"""
-    failed_codes = load_failed_codes()
-    return failed_codes.get(uid, [])
+    return code_history.codes(uid, STATUS_FAILED)
+
+def count_used_codes(uid: str) -> int:
+    return code_history.count(uid, STATUS_USED)
+
+def count_failed_codes(uid: str) -> int:
+    return code_history.count(uid, STATUS_FAILED)
 
 def filter_new_codes(uid: str, codes: List[Dict]) -> List[Dict]:
-    """Фильтрует коды, исключая уже использованные и неуспешные"""
-    used_codes = get_used_codes(uid)
-    failed_codes = get_failed_codes(uid)
+    """Фильтрует коды, исключая уже использованные, неуспешные, истекшие и глобально мертвые"""
+    codes = dedupe_records(codes)
     
-    # Объединяем списки и приводим к нижнему регистру
-    excluded_codes = used_codes + failed_codes
-    excluded_codes_lower = [c.lower() for c in excluded_codes]
+    # Из истории читаются только проверяемые коды (по первичному ключу), а не вся история UID
+    known_keys = code_history.known_keys(uid, [code_data.get('code', '') for code_data in codes])
     
     new_codes = []
+    dead_count = 0
+    expired_count = 0
     for code_data in codes:
         code = code_data.get('code', '').strip()
-        if code and code.lower() not in excluded_codes_lower:
+        if code_key(code) not in known_keys:
+            # Истекшие по данным сайтов коды не стоят попытки активации
+            if is_expired(code_data):
+                expired_count += 1
+                continue
+            # Коды, признанные мертвыми у других пользователей, тоже пропускаем
+            if dead_codes.is_dead(code):
+                dead_count += 1
+                continue
             new_codes.append(code_data)
     
+    # Самые ценные коды первыми (в списках бота и в очереди активации)
+    new_codes = order_codes_by_value(new_codes)
+    
     logger.info(f"Отфильтровано: {len(codes)} → {len(new_codes)} новых кодов для UID {uid}")
-    logger.info(f"Исключено: {len(used_codes)} использованных + {len(failed_codes)} неуспешных")
+    logger.info(f"Исключено: {len(known_keys)} использованных или неуспешных + "
+                f"{expired_count} истекших + {dead_count} глобально мертвых")
     return new_codes
 
-def clear_failed_codes(uid: str):
-    """Очищает список неуспешных кодов для UID (для повторной попытки)"""
-    failed_codes = load_failed_codes()
-    if uid in failed_codes:
-        del failed_codes[uid]
-        save_failed_codes(failed_codes)
+def save_batch_results(uid: str, stats: Dict):
+    """Сохраняет итоги батча активации в историю кодов UID"""
+    # Уже активированные ранее коды тоже больше не нужно пробовать
+    used = stats["successful_codes"] + stats.get("already_used_codes", [])
+    if used:
+        add_used_codes(uid, used)
+        learn_codes(used)
+        logger.info(f"Сохранено {len(used)} успешных кодов для UID {uid}")
+    
+    # Коды без окончательного вердикта (remaining_codes) не сохраняем как неуспешные
+    if stats["failed_codes"]:
+        add_failed_codes(uid, stats["failed_codes"])
+        logger.info(f"Сохранено {len(stats['failed_codes'])} неуспешных кодов для UID {uid}")
+
+def format_batch_interruption(stats: Dict) -> str:
+    """Текст для отчета о досрочно остановленном или отложенном батче"""
+    text = ""
+    if stats.get("already_used_codes"):
+        text += f"\n♻️ {len(stats['already_used_codes'])} кодов уже были активированы ранее"
+    if stats.get("aborted"):
+        text += "\n⛔ Verification Code истек во время активации - батч остановлен"
+    if stats.get("skipped_dead_codes"):
+        text += f"\n💀 {len(stats['skipped_dead_codes'])} кодов пропущены как мертвые у других игроков"
+    if stats.get("not_attempted_codes"):
+        text += f"\n💡 {len(stats['not_attempted_codes'])} кодов не поместились в эту сессию"
+    if stats.get("remaining_codes"):
+        text += f"\n⏸ {len(stats['remaining_codes'])} кодов не обработаны и не помечены неуспешными"
+    if stats.get("not_attempted_codes") or stats.get("remaining_codes"):
+        text += "\n📥 Они сохранены в очередь и активируются первыми при вводе нового Verification Code"
+    return text
+
+def clear_failed_codes(uid: str) -> int:
+    """Очищает список неуспешных кодов для UID (для повторной попытки), возвращает число удаленных кодов"""
+    codes_count = code_history.clear(uid, STATUS_FAILED)
+    if codes_count:
         logger.info(f"Очищены неуспешные коды для UID {uid}")
+    return codes_count
+
+def forget_used_codes(uid: str) -> int:
+    """Очищает список использованных кодов для UID, возвращает число удаленных кодов"""
+    codes_count = code_history.clear(uid, STATUS_USED)
+    if codes_count:
+        logger.info(f"Очищены использованные коды для UID {uid}")
+    return codes_count
+
+def read_log_tail(path: str, lines: int = 20) -> Optional[List[str]]:
+    """Последние строки лога (None - файла нет)"""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.readlines()[-lines:]
+
+def get_pending_codes(uid: str) -> List[Dict]:
+    """Получает очередь отложенных кодов для конкретного UID"""
+    return code_history.pending(uid)
+
+def set_pending_codes(uid: str, code_records: List[Dict]):
+    """Заменяет очередь отложенных кодов для UID (пустой список удаляет очередь)"""
+    code_history.set_pending(uid, [dict(code_data, carried_over=True) for code_data in code_records])
+    logger.info(f"В очереди отложенных кодов для UID {uid}: {len(code_records)}")
+
+# UID, для которых сейчас идет сессия активации. Две сессии одного UID отправили бы
+# одни и те же коды и перезаписали бы очередь отложенных кодов друг друга.
+# Меняется только из event loop, поэтому замок не нужен
+_active_sessions: Set[str] = set()
+
+def begin_redeem_session(uid: str) -> bool:
+    """Отмечает начало сессии активации UID; False - другая сессия этого UID еще идет"""
+    if uid in _active_sessions:
+        return False
+    _active_sessions.add(uid)
+    return True
+
+def end_redeem_session(uid: str):
+    """Отмечает конец сессии активации UID"""
+    _active_sessions.discard(uid)
+
+def merge_code_records(*code_lists: List[Dict]) -> List[Dict]:
+    """Объединяет списки кодов без дубликатов, сохраняя порядок первого появления"""
+    return dedupe_records(*code_lists)
+
+async def stream_new_codes(uid: str, found: List[Dict]) -> AsyncIterator[List[Dict]]:
+    """
+    Пачки новых для UID кодов по мере ответа сайтов (iter_codes_fixed) после
+    filter_new_codes: без использованных, неуспешных, истекших и глобально мертвых
+    Все найденные на сайтах коды дописываются в found - для отчета
+    """
+    batches = iter_codes_fixed()
+    while True:
+        # Генератор ждет ответа сайтов - шагаем по нему в пуле сбора кодов, не блокируя event loop
+        batch = await run_scrape(next, batches, None)
+        if batch is None:
+            break
+        found.extend(batch)
+        new_codes = await run_blocking(filter_new_codes, uid, batch)
+        if new_codes:
+            yield new_codes
+
+class PrefetchedStream:
+    """
+    Асинхронный поток пачек кодов, запущенный заранее в фоновой задаче:
+    источник работает параллельно с другими шагами (верификация, список ролей),
+    а готовые пачки ждут в буфере, пока их не начнут читать
+    """
+    
+    def __init__(self, source: AsyncIterator[List[Dict]]):
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._pump(source))
+    
+    async def _pump(self, source: AsyncIterator[List[Dict]]):
+        try:
+            async for batch in source:
+                self._queue.put_nowait(batch)
+        except Exception as e:
+            logger.error(f"❌ Ошибка потока кодов: {e}")
+        finally:
+            self._queue.put_nowait(None)
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self) -> List[Dict]:
+        batch = await self._queue.get()
+        if batch is None:
+            raise StopAsyncIteration
+        return batch
+    
+    def cancel(self):
+        """Останавливает источник (например, если верификация не прошла)"""
+        self._task.cancel()
 
 class AFKTelegramBot:
     def __init__(self, bot_token: str):
         self.bot_token = bot_token
         self.application = None  # Инициализируем позже
+        self.watchdog = LoopWatchdog()  # Следит, чтобы ни один обработчик не блокировал event loop
         
         # Загружаем сохраненные настройки пользователей
         self.load_saved_user_data()
@@ -276,16 +388,19 @@ class AFKTelegramBot:
         self.application.add_handler(CallbackQueryHandler(self.parse_codes_menu, pattern="^parse_codes$"))
         self.application.add_handler(CallbackQueryHandler(self.redeem_codes_menu, pattern="^redeem_codes$"))
         self.application.add_handler(CallbackQueryHandler(self.settings_menu, pattern="^settings$"))
-        self.application.add_handler(CallbackQueryHandler(self.account_info, pattern="^account_info$"))
+        self.application.add_handler(CallbackQueryHandler(self.account_info, pattern="^account_info$", block=False))
+        
+        # Парсинг и активация идут десятки секунд: block=False - обновления других
+        # пользователей обрабатываются, не дожидаясь окончания этих обработчиков
         
         # Парсинг кодов
-        self.application.add_handler(CallbackQueryHandler(self.parse_afk_guide, pattern="^parse_afk_guide$"))
-        self.application.add_handler(CallbackQueryHandler(self.parse_lolvvv, pattern="^parse_lolvvv$"))
-        self.application.add_handler(CallbackQueryHandler(self.parse_all_sites, pattern="^parse_all_sites$"))
+        self.application.add_handler(CallbackQueryHandler(self.parse_afk_guide, pattern="^parse_afk_guide$", block=False))
+        self.application.add_handler(CallbackQueryHandler(self.parse_lolvvv, pattern="^parse_lolvvv$", block=False))
+        self.application.add_handler(CallbackQueryHandler(self.parse_all_sites, pattern="^parse_all_sites$", block=False))
         
         # Активация кодов
-        self.application.add_handler(CallbackQueryHandler(self.quick_redeem, pattern="^quick_redeem$"))
-        self.application.add_handler(CallbackQueryHandler(self.redeem_with_parsing, pattern="^redeem_with_parsing$"))
+        self.application.add_handler(CallbackQueryHandler(self.quick_redeem, pattern="^quick_redeem$", block=False))
+        self.application.add_handler(CallbackQueryHandler(self.redeem_with_parsing, pattern="^redeem_with_parsing$", block=False))
         
         # Настройки
         self.application.add_handler(CallbackQueryHandler(self.clear_account, pattern="^clear_account$"))
@@ -451,7 +566,7 @@ class AFKTelegramBot:
         user_data[user_id]['uid'] = uid
         
         # Сохраняем UID в файл для постоянного хранения
-        save_user_uid(user_id, uid)
+        await run_blocking(save_user_uid, user_id, uid)
         
         success_text = f"""
 ✅ **UID сохранен:** `{uid}`
@@ -496,7 +611,7 @@ class AFKTelegramBot:
         
         try:
             uid = user_data[user_id]['uid']
-            api = LilithAPI(uid, verification_code)
+            api = AsyncLilithAPI(uid, verification_code)
             
             if await self.test_api_connection(api):
                 success_text = f"""
@@ -517,6 +632,13 @@ class AFKTelegramBot:
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 
                 await update.message.reply_text(success_text, reply_markup=reply_markup, parse_mode='Markdown')
+                
+                # Отложенные коды активируем сразу - пока Verification Code свежий.
+                # Отдельной задачей: сессия длится до конца окна кода, а обработчик
+                # диалога блокирующий и держал бы обновления остальных пользователей
+                if await run_blocking(get_pending_codes, uid):
+                    context.application.create_task(self.drain_pending_codes(update, api), update=update)
+                
                 return ConversationHandler.END
             else:
                 error_text = """
@@ -546,12 +668,56 @@ class AFKTelegramBot:
             )
             return ConversationHandler.END
     
-    async def test_api_connection(self, api: LilithAPI) -> bool:
+    async def drain_pending_codes(self, update: Update, api: AsyncLilithAPI):
+        """Активация очереди отложенных кодов без парсинга сайтов"""
+        user_id = update.effective_user.id
+        if not begin_redeem_session(api.uid):
+            # Идущая сессия сама берет очередь первой - остаток дождется следующей
+            logger.info(f"⏳ Для UID {api.uid} уже идет активация - очередь отложенных кодов не трогаем")
+            return
+        
+        try:
+            pending_count = len(await run_blocking(get_pending_codes, api.uid))
+            await update.message.reply_text(f"▶️ В очереди {pending_count} отложенных кодов - активирую сразу...")
+            
+            accounts = await api.get_user_accounts()
+            if not accounts:
+                await update.message.reply_text("❌ Не удалось получить список аккаунтов. Коды остаются в очереди.")
+                return
+            
+            stats = await self.run_redeem_session(
+                api, accounts, [], user_data[user_id].get('setup_time'),
+                notify=update.message.reply_text
+            )
+            
+            result_text = f"""
+🎉 **Отложенные коды обработаны!**
+
+✅ Успешных кодов: {len(stats['successful_codes'])}
+❌ Неуспешных кодов: {len(stats['failed_codes'])}
+📦 Обработано кодов: {stats['total_processed']}
+            """
+            
+            if stats["successful_codes"]:
+                result_text += "\n💎 Проверь игру - награды должны быть в почте!"
+            
+            result_text += format_batch_interruption(stats)
+            
+            keyboard = [[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            
+            await update.message.reply_text(result_text, reply_markup=reply_markup, parse_mode='Markdown')
+            
+        except Exception as e:
+            logger.error(f"Ошибка активации отложенных кодов: {e}")
+            await update.message.reply_text(f"❌ Ошибка активации отложенных кодов: {str(e)}")
+        finally:
+            end_redeem_session(api.uid)
+    
+    async def test_api_connection(self, api: AsyncLilithAPI) -> bool:
         """Тестирование подключения к API"""
         try:
-            # Запускаем синхронную функцию в отдельном потоке
-            loop = asyncio.get_event_loop()
-            return await loop.run_in_executor(None, api.verify_account)
+            return await api.verify_account()
         except Exception as e:
             logger.error(f"Ошибка тестирования API: {e}")
             return False
@@ -626,13 +792,12 @@ class AFKTelegramBot:
         
         try:
             # Запускаем парсинг в отдельном потоке
-            loop = asyncio.get_event_loop()
-            codes = await loop.run_in_executor(None, parse_afk_guide_fixed, 'https://afk.guide/redemption-codes/')
+            codes = await run_scrape(scrape_source, 'afk.guide')
             
             if codes:
                 # Фильтруем уже использованные коды
                 if uid:
-                    new_codes = filter_new_codes(uid, codes)
+                    new_codes = await run_blocking(filter_new_codes, uid, codes)
                     used_count = len(codes) - len(new_codes)
                 else:
                     new_codes = codes
@@ -693,13 +858,12 @@ class AFKTelegramBot:
         
         try:
             # Запускаем парсинг в отдельном потоке
-            loop = asyncio.get_event_loop()
-            codes = await loop.run_in_executor(None, parse_lolvvv_fixed, 'https://www.lolvvv.com/codes/afk-arena')
+            codes = await run_scrape(scrape_source, 'lolvvv.com')
             
             if codes:
                 # Фильтруем уже использованные коды
                 if uid:
-                    new_codes = filter_new_codes(uid, codes)
+                    new_codes = await run_blocking(filter_new_codes, uid, codes)
                     used_count = len(codes) - len(new_codes)
                 else:
                     new_codes = codes
@@ -760,13 +924,12 @@ class AFKTelegramBot:
         
         try:
             # Запускаем парсинг в отдельном потоке
-            loop = asyncio.get_event_loop()
-            all_codes = await loop.run_in_executor(None, get_all_codes_fixed)
+            all_codes = await run_scrape(get_all_codes_fixed)
             
             if all_codes:
                 # Фильтруем уже использованные коды
                 if uid:
-                    new_codes = filter_new_codes(uid, all_codes)
+                    new_codes = await run_blocking(filter_new_codes, uid, all_codes)
                     used_count = len(all_codes) - len(new_codes)
                 else:
                     new_codes = all_codes
@@ -806,6 +969,9 @@ class AFKTelegramBot:
                     code = code_data.get('code', 'N/A')
                     source = code_data.get('source', 'N/A')
                     codes_text += f"`{i:2d}. {code}` ({source})\n"
+                    gifts = code_data.get('gifts') or {}
+                    if gifts and 'Unknown' not in gifts:
+                        codes_text += f"      🎁 {describe_rewards(gifts)}\n"
                 
                 if len(new_codes) > 15:
                     codes_text += f"\n... и еще {len(new_codes) - 15} кодов"
@@ -840,12 +1006,81 @@ class AFKTelegramBot:
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="parse_codes")]])
             )
     
+    async def run_redeem_session(self, api: AsyncLilithAPI, accounts: List[Dict], code_records: List[Dict],
+                                 setup_time: Optional[datetime], notify=None) -> Dict:
+        """
+        Общая часть активации для всех обработчиков:
+        отложенные коды прошлых сессий идут первыми, план строится под окно
+        Verification Code, а все что не успели - снова попадает в очередь
+        """
+        uid = api.uid
+        
+        pending = await run_blocking(lambda: filter_new_codes(uid, get_pending_codes(uid)))
+        records = merge_code_records(pending, code_records)
+        if pending:
+            logger.info(f"▶️ Добавлено {len(pending)} отложенных кодов для UID {uid}")
+        
+        # Планируем сессию под окно Verification Code: самые ценные коды первыми
+        deadline = session_deadline(setup_time)
+        targets_count = len(group_accounts_by_target(uid, accounts))
+        codes_to_activate, not_planned = plan_redemption(
+            records, api.pacer, deadline, targets_count, MAX_CODES_PER_SESSION
+        )
+        if not_planned and notify:
+            await notify(f"🔄 Найдено {len(records)} кодов. Активирую {len(codes_to_activate)} за эту сессию...")
+        
+        stats = await api.redeem_codes_batch_with_tracking(codes_to_activate, BATCH_SIZE, deadline)
+        stats["not_attempted_codes"].extend(not_planned)
+        
+        # Сохраняем результаты
+        await run_blocking(save_batch_results, uid, stats)
+        
+        # Все, что не получило окончательного вердикта, ждет следующего Verification Code
+        leftover = CodeIndex(stats["not_attempted_codes"] + stats["remaining_codes"])
+        await run_blocking(set_pending_codes, uid, [code_data for code_data in records if code_data['code'] in leftover])
+        
+        return stats
+    
+    async def run_streaming_session(self, api: AsyncLilithAPI, code_batches: AsyncIterator[List[Dict]],
+                                    setup_time: Optional[datetime]) -> Dict:
+        """
+        Потоковый вариант run_redeem_session: отложенные коды идут первой пачкой,
+        новые - по мере ответа сайтов, а все что не успели - снова попадает в очередь
+        """
+        uid = api.uid
+        
+        pending = await run_blocking(lambda: filter_new_codes(uid, get_pending_codes(uid)))
+        if pending:
+            logger.info(f"▶️ Добавлено {len(pending)} отложенных кодов для UID {uid}")
+        records: List[Dict] = []
+        
+        async def batches():
+            if pending:
+                records.extend(pending)
+                yield pending
+            async for batch in code_batches:
+                records.extend(batch)
+                yield batch
+        
+        stats = await api.redeem_codes_stream(batches(), session_deadline(setup_time), MAX_CODES_PER_SESSION)
+        
+        # Сохраняем результаты
+        await run_blocking(save_batch_results, uid, stats)
+        
+        # Все, что не получило окончательного вердикта, ждет следующего Verification Code
+        leftover = CodeIndex(stats["not_attempted_codes"] + stats["remaining_codes"])
+        await run_blocking(set_pending_codes, uid,
+                           [code_data for code_data in merge_code_records(records) if code_data['code'] in leftover])
+        
+        return stats
+    
     async def redeem_codes_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Меню активации кодов"""
         user_id = update.effective_user.id
         user_info = user_data.get(user_id, {})
         
-        has_parsed_codes = bool(user_info.get('parsed_codes'))
+        pending_count = len(await run_blocking(get_pending_codes, user_info['uid'])) if user_info.get('uid') else 0
+        has_parsed_codes = bool(user_info.get('parsed_codes')) or pending_count > 0
         
         menu_text = """
 🎁 **Активация промокодов**
@@ -856,10 +1091,13 @@ class AFKTelegramBot:
 🔍 **С парсингом** - сначала парсит, потом активирует
         """
         
-        if has_parsed_codes:
+        if user_info.get('parsed_codes'):
             parsed_count = len(user_info['parsed_codes'])
             menu_text += f"\n💾 У тебя есть {parsed_count} сохраненных кодов"
         
+        if pending_count:
+            menu_text += f"\n📥 В очереди {pending_count} отложенных кодов"
+        
         keyboard = []
         
         if has_parsed_codes:
@@ -879,7 +1117,7 @@ class AFKTelegramBot:
         user_id = update.effective_user.id
         user_info = user_data.get(user_id, {})
         
-        if not user_info.get('parsed_codes'):
+        if not user_info.get('parsed_codes') and not await run_blocking(get_pending_codes, user_info.get('uid', '')):
             await update.callback_query.edit_message_text(
                 "❌ Нет сохраненных кодов. Сначала выполни парсинг.",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔍 Парсить коды", callback_data="parse_codes")]])
@@ -893,18 +1131,24 @@ class AFKTelegramBot:
             )
             return
         
-        codes = user_info['parsed_codes']
+        if not begin_redeem_session(user_info['uid']):
+            await update.callback_query.edit_message_text(
+                SESSION_BUSY_TEXT,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="redeem_codes")]])
+            )
+            return
+        
+        codes = user_info.get('parsed_codes', [])
         await update.callback_query.edit_message_text(f"🔄 Активирую {len(codes)} кодов...")
         
         try:
             uid = user_info['uid']
             verification_code = user_info['verification_code']
             
-            api = LilithAPI(uid, verification_code)
+            api = AsyncLilithAPI(uid, verification_code)
             
             # Верификация аккаунта (асинхронно)
-            loop = asyncio.get_event_loop()
-            if not await loop.run_in_executor(None, api.verify_account):
+            if not await api.verify_account():
                 # Если верификация не удалась - предлагаем обновить код
                 error_text = """
 ❌ **Не удалось верифицировать аккаунт**
@@ -930,7 +1174,7 @@ class AFKTelegramBot:
                 return
             
             # Получаем аккаунты (асинхронно)
-            accounts = await loop.run_in_executor(None, api.get_user_accounts)
+            accounts = await api.get_user_accounts()
             if not accounts:
                 await update.callback_query.edit_message_text(
                     "❌ Не удалось получить список аккаунтов.",
@@ -939,25 +1183,10 @@ class AFKTelegramBot:
                 return
             
             # Активируем коды батчами (асинхронно)
-            codes_list = [code_data['code'] for code_data in codes]
-            
-            # Ограничиваем количество кодов
-            codes_to_activate = codes_list[:MAX_CODES_PER_SESSION]
-            if len(codes_list) > MAX_CODES_PER_SESSION:
-                await update.callback_query.edit_message_text(
-                    f"🔄 Найдено {len(codes_list)} кодов. Активирую первые {MAX_CODES_PER_SESSION} за эту сессию..."
-                )
-            
-            stats = await loop.run_in_executor(None, api.redeem_codes_batch_with_tracking, codes_to_activate, BATCH_SIZE)
-            
-            # Сохраняем результаты
-            if stats["successful_codes"]:
-                add_used_codes(uid, stats["successful_codes"])
-                logger.info(f"Сохранено {len(stats['successful_codes'])} успешных кодов для UID {uid}")
-            
-            if stats["failed_codes"]:
-                add_failed_codes(uid, stats["failed_codes"])
-                logger.info(f"Сохранено {len(stats['failed_codes'])} неуспешных кодов для UID {uid}")
+            stats = await self.run_redeem_session(
+                api, accounts, codes, user_info.get('setup_time'),
+                notify=update.callback_query.edit_message_text
+            )
             
             # Формируем отчет
             total_attempts = stats["success"] + stats["failed"]
@@ -980,15 +1209,14 @@ class AFKTelegramBot:
 👥 **Аккаунтов обработано:** {len(accounts)}
             """
             
-            if len(codes_list) > MAX_CODES_PER_SESSION:
-                result_text += f"\n💡 Осталось {len(codes_list) - MAX_CODES_PER_SESSION} кодов для следующей сессии"
-            
             if stats["successful_codes"]:
                 result_text += "\n💎 Проверь игру - награды должны быть в почте!"
             
             if stats["failed_codes"]:
                 result_text += f"\n🔄 {len(stats['failed_codes'])} кодов сохранены как неуспешные и будут пропущены в будущем"
             
+            result_text += format_batch_interruption(stats)
+            
             keyboard = [
                 [InlineKeyboardButton("🔍 Парсить новые коды", callback_data="parse_codes")],
                 [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
@@ -1003,6 +1231,8 @@ class AFKTelegramBot:
                 f"❌ Ошибка активации: {str(e)}",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="redeem_codes")]])
             )
+        finally:
+            end_redeem_session(user_info['uid'])
     
     async def redeem_with_parsing(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Активация с предварительным парсингом"""
@@ -1016,40 +1246,35 @@ class AFKTelegramBot:
             )
             return
         
-        await update.callback_query.edit_message_text("🔄 Парсю коды со всех сайтов...")
+        uid = user_info['uid']
+        verification_code = user_info['verification_code']
+        
+        if not begin_redeem_session(uid):
+            await update.callback_query.edit_message_text(
+                SESSION_BUSY_TEXT,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="redeem_codes")]])
+            )
+            return
+        
+        await update.callback_query.edit_message_text("🔄 Парсю коды со всех сайтов и проверяю аккаунт...")
+        
+        # Парсинг сайтов не зависит от верификации: запускаем его сразу, параллельно
+        # с верификацией и списком ролей - готовые пачки кодов ждут в буфере
+        all_codes: List[Dict] = []
+        code_stream = PrefetchedStream(stream_new_codes(uid, all_codes))
         
         try:
-            # Парсим коды
-            all_codes = get_all_codes_fixed()
-            
-            if not all_codes:
-                await update.callback_query.edit_message_text(
-                    "❌ Не найдено активных кодов на сайтах.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="redeem_codes")]])
-                )
-                return
-            
-            # Сохраняем коды
-            user_data[user_id]['parsed_codes'] = all_codes
-            
-            await update.callback_query.edit_message_text(f"🔄 Найдено {len(all_codes)} кодов. Активирую...")
-            
-            # Активируем коды (используем ту же логику что и в quick_redeem)
-            uid = user_info['uid']
-            verification_code = user_info['verification_code']
-            
-            api = LilithAPI(uid, verification_code)
+            api = AsyncLilithAPI(uid, verification_code)
             
             # Все API вызовы делаем асинхронными
-            loop = asyncio.get_event_loop()
-            if not await loop.run_in_executor(None, api.verify_account):
+            if not await api.verify_account():
                 await update.callback_query.edit_message_text(
                     "❌ Не удалось верифицировать аккаунт. Возможно истек Verification Code.",
                     reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⚙️ Обновить код", callback_data="setup_account")]])
                 )
                 return
             
-            accounts = await loop.run_in_executor(None, api.get_user_accounts)
+            accounts = await api.get_user_accounts()
             if not accounts:
                 await update.callback_query.edit_message_text(
                     "❌ Не удалось получить список аккаунтов.",
@@ -1057,25 +1282,18 @@ class AFKTelegramBot:
                 )
                 return
             
-            codes_list = [code_data['code'] for code_data in all_codes]
+            # Коды активируются по мере ответа сайтов: первый код уходит, пока медленные сайты еще грузятся
+            stats = await self.run_streaming_session(api, code_stream, user_info.get('setup_time'))
             
-            # Ограничиваем количество кодов
-            codes_to_activate = codes_list[:MAX_CODES_PER_SESSION]
-            if len(codes_list) > MAX_CODES_PER_SESSION:
+            if not all_codes and not stats["total_processed"]:
                 await update.callback_query.edit_message_text(
-                    f"🔄 Найдено {len(codes_list)} кодов. Активирую первые {MAX_CODES_PER_SESSION} за эту сессию..."
+                    "❌ Не найдено активных кодов на сайтах.",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="redeem_codes")]])
                 )
+                return
             
-            stats = await loop.run_in_executor(None, api.redeem_codes_batch_with_tracking, codes_to_activate, BATCH_SIZE)
-            
-            # Сохраняем результаты
-            if stats["successful_codes"]:
-                add_used_codes(uid, stats["successful_codes"])
-                logger.info(f"Сохранено {len(stats['successful_codes'])} успешных кодов для UID {uid}")
-            
-            if stats["failed_codes"]:
-                add_failed_codes(uid, stats["failed_codes"])
-                logger.info(f"Сохранено {len(stats['failed_codes'])} неуспешных кодов для UID {uid}")
+            # Сохраняем коды
+            user_data[user_id]['parsed_codes'] = all_codes
             
             # Статистика по источникам
             sources_stats = {}
@@ -1110,15 +1328,14 @@ class AFKTelegramBot:
 👥 **Аккаунтов обработано:** {len(accounts)}
             """
             
-            if len(codes_list) > MAX_CODES_PER_SESSION:
-                result_text += f"\n💡 Осталось {len(codes_list) - MAX_CODES_PER_SESSION} кодов для следующей сессии"
-            
             if stats["successful_codes"]:
                 result_text += "\n💎 Проверь игру - награды должны быть в почте!"
             
             if stats["failed_codes"]:
                 result_text += f"\n🔄 {len(stats['failed_codes'])} кодов сохранены как неуспешные"
             
+            result_text += format_batch_interruption(stats)
+            
             keyboard = [
                 [InlineKeyboardButton("🔄 Повторить", callback_data="redeem_with_parsing")],
                 [InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]
@@ -1133,6 +1350,9 @@ class AFKTelegramBot:
                 f"❌ Ошибка: {str(e)}",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад", callback_data="redeem_codes")]])
             )
+        finally:
+            code_stream.cancel()
+            end_redeem_session(uid)
     
     async def account_info(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Информация об аккаунте"""
@@ -1167,12 +1387,11 @@ class AFKTelegramBot:
                     [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
                 ]
             else:
-                api = LilithAPI(uid, verification_code)
+                api = AsyncLilithAPI(uid, verification_code)
                 
                 # Асинхронные вызовы API
-                loop = asyncio.get_event_loop()
-                if await loop.run_in_executor(None, api.verify_account):
-                    accounts = await loop.run_in_executor(None, api.get_user_accounts)
+                if await api.verify_account():
+                    accounts = await api.get_user_accounts()
                     
                     info_text = f"""
 👤 **Информация об аккаунте**
@@ -1235,8 +1454,8 @@ class AFKTelegramBot:
         uid = user_info.get('uid', '')
         
         # Подсчитываем коды
-        used_codes_count = len(get_used_codes(uid)) if uid else 0
-        failed_codes_count = len(get_failed_codes(uid)) if uid else 0
+        used_codes_count = await run_blocking(count_used_codes, uid) if uid else 0
+        failed_codes_count = await run_blocking(count_failed_codes, uid) if uid else 0
         
         menu_text = f"""
 ⚙️ **Настройки бота**
@@ -1269,25 +1488,23 @@ class AFKTelegramBot:
         uid = user_info.get('uid', '')
         
         # Подсчитываем что будет удалено
-        used_codes_count = len(get_used_codes(uid)) if uid else 0
-        failed_codes_count = len(get_failed_codes(uid)) if uid else 0
+        used_codes_count = await run_blocking(count_used_codes, uid) if uid else 0
+        failed_codes_count = await run_blocking(count_failed_codes, uid) if uid else 0
         
         # Очищаем данные пользователя
         if user_id in user_data:
             del user_data[user_id]
         
-        # Очищаем использованные коды
+        # Забываем сохраненный токен, список ролей и очередь отложенных кодов
         if uid:
-            used_codes = load_used_codes()
-            if uid in used_codes:
-                del used_codes[uid]
-                save_used_codes(used_codes)
-            
-            # Очищаем неуспешные коды
-            failed_codes = load_failed_codes()
-            if uid in failed_codes:
-                del failed_codes[uid]
-                save_failed_codes(failed_codes)
+            token_cache.invalidate_uid(uid)
+            roster_cache.invalidate(uid)
+            await run_blocking(set_pending_codes, uid, [])
+        
+        # Очищаем использованные и неуспешные коды
+        if uid:
+            await run_blocking(forget_used_codes, uid)
+            await run_blocking(clear_failed_codes, uid)
         
         success_text = f"""
 🗑️ **Все данные очищены**
@@ -1313,11 +1530,8 @@ class AFKTelegramBot:
         """Просмотр логов"""
         try:
             # Читаем последние 20 строк лога
-            if os.path.exists('telegram_bot.log'):
-                with open('telegram_bot.log', 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    last_lines = lines[-20:] if len(lines) > 20 else lines
-                
+            last_lines = await run_blocking(read_log_tail, 'telegram_bot.log', 20)
+            if last_lines is not None:
                 log_text = "📋 **Последние записи лога:**\n\n```\n"
                 log_text += ''.join(last_lines)
                 log_text += "\n```"
@@ -1353,7 +1567,7 @@ class AFKTelegramBot:
             return
         
         try:
-            used_codes = get_used_codes(uid)
+            used_codes = await run_blocking(get_used_codes, uid)
             
             if used_codes:
                 codes_text = f"📋 **Использованные коды для UID {uid}:**\n\n"
@@ -1402,12 +1616,7 @@ class AFKTelegramBot:
             return
         
         try:
-            used_codes = load_used_codes()
-            codes_count = len(used_codes.get(uid, []))
-            
-            if uid in used_codes:
-                del used_codes[uid]
-                save_used_codes(used_codes)
+            codes_count = await run_blocking(forget_used_codes, uid)
             
             success_text = f"""
 🧹 **Список использованных кодов очищен**
@@ -1461,8 +1670,8 @@ class AFKTelegramBot:
         status_text += f"💾 Сохранено кодов: {len(parsed_codes)}\n"
         
         # Информация об использованных кодах
-        used_codes_count = len(get_used_codes(uid)) if uid else 0
-        failed_codes_count = len(get_failed_codes(uid)) if uid else 0
+        used_codes_count = await run_blocking(count_used_codes, uid) if uid else 0
+        failed_codes_count = await run_blocking(count_failed_codes, uid) if uid else 0
         status_text += f"✅ Успешных кодов: {used_codes_count}\n"
         status_text += f"❌ Неуспешных кодов: {failed_codes_count}\n"
         
@@ -1482,6 +1691,24 @@ class AFKTelegramBot:
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")]])
         )
     
+    async def on_startup(self, application: Application):
+        """Запуск сторожа event loop вместе с ботом, модель формы кодов учится на истории активаций"""
+        self.watchdog.start()
+        await run_blocking(dead_codes.load)
+        learn_codes(await run_blocking(code_history.recent_codes, STATUS_USED, SHAPE_HISTORY_LIMIT))
+    
+    async def on_shutdown(self, application: Application):
+        """Освобождение ресурсов при остановке бота"""
+        self.watchdog.stop()
+        await close_shared_session()
+        await run_blocking(dead_codes.flush)
+        shutdown_parse_pool()
+        shutdown_blocking_pool()
+        logger.info("🔌 Пул соединений Lilith API, процессы парсинга и пул потоков закрыты")
+        if self.watchdog.stalls:
+            logger.info(f"🐢 Зависаний event loop за сессию: {self.watchdog.stalls}, "
+                        f"самое долгое {self.watchdog.longest_stall:.2f}с")
+    
     def run(self):
         """Запуск бота с обработкой ошибок"""
         logger.info("🚀 Запуск AFK Arena Telegram Bot")
@@ -1498,6 +1725,8 @@ class AFKTelegramBot:
                 .get_updates_write_timeout(10)
                 .get_updates_connect_timeout(10)
                 .get_updates_pool_timeout(5)
+                .post_init(self.on_startup)
+                .post_shutdown(self.on_shutdown)
                 .build()
             )
             self.setup_handlers()
@@ -1542,7 +1771,7 @@ class AFKTelegramBot:
                 print("3. Обновить зависимости: pip3 install -r requirements.txt")
             
             raise
-
+    
     async def view_failed_codes(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Просмотр неуспешных кодов"""
         user_id = update.effective_user.id
@@ -1557,7 +1786,7 @@ class AFKTelegramBot:
             return
         
         try:
-            failed_codes = get_failed_codes(uid)
+            failed_codes = await run_blocking(get_failed_codes, uid)
             
             if failed_codes:
                 codes_text = f"❌ **Неуспешные коды для UID {uid}:**\n\n"
@@ -1607,10 +1836,7 @@ class AFKTelegramBot:
             return
         
         try:
-            failed_codes = get_failed_codes(uid)
-            codes_count = len(failed_codes)
-            
-            clear_failed_codes(uid)
+            codes_count = await run_blocking(clear_failed_codes, uid)
             
             success_text = f"""
 🔄 **Список неуспешных кодов сброшен**